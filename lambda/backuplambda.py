@@ -1,17 +1,994 @@
 from __future__ import print_function
 
+import calendar
 import json
 import logging
+import math
+import os
+import random
 import sys
+import threading
+import time
 import traceback
-from datetime import datetime
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, tzinfo
+
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
 
-import boto3
-import pytz
+# boto3 and botocore are imported where they are first needed, they are most of a cold start
+# and an invocation only pays for them once it gets as far as building a client
+
+try:
+    from datetime import timezone
+    UTC = timezone.utc
+except ImportError:
+    class _UTC(tzinfo):
+        def utcoffset(self, dt):
+            return timedelta(0)
+
+        def tzname(self, dt):
+            return 'UTC'
+
+        def dst(self, dt):
+            return timedelta(0)
+
+    UTC = _UTC()
+
+# Maximum number of resource ids to resolve tags for in a single describe_tags call
+TAG_LOOKUP_BATCH_SIZE = 200
+
+# Maximum number of instance or snapshot ids to filter on in a single describe call
+ID_FILTER_BATCH_SIZE = 200
+
+# Both EC2 and RDS allow at most 50 tags on a resource
+MAX_TAGS_PER_RESOURCE = 50
+
+# Bookkeeping tags applied to every snapshot the tool creates
+PERIOD_TAG = 'backuplambda:period'
+DATE_SUFFIX_TAG = 'backuplambda:date-suffix'
+SOURCE_TAG = 'backuplambda:source'
+
+# Names the tag_name=tag_value the snapshot was taken under, so a sweep can tell a resource untagged
+# since from one backed up by another schedule
+SCHEDULE_TAG = 'backuplambda:schedule'
+
+# Applied instead of the source tag to the snapshots taken together of an instance's volumes,
+# which all get the one set of tags, each names its volume in its own VolumeId
+INSTANCE_TAG = 'backuplambda:instance'
+
+# Tags applied to the copies in a DR region, naming the snapshot copied and when it was taken
+COPY_OF_TAG = 'backuplambda:copy-of'
+SOURCE_TIME_TAG = 'backuplambda:source-time'
+
+# Tag on a manual snapshot promoted from an automated one, naming the automated snapshot
+PROMOTED_FROM_TAG = 'backuplambda:promoted-from'
+
+# Oldest automated snapshot to promote, automated backups are taken once a day
+DEFAULT_PROMOTE_MAX_AGE_HOURS = 24
+
+# Copies to have in progress in a DR region at once, well under the per destination quotas
+DEFAULT_COPIES_IN_FLIGHT = 5
+
+# Error codes the EC2 and RDS APIs answer with when the account is over its request rate
+THROTTLE_ERROR_CODES = frozenset(['RequestLimitExceeded', 'Throttling', 'ThrottlingException',
+                                  'RequestThrottled', 'RequestThrottledException', 'TooManyRequestsException'])
+
+# Retries for the clients ApiRateLimiter handles them for, so botocore's own retry handler is switched off,
+# every other client keeps botocore's
+CLIENT_RETRIES = {'max_attempts': 0}
+
+# Seconds a client waits on a response, the coordinator's invocation of a shard only answers once it has finished,
+# which can take up to the 900 seconds a function is allowed to run
+CLIENT_READ_TIMEOUTS = {'lambda': 910}
+DEFAULT_READ_TIMEOUT = 60
+
+# Error codes a create answers with when the resource or account already has snapshots in progress,
+# the resource is left for a later run rather than counted as failed
+SNAPSHOT_BUSY_ERROR_CODES = frozenset(['SnapshotCreationPerVolumeRateExceeded', 'ConcurrentSnapshotLimitExceeded'])
+
+# Error codes an RDS create answers with when the database is in no state to snapshot, which
+# is only a reason to wait when the database is in one of DB_PASSING_STATUSES
+DB_STATE_ERROR_CODES = frozenset(['InvalidDBInstanceState', 'InvalidDBClusterStateFault'])
+
+# Database and cluster statuses that pass by themselves, such as a backup or modification in
+# progress, rather than need someone to act, as stopped or storage-full do
+DB_PASSING_STATUSES = frozenset(['available', 'backing-up', 'backtracking', 'configuring-enhanced-monitoring',
+                                 'configuring-iam-database-auth', 'configuring-log-exports', 'converting-to-vpc',
+                                 'creating', 'maintenance', 'migrating', 'modifying', 'moving-to-vpc',
+                                 'preparing-data-migration', 'promoting', 'rebooting', 'renaming',
+                                 'resetting-master-credentials', 'starting', 'storage-optimization',
+                                 'upgrading'])
+
+# Error codes a delete answers with when the snapshot is already gone
+SNAPSHOT_GONE_ERROR_CODES = frozenset(['InvalidSnapshot.NotFound', 'DBSnapshotNotFound',
+                                       'DBClusterSnapshotNotFoundFault'])
+
+# Runs a saved snapshot index is refreshed for, and how old it can get, before it is listed
+# again in full to correct any drift, such as snapshots deleted outside the tool
+DEFAULT_RESYNC_RUNS = 24
+DEFAULT_INDEX_MAX_AGE_HOURS = 48
+
+# Snapshot fields holding tag lists, which a saved snapshot index keeps as pairs
+TAG_LIST_KEYS = ('Tags', 'TagList')
+
+# How often to check on the snapshots in progress while waiting for room to start another
+PENDING_POLL_SECONDS = 15
+
+# Most of a run's per resource detail to keep in its report, the rest is only written to the logs
+REPORT_DETAIL_BYTES = 64 * 1024
+
+# Largest message SNS accepts
+SNS_MESSAGE_BYTES = 256 * 1024
+
+# Most resource ids to name in a single line of a report
+REPORT_ID_LIMIT = 20
+
+# CloudWatch namespace for the Embedded Metric Format log lines
+METRICS_NAMESPACE = 'AwsBackupLambda'
+
+# Snapshot times, written out as text in inventories and cursors
+SNAPSHOT_TIME_KEYS = ('StartTime', 'SnapshotCreateTime')
+
+# Renew assumed role credentials when they are this close to expiring
+SESSION_RENEW_SECONDS = 300
+
+# The session, role credentials, clients and account ids, kept at module scope so warm invocations reuse them
+_session = []
+_credentials = {}
+_clients = {}
+_account_ids = {}
+_cache_lock = threading.RLock()
+
+
+def get_session():
+    """
+    The boto3 session for the container. Clients for assumed roles are built from it too,
+    with the role's credentials, so the service models are only loaded once.
+    """
+    with _cache_lock:
+        if not _session:
+            import boto3.session
+            _session.append(boto3.session.Session())
+        return _session[0]
+
+
+def get_credentials(role_arn=None):
+    """
+    Credentials for the role, or None for the execution role.
+    """
+    if role_arn is None:
+        return None
+
+    with _cache_lock:
+        credentials, expires = _credentials.get(role_arn, (None, None))
+        if credentials is not None and expires - time.time() > SESSION_RENEW_SECONDS:
+            return credentials
+
+        print('Assuming role ' + role_arn)
+        assumed = get_client('sts').assume_role(RoleArn=role_arn, RoleSessionName='aws-backup-lambda')['Credentials']
+        credentials = {'aws_access_key_id': assumed['AccessKeyId'],
+                       'aws_secret_access_key': assumed['SecretAccessKey'],
+                       'aws_session_token': assumed['SessionToken']}
+        _credentials[role_arn] = (credentials, calendar.timegm(assumed['Expiration'].utctimetuple()))
+        return credentials
+
+
+def get_client(service_name, region_name=None, role_arn=None, retries=None, slot=None):
+    """
+    A client for the service in the region, shared by everything in the container
+    using the same role. retries replaces botocore's retry settings, e.g. CLIENT_RETRIES,
+    and slot keeps a client of its own for a manager running alongside others in the
+    same region, whose event handlers would otherwise replace each other's.
+    """
+    with _cache_lock:
+        credentials = get_credentials(role_arn)
+        key = (service_name, region_name, role_arn, tuple(sorted((retries or {}).items())), slot)
+
+        # Renewed credentials mean the client is rebuilt with them
+        client_credentials, client = _clients.get(key, (None, None))
+        if client is None or client_credentials is not credentials:
+            from botocore.config import Config
+            config = Config(read_timeout=CLIENT_READ_TIMEOUTS.get(service_name, DEFAULT_READ_TIMEOUT))
+            if retries is not None:
+                config = config.merge(Config(retries=retries))
+            client = get_session().client(service_name, region_name=region_name, config=config,
+                                          **(credentials or {}))
+            _clients[key] = (credentials, client)
+        return client
+
+
+def get_account_id(role_arn=None):
+    with _cache_lock:
+        if role_arn not in _account_ids:
+            _account_ids[role_arn] = get_client('sts', role_arn=role_arn).get_caller_identity()['Account']
+        return _account_ids[role_arn]
+
+
+def clear_caches():
+    with _cache_lock:
+        del _session[:]
+        _credentials.clear()
+        _clients.clear()
+        _account_ids.clear()
+
+
+def prefetch(iterable, depth=1):
+    """
+    Iterate over iterable on a background thread, keeping up to depth items fetched
+    ahead of the consumer, so the next page of a listing is in flight while the
+    current one is being processed.
+    """
+    queue = Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry):
+        # Give up once the consumer has, rather than block on a full queue nobody reads
+        while not stop.is_set():
+            try:
+                queue.put(entry, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception:
+            put((done, sys.exc_info()))
+
+    worker = threading.Thread(target=produce)
+    worker.daemon = True
+    worker.start()
+
+    try:
+        while True:
+            item, exc_info = queue.get()
+            if item is done:
+                if exc_info is not None:
+                    raise exc_info[1]
+                return
+            yield item
+    finally:
+        # The consumer may give up early, let the producer know it can stop
+        stop.set()
+
+
+def shard_of(key, shard_count):
+    """
+    The shard a resource falls in, from a hash of its id that is the same in every invocation and
+    Python version, so the retention decisions for a resource are always made by the same shard.
+    """
+    return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % shard_count
+
+
+class SnapshotIndex(object):
+    """
+    In-memory index of snapshots keyed by the id of the resource they were taken from.
+
+    Built from a single bulk listing, or restored from the index an earlier run saved, so that
+    per-resource lookups cost no API calls. The snapshots added and discarded since are journaled,
+    so a run's changes can be made again to an index saved by another run.
+    """
+
+    def __init__(self, key_func, id_func=None):
+        self.key_func = key_func
+        self.id_func = id_func
+        self.snapshots = {}
+        self.journal = []
+        self.lock = threading.Lock()
+
+    def same(self, snapshot, other):
+        if self.id_func is None:
+            return snapshot == other
+        return self.id_func(snapshot) == self.id_func(other)
+
+    def add(self, snapshot):
+        with self.lock:
+            # A snapshot described again replaces the one already held
+            snapshots = self.snapshots.setdefault(self.key_func(snapshot), [])
+            snapshots[:] = [snap for snap in snapshots if not self.same(snap, snapshot)]
+            snapshots.append(snapshot)
+            self.journal.append(('add', snapshot))
+
+    def extend(self, snapshots):
+        """
+        Fill the index from a listing, which is not journaled.
+        """
+        with self.lock:
+            for snapshot in snapshots:
+                self.snapshots.setdefault(self.key_func(snapshot), []).append(snapshot)
+
+    def discard(self, snapshot):
+        with self.lock:
+            snapshots = self.snapshots.get(self.key_func(snapshot), [])
+            snapshots[:] = [snap for snap in snapshots if not self.same(snap, snapshot)]
+            self.journal.append(('discard', snapshot))
+
+    def replay(self, journal):
+        for action, snapshot in journal:
+            if action == 'add':
+                self.add(snapshot)
+            else:
+                self.discard(snapshot)
+
+    def get(self, resource_id):
+        # Hand back a copy, callers sort the result in place
+        with self.lock:
+            return list(self.snapshots.get(resource_id, []))
+
+    def __iter__(self):
+        with self.lock:
+            snapshots = [snap for snaps in self.snapshots.values() for snap in snaps]
+        return iter(snapshots)
+
+    def __len__(self):
+        return sum(len(snaps) for snaps in self.snapshots.values())
+
+
+class TokenBucket(object):
+    """
+    Token bucket that adapts to throttling, the refill rate is halved every time the
+    API pushes back and recovers gradually as calls go through.
+    """
+
+    def __init__(self, rate, burst=None, min_rate=0.1):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min_rate
+        self.capacity = float(burst or max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class ApiRateLimiter(object):
+    """
+    Client side rate limiting and retries for the boto3 clients, hooked in through
+    botocore's event system so paginated calls are covered too.
+
+    Every API action gets its own token bucket, the rate of which comes from the
+    'describe' budget for read only calls and the 'mutate' budget for everything
+    else, unless the action is given a budget of its own by name.
+    """
+
+    DEFAULT_RATES = {
+        'describe': 20,
+        'mutate': 5,
+    }
+
+    def __init__(self, rates=None, max_attempts=8, base_delay=0.5, max_delay=20):
+        self.rates = dict(self.DEFAULT_RATES)
+        self.rates.update(rates or {})
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def is_read_only(operation_name):
+        return operation_name.startswith(('Describe', 'List', 'Get'))
+
+    def bucket_for(self, service_name, operation_name):
+        key = (service_name, operation_name)
+        with self.lock:
+            if key not in self.buckets:
+                category = 'describe' if self.is_read_only(operation_name) else 'mutate'
+                self.buckets[key] = TokenBucket(self.rates.get(operation_name, self.rates[category]))
+            return self.buckets[key]
+
+    @staticmethod
+    def detach(client):
+        events = client.meta.events
+        events.unregister('before-call', unique_id='backuplambda-rate-limit')
+        events.unregister('needs-retry', unique_id='backuplambda-retry')
+
+    def attach(self, client):
+        # Clients are reused between invocations, replace rather than stack the handlers
+        self.detach(client)
+
+        events = client.meta.events
+        events.register('before-call', self.before_call, unique_id='backuplambda-rate-limit')
+        events.register('needs-retry', self.needs_retry, unique_id='backuplambda-retry')
+
+    def before_call(self, model, **kwargs):
+        self.bucket_for(model.service_model.endpoint_prefix, model.name).acquire()
+
+    def needs_retry(self, attempts, operation, response=None, caught_exception=None, **kwargs):
+        """
+        Called by botocore after every attempt, returns the number of seconds to wait
+        before trying again or None to stop.
+        """
+        bucket = self.bucket_for(operation.service_model.endpoint_prefix, operation.name)
+
+        error_code = None
+        status_code = None
+        if response is not None:
+            http_response, parsed = response
+            error_code = parsed.get('Error', {}).get('Code')
+            status_code = http_response.status_code
+
+        throttled = error_code in THROTTLE_ERROR_CODES
+        if throttled:
+            bucket.throttled()
+        elif caught_exception is None and status_code is not None and status_code < 500:
+            bucket.succeeded()
+            return None
+
+        if attempts >= self.max_attempts:
+            return None
+
+        # A throttled request was never acted on so is always safe to resend, other
+        # failures are only retried for calls that do not change anything
+        if not throttled and not self.is_read_only(operation.name):
+            return None
+
+        # Exponential backoff with full jitter
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempts - 1))))
+        print('Retrying %(operation)s in %(delay).2fs after attempt %(attempts)s (%(reason)s)' % {
+            'operation': operation.name,
+            'delay': delay,
+            'attempts': attempts,
+            'reason': error_code or caught_exception or status_code
+        })
+        return delay
+
+
+def percentile(values, pct):
+    """
+    Nearest rank percentile of a list of values.
+    """
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(pct / 100.0 * len(ordered))) - 1)]
+
+
+def summarise_latencies(latencies):
+    return {
+        'p50_ms': int(percentile(latencies, 50) * 1000),
+        'p95_ms': int(percentile(latencies, 95) * 1000),
+        'max_ms': int(max(latencies) * 1000) if latencies else 0,
+    }
+
+
+def print_emf(dimensions, values, units):
+    """
+    Print a CloudWatch Embedded Metric Format log line, which CloudWatch Logs turns
+    into metrics without any API calls from the function.
+    """
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [sorted(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': units[name]} for name in sorted(values)]
+            }]
+        }
+    }
+    record.update(dimensions)
+    record.update(values)
+    print(json.dumps(record, sort_keys=True))
+
+
+class ApiCallStats(object):
+    """
+    Call counts, retries, throttles and latencies for every API operation made
+    through the clients it is attached to, collected from botocore's events.
+    """
+
+    def __init__(self):
+        self.operations = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @staticmethod
+    def detach(client):
+        events = client.meta.events
+        for event in ('before-call', 'after-call', 'request-created', 'needs-retry'):
+            events.unregister(event, unique_id='backuplambda-stats-' + event)
+
+    def attach(self, client):
+        # Clients are reused between invocations, replace rather than stack the handlers
+        self.detach(client)
+
+        events = client.meta.events
+        events.register('before-call', self.before_call, unique_id='backuplambda-stats-before-call')
+        events.register('after-call', self.after_call, unique_id='backuplambda-stats-after-call')
+        events.register('request-created', self.request_created, unique_id='backuplambda-stats-request-created')
+        events.register('needs-retry', self.needs_retry, unique_id='backuplambda-stats-needs-retry')
+
+    def stats_for(self, event_name):
+        # Event names look like 'after-call.ec2.DescribeVolumes'
+        operation = event_name.split('.', 1)[1]
+        if operation not in self.operations:
+            self.operations[operation] = {'calls': 0, 'attempts': 0, 'throttles': 0, 'latencies': []}
+        return self.operations[operation]
+
+    def before_call(self, event_name, **kwargs):
+        # Requests on one thread run one at a time, so a single start time per thread will do
+        self.local.started = time.time()
+
+    def after_call(self, event_name, **kwargs):
+        elapsed = time.time() - getattr(self.local, 'started', time.time())
+        with self.lock:
+            stats = self.stats_for(event_name)
+            stats['calls'] += 1
+            stats['latencies'].append(elapsed)
+
+    def request_created(self, event_name, **kwargs):
+        with self.lock:
+            self.stats_for(event_name)['attempts'] += 1
+
+    def needs_retry(self, event_name, response=None, **kwargs):
+        # Only watching, the decision to retry is left to the rate limiter
+        if response is not None and response[1].get('Error', {}).get('Code') in THROTTLE_ERROR_CODES:
+            with self.lock:
+                self.stats_for(event_name)['throttles'] += 1
+        return None
+
+    def total_calls(self):
+        with self.lock:
+            return sum(stats['calls'] for stats in self.operations.values())
+
+    def summary(self):
+        with self.lock:
+            summary = {}
+            for operation, stats in self.operations.items():
+                summary[operation] = {
+                    'calls': stats['calls'],
+                    'retries': max(0, stats['attempts'] - stats['calls']),
+                    'throttles': stats['throttles'],
+                }
+                summary[operation].update(summarise_latencies(stats['latencies']))
+            return summary
+
+
+class PhaseTimer(object):
+    """
+    Time spent in each phase of processing a single resource.
+    """
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + time.time() - start
+
+    def __str__(self):
+        return ', '.join('%s %dms' % (name, self.timings[name] * 1000) for name in sorted(self.timings))
+
+
+class BackupMetrics(object):
+    """
+    Counters and phase timings for a backup run, safe to update from the worker threads.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, count=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    def record_timings(self, timer):
+        with self.lock:
+            for name, elapsed in timer.timings.items():
+                self.timings.setdefault(name, []).append(elapsed)
+
+    def timing_summary(self):
+        with self.lock:
+            return dict((name, summarise_latencies(timings)) for name, timings in self.timings.items())
+
+    def __getitem__(self, name):
+        with self.lock:
+            return self.counts.get(name, 0)
+
+
+class RunReport(object):
+    """
+    The report of a run, written out as it goes. Each section of detail and each structured
+    record goes to the logs as soon as it is added, while only the first max_bytes of detail
+    are kept for the summary, so the report stays bounded however large the fleet.
+    """
+
+    def __init__(self, max_bytes=REPORT_DETAIL_BYTES, **fields):
+        self.max_bytes = max_bytes
+        self.fields = fields
+        self.sections = []
+        self.size = 0
+        self.dropped = 0
+
+    def add(self, section):
+        print(section, end='')
+        if self.dropped or self.size + len(section) > self.max_bytes:
+            self.dropped += 1
+            return
+        self.sections.append(section)
+        self.size += len(section)
+
+    def record(self, kind, **fields):
+        """
+        Write a record of a single event, such as a create or delete, to the logs as a JSON line.
+        """
+        record = dict(self.fields, record=kind)
+        record.update(fields)
+        print(json.dumps(record, default=format_timestamp, sort_keys=True))
+
+    def render(self, closing=''):
+        parts = list(self.sections)
+        if self.dropped:
+            parts.append('\n... %(count)s more sections left out, the full report is in the logs\n' % {
+                'count': self.dropped
+            })
+        parts.append(closing)
+        return ''.join(parts)
+
+
+def summarise_ids(ids, limit=REPORT_ID_LIMIT):
+    if len(ids) <= limit:
+        return ', '.join(ids)
+    return '%s and %s more' % (', '.join(ids[:limit]), len(ids) - limit)
+
+
+def truncate_message(message, max_bytes=SNS_MESSAGE_BYTES):
+    """
+    Cut a message down to max_bytes of UTF-8, noting that the rest is in the logs.
+    """
+    encoded = message.encode('utf-8')
+    if len(encoded) <= max_bytes:
+        return message
+
+    note = '\n... truncated, the full report is in the logs\n'
+    return encoded[:max_bytes - len(note)].decode('utf-8', 'ignore') + note
+
+
+class SnapshotDeferred(Exception):
+    """
+    Raised when a resource is left for a later run rather than snapshot, which is not an error.
+    """
+
+
+class OutOfTime(Exception):
+    """
+    Raised when the invocation runs out of time before a resource's snapshot could be started,
+    the resource goes back in the cursor for the next invocation.
+    """
+
+
+class SnapshotSkipped(Exception):
+    """
+    Raised when a resource goes without a new snapshot by design, which is reported with the reason.
+    """
+
+
+class SnapshotRefused(Exception):
+    """
+    Raised when a resource cannot be snapshot until someone sees to it, which is reported as an error.
+    """
+
+
+class PendingSnapshotLimiter(object):
+    """
+    Caps the number of snapshots in progress at once, counting those already in progress when
+    the run started, so creates are spread across the run instead of failing on the account's
+    limits. Waiting creates check on the snapshots in progress every poll_interval seconds.
+    """
+
+    def __init__(self, limit, in_progress, refresh, poll_interval=PENDING_POLL_SECONDS):
+        self.limit = limit
+        self.in_progress = list(in_progress)
+        self.refresh = refresh
+        self.poll_interval = poll_interval
+        self.reserved = 0
+        self.refreshing = False
+        self.last_refresh = time.time()
+        self.condition = threading.Condition()
+
+    def has_room(self, count):
+        # A request bigger than the limit, such as a large instance's volumes, goes ahead
+        # on its own once nothing else is in progress
+        if self.reserved == 0 and not self.in_progress:
+            return True
+        return len(self.in_progress) + self.reserved + count <= self.limit
+
+    def acquire(self, count=1, out_of_time=None):
+        """
+        Wait for room to start count more snapshots.
+
+        :return: False when the invocation ran out of time first
+        """
+        while True:
+            with self.condition:
+                if self.has_room(count):
+                    self.reserved += count
+                    return True
+                if out_of_time is not None and out_of_time():
+                    return False
+
+                if self.refreshing or time.time() - self.last_refresh < self.poll_interval:
+                    self.condition.wait(self.poll_interval)
+                    continue
+
+                # One waiter checks on the snapshots, without holding up release meanwhile
+                self.refreshing = True
+                checking = list(self.in_progress)
+
+            still_in_progress = checking
+            try:
+                still_in_progress = self.refresh(checking)
+            finally:
+                with self.condition:
+                    # Snapshots started while the check ran are still in progress
+                    self.in_progress = list(still_in_progress) + self.in_progress[len(checking):]
+                    self.refreshing = False
+                    self.last_refresh = time.time()
+                    self.condition.notify_all()
+
+    def release(self, count=1, started=()):
+        """
+        Give back the room taken by acquire, keeping track of the snapshots that were started.
+        """
+        with self.condition:
+            self.reserved -= count
+            self.in_progress.extend(started)
+            self.condition.notify_all()
+
+
+class RetentionPlanner(object):
+    """
+    Decides which of a resource's snapshots to keep and which to delete, from a single
+    pass over the snapshots sorted newest first.
+
+    With only a keep_count the newest keep_count snapshots are kept. With tiers, such as
+    {"day": 14, "week": 12, "month": 6}, the newest snapshot of each of the 14 most recent
+    days, 12 most recent weeks and 6 most recent months that have one is kept, a
+    snapshot wanted by any tier is kept, and everything else is deleted.
+    """
+
+    TIER_BUCKETS = {
+        'hour': lambda t: t.strftime('%Y-%m-%dT%H'),
+        'day': lambda t: t.strftime('%Y-%m-%d'),
+        'week': lambda t: '%04d-W%02d' % t.isocalendar()[:2],
+        'month': lambda t: t.strftime('%Y-%m'),
+        'year': lambda t: t.strftime('%Y'),
+    }
+
+    def __init__(self, keep_count=None, tiers=None):
+        for tier in tiers or {}:
+            if tier not in self.TIER_BUCKETS:
+                raise ValueError('Unknown retention tier %s, expected one of %s' % (
+                    tier, ', '.join(sorted(self.TIER_BUCKETS))))
+        if keep_count is None and not tiers:
+            raise ValueError('Either a keep_count or retention tiers are required')
+
+        self.keep_count = keep_count
+        self.tiers = tiers or {}
+
+    def __str__(self):
+        if not self.tiers:
+            return str(self.keep_count)
+        return ', '.join('%s %s' % (self.tiers[tier], tier) for tier in sorted(self.tiers))
+
+    def plan(self, snapshots, time_func, name_func):
+        """
+        :return: the snapshots to keep and the snapshots to delete, each oldest first
+        """
+        # Names break ties between snapshots taken at the same time, so the plan is deterministic
+        ordered = sorted(snapshots, key=lambda snap: (time_func(snap), name_func(snap)), reverse=True)
+
+        if not self.tiers:
+            keep, delete = ordered[:self.keep_count], ordered[self.keep_count:]
+        else:
+            keep, delete = [], []
+            buckets = dict((tier, set()) for tier in self.tiers)
+            for snap in ordered:
+                wanted = False
+                snap_time = time_func(snap)
+                for tier, count in self.tiers.items():
+                    bucket = self.TIER_BUCKETS[tier](snap_time)
+                    if bucket not in buckets[tier] and len(buckets[tier]) < count:
+                        buckets[tier].add(bucket)
+                        wanted = True
+                (keep if wanted else delete).append(snap)
+
+        keep.reverse()
+        delete.reverse()
+        return keep, delete
+
+
+def format_timestamp(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(UTC).replace(tzinfo=None)
+        return value.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def parse_timestamp(value):
+    # Split by hand rather than strptime, an inventory can hold hundreds of thousands of these
+    day, _, clock = value.rstrip('Z').split('+')[0].partition('T')
+    clock, _, fraction = clock.partition('.')
+    parts = [int(part) for part in day.split('-') + clock.split(':')]
+    return datetime(*parts, microsecond=int(fraction[:6].ljust(6, '0')), tzinfo=UTC)
+
+
+def dump_inventory(inventory, fp):
+    json.dump(inventory, fp, default=format_timestamp, sort_keys=True)
+
+
+def load_inventory(fp):
+    """
+    Read an inventory saved by dump_inventory, turning the snapshot times back into datetimes.
+    """
+    def parse_times(item):
+        for key in SNAPSHOT_TIME_KEYS:
+            if key in item:
+                item[key] = parse_timestamp(item[key])
+        return item
+
+    return json.load(fp, object_hook=parse_times)
+
+
+class MemoryStateStore(object):
+    """
+    Keeps run state in memory, which only carries over between invocations that land
+    on the same warm container. Meant for tests and local runs.
+    """
+
+    def __init__(self):
+        self.states = {}
+
+    def load(self, key):
+        state = self.states.get(key)
+        return json.loads(state) if state is not None else None
+
+    def save(self, key, state):
+        self.states[key] = json.dumps(state)
+
+    def delete(self, key):
+        self.states.pop(key, None)
+
+
+class FileStateStore(object):
+    """
+    Keeps run state as one JSON file per key in a local directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, key.replace('/', '_') + '.json')
+
+    def load(self, key):
+        if not os.path.exists(self.path(key)):
+            return None
+        with open(self.path(key)) as state_file:
+            return json.load(state_file)
+
+    def save(self, key, state):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # Write alongside and rename, so a reader never sees a half written file
+        temp_path = self.path(key) + '.tmp'
+        with open(temp_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.rename(temp_path, self.path(key))
+
+    def delete(self, key):
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+
+class S3StateStore(object):
+    """
+    Keeps run state as one JSON object per key in an S3 bucket.
+    """
+
+    def __init__(self, bucket, prefix=''):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    @property
+    def conn(self):
+        return get_client('s3')
+
+    def object_key(self, key):
+        return self.prefix + key + '.json'
+
+    def load(self, key):
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.conn.get_object(Bucket=self.bucket, Key=self.object_key(key))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return json.loads(response['Body'].read().decode('utf-8'))
+
+    def save(self, key, state):
+        self.conn.put_object(Bucket=self.bucket, Key=self.object_key(key), Body=json.dumps(state).encode('utf-8'))
+
+    def delete(self, key):
+        self.conn.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+
+# Only survives for as long as the container stays warm
+MEMORY_STATE_STORE = MemoryStateStore()
+
+
+def build_state_store(location):
+    """
+    Build the state store for a location of the form 's3://bucket/prefix/',
+    'file:///path/to/dir' (or just a path), falling back to memory when not given.
+    """
+    if not location or location == 'memory':
+        return MEMORY_STATE_STORE
+    if location.startswith('s3://'):
+        bucket, _, prefix = location[len('s3://'):].partition('/')
+        return S3StateStore(bucket, prefix)
+    if location.startswith('file://'):
+        location = location[len('file://'):]
+    return FileStateStore(location)
 
 
 class BaseBackupManager(object):
-    def __init__(self, period, tag_name, tag_value, date_suffix, keep_count):
+    service_name = None
+
+    # The snapshot fields delete_snapshot needs, all a cursor keeps of a snapshot left to delete
+    snapshot_reference_keys = ()
+
+    # The snapshot fields the tool reads, all a saved snapshot index keeps of each snapshot
+    snapshot_index_keys = ()
+
+    def __init__(self, period, tag_name, tag_value, date_suffix, keep_count, max_workers=1, rate_limiter=None,
+                 time_remaining=None, deadline_margin=30, page_size=None, role_arn=None, retention=None,
+                 plan_only=False, inventory=None, delete_workers=None, max_pending_snapshots=None, copy=None,
+                 shard_index=0, shard_count=1, copies_only=False):
 
         # Message to return result
         self.message = ""
@@ -22,192 +999,1336 @@ class BaseBackupManager(object):
         self.tag_value = tag_value
         self.date_suffix = date_suffix
         self.keep_count = keep_count
+        self.retention = retention
+
+        # Either the single period rotation of keep_count, or tiers across periods
+        self.retention_planner = RetentionPlanner(keep_count=keep_count, tiers=retention)
+
+        # With tiers the snapshots of the periods named after them are part of the one rotation,
+        # which lets a single schedule take over from separate daily and weekly ones
+        self.retention_periods = [period] + sorted(tier for tier in retention or {} if tier != period)
+
+        # Number of resources to process at once, 1 processes them one after another
+        self.max_workers = max_workers
+
+        # Number of expired snapshots to delete at once, once the snapshots are all taken
+        self.delete_workers = delete_workers or max_workers
+
+        # Page size for discovery listings, None leaves it to the API
+        self.page_size = page_size
+        self.lock = threading.Lock()
+
+        # Shared between managers, as the API rate limits apply to the whole account
+        self.rate_limiter = rate_limiter
+
+        # Role to assume for the run, None runs as the execution role
+        self.role_arn = role_arn
+
+        # API calls made by this manager's clients
+        self.api_stats = ApiCallStats()
+
+        # Callable giving the milliseconds left in the invocation, and how many
+        # seconds before the end to stop picking up new resources
+        self.time_remaining = time_remaining
+        self.deadline_margin = deadline_margin
+
+        # Work left over from an earlier invocation to limit this run to, and the
+        # work this run has left over when it stops early
+        self.resume_phases = None
+        self.cursor = None
+
+        # Listings saved by export_inventory to work from instead of the account, which
+        # only makes sense when planning
+        self.inventory = inventory
+
+        # Work out the creates and deletes without making them
+        self.plan_only = plan_only or inventory is not None
+
+        # The snapshots created and deleted by the last run, or that would have been when planning
+        self.changes = None
+
+        # Lazily populated on the first snapshot lookup of the run, unless restored from a saved index,
+        # along with when it was last listed in full, the runs since, and when this run listed or restored it
+        self.snapshot_index = None
+        self.index_watermark = None
+        self.index_runs = 0
+        self.index_loaded = None
+
+        # The report of the run in progress
+        self.report = None
+
+        # Copy the snapshots to a DR region and apply retention there too, e.g.
+        # {"region": "us-west-2", "max_in_flight": 5}, and the manager for that region
+        self.copy_settings = copy
+        self.replica_mgr = None
+
+        # Set on a DR region's manager, whose index only holds the copies made by the tool
+        self.copies_only = copies_only
+
+        # Most snapshots to have in progress at once, None leaves it to the API
+        self.max_pending_snapshots = max_pending_snapshots
+        self.pending_limiter = None
+
+        # The share of the resources this invocation backs up, when several split them between them
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+
+    def connect(self, service_name, region_name):
+        # Connect to AWS using the credentials provided above or in Environment vars or using IAM role.
+        print('Connecting to AWS')
+        if self.rate_limiter is not None:
+            client = get_client(service_name, region_name, self.role_arn, retries=CLIENT_RETRIES,
+                                slot=self.client_slot)
+            self.rate_limiter.attach(client)
+        else:
+            # Left to botocore's retries, as there is nothing else to retry the calls
+            client = get_client(service_name, region_name, self.role_arn, slot=self.client_slot)
+            ApiRateLimiter.detach(client)
+
+        # Attached after the rate limiter, so latencies leave out time spent waiting for a token
+        self.api_stats.attach(client)
+        return client
+
+    def lookup_period_prefix(self, period=None):
+        return period or self.period
+
+    @staticmethod
+    def tag_list_to_dict(tags):
+        resource_tags = {}
+        for tag in tags:
+            # Tags starting with 'aws:' are reserved for internal use
+            if not tag['Key'].startswith('aws:'):
+                resource_tags[tag['Key']] = tag['Value']
+        return resource_tags
+
+    @staticmethod
+    def tag_dict_to_list(tags):
+        return [{"Key": k, "Value": tags[k]} for k in sorted(tags)]
+
+    def bookkeeping_tags(self, source_id):
+        return {
+            PERIOD_TAG: self.period,
+            DATE_SUFFIX_TAG: self.date_suffix,
+            SOURCE_TAG: source_id,
+            SCHEDULE_TAG: self.schedule,
+        }
+
+    @property
+    def schedule(self):
+        return '%s=%s' % (self.tag_name, self.tag_value)
+
+    def build_snapshot_tags(self, resource, tags, extra=None):
+        """
+        The tags to apply to a new snapshot of the resource, all given with the create call.
+        """
+        resource_id = self.resolve_backupable_id(resource)
+        bookkeeping = self.bookkeeping_tags(resource_id)
+        bookkeeping.update(extra or {})
+
+        return self.fit_tags(resource_id, bookkeeping, tags)
+
+    def fit_tags(self, resource_id, bookkeeping, tags):
+        """
+        The bookkeeping tags followed by as many of the other tags as fit under the limit, the
+        rest are left off in key order, as a request over the limit is turned down.
+        """
+        keys = sorted(k for k in tags if k not in bookkeeping)
+        room = MAX_TAGS_PER_RESOURCE - len(bookkeeping)
+        if len(keys) > room:
+            print('Leaving %(count)s tags of %(resource_id)s off its snapshot, over the %(limit)s tag limit: '
+                  '%(keys)s' % {
+                      'count': len(keys) - room,
+                      'resource_id': resource_id,
+                      'limit': MAX_TAGS_PER_RESOURCE,
+                      'keys': ', '.join(keys[room:])
+                  })
+
+        resource_tags = dict((k, tags[k]) for k in keys[:room])
+        return self.tag_dict_to_list(bookkeeping) + self.tag_dict_to_list(resource_tags)
+
+    def resolve_snapshot_tags(self, snapshot):
+        return self.tag_list_to_dict(snapshot.get('Tags', []))
+
+    def snapshot_in_period(self, snapshot, periods=None):
+        periods = periods or [self.period]
+
+        period = self.resolve_snapshot_tags(snapshot).get(PERIOD_TAG)
+        if period is not None:
+            return period in periods
+
+        # Snapshots taken before the bookkeeping tags existed are matched on their name
+        name = self.resolve_snapshot_name(snapshot)
+        return any(name.startswith(self.lookup_period_prefix(p)) for p in periods)
+
+    def get_resource_tags(self, resource_id):
+        pass
+
+    def set_resource_tags(self, resource, tags):
+        pass
+
+    def pagination_config(self):
+        return {'PageSize': self.page_size} if self.page_size else {}
+
+    def list_pages(self, operation_name, result_key, **kwargs):
+        """
+        Page through a listing, or through the saved inventory when there is one.
+        """
+        if self.inventory is not None:
+            return iter([{result_key: self.inventory.get(result_key, [])}])
+
+        paginator = self.conn.get_paginator(operation_name)
+        return prefetch(paginator.paginate(**kwargs))
+
+    def get_backable_resources(self):
+        """
+        Yield the resources to back up, paging through the listing as it goes.
+        """
+        pass
+
+    def group_resources(self, resources):
+        """
+        Arrange the resources into the items process_resource takes, one resource each by default.
+        """
+        return resources
+
+    def shard_key(self, item):
+        """
+        :return: the id a work item is assigned to a shard by
+        """
+        return self.resolve_backupable_id(item)
+
+    def in_shard(self, key):
+        return self.shard_count <= 1 or shard_of(key, self.shard_count) == self.shard_index
+
+    def work_item_ids(self, item):
+        """
+        :return: the ids of the resources a work item covers, as a cursor records them
+        """
+        return [self.resolve_backupable_id(item)]
+
+    def snapshot_resource(self, resource, description, tags):
+        """
+        :return: the new snapshot
+        """
+        pass
+
+    def planned_snapshot(self, resource, description, tags):
+        """
+        :return: the snapshot snapshot_resource would create, for planning retention without it
+        """
+        pass
+
+    def iter_snapshots(self):
+        """
+        Yield every snapshot in the region, paging through the listings as it goes.
+        """
+        pass
+
+    def new_snapshot_index(self):
+        if self.copies_only:
+            # Copies are filed under the resource they were taken of, which is only in their tags
+            return SnapshotIndex(key_func=lambda snap: self.resolve_snapshot_tags(snap).get(SOURCE_TAG),
+                                 id_func=self.resolve_snapshot_id)
+        return SnapshotIndex(key_func=self.resolve_backupable_id, id_func=self.resolve_snapshot_id)
+
+    def build_snapshot_index(self):
+        index = self.new_snapshot_index()
+        self.index_watermark = self.index_loaded = datetime.now(UTC)
+        self.index_runs = 0
+
+        if self.copies_only:
+            index.extend(snap for snap in self.iter_snapshots() if COPY_OF_TAG in self.resolve_snapshot_tags(snap))
+        else:
+            index.extend(self.iter_snapshots())
+
+        print('Indexed %(count)s snapshots' % {'count': len(index)})
+        return index
+
+    def snapshot_index_state(self, index):
+        """
+        The index as it is saved between runs, a row of snapshot_index_keys for each snapshot, with
+        times in epoch milliseconds and tags as key and value pairs to keep it small and quick to read.
+        """
+        rows = []
+        for snapshot in index:
+            row = []
+            for key in self.snapshot_index_keys:
+                value = snapshot.get(key)
+                if value is not None and key in SNAPSHOT_TIME_KEYS:
+                    value = calendar.timegm(value.utctimetuple()) * 1000 + value.microsecond // 1000
+                elif value is not None and key in TAG_LIST_KEYS:
+                    value = [[tag['Key'], tag['Value']] for tag in value]
+                row.append(value)
+            rows.append(row)
+
+        return {
+            'keys': list(self.snapshot_index_keys),
+            'watermark': format_timestamp(self.index_watermark),
+            'runs': self.index_runs,
+            'saved': format_timestamp(datetime.now(UTC)),
+            'snapshots': rows,
+        }
+
+    def restore_snapshot_index(self, state):
+        index = self.new_snapshot_index()
+        epoch = datetime(1970, 1, 1, tzinfo=UTC)
+
+        def restore(row):
+            snapshot = {}
+            for key, value in zip(state['keys'], row):
+                if value is None:
+                    continue
+                if key in SNAPSHOT_TIME_KEYS:
+                    value = epoch + timedelta(milliseconds=value)
+                elif key in TAG_LIST_KEYS:
+                    value = [{'Key': tag_key, 'Value': tag_value} for tag_key, tag_value in value]
+                snapshot[key] = value
+            return snapshot
+
+        index.extend(restore(row) for row in state['snapshots'])
+        return index
+
+    def refresh_snapshot_index(self, index):
+        """
+        Bring an index restored from an earlier run up to date with the snapshots that were in progress
+        then, the only ones whose state still changes, dropping any that are no longer there.
+
+        :return: the number of snapshots refreshed
+        """
+        in_progress = [snap for snap in index if self.snapshot_in_progress(snap)]
+        current = dict((self.resolve_snapshot_id(snap), snap) for snap in self.describe_snapshots_by_id(in_progress))
+
+        for snapshot in in_progress:
+            if self.resolve_snapshot_id(snapshot) in current:
+                index.add(current[self.resolve_snapshot_id(snapshot)])
+            else:
+                index.discard(snapshot)
+        return len(in_progress)
+
+    def get_snapshot_index(self):
+        # Workers share the one index, only the first to get here builds it
+        with self.lock:
+            if self.snapshot_index is None:
+                self.snapshot_index = self.build_snapshot_index()
+        return self.snapshot_index
+
+    def list_snapshots_for_resource(self, resource):
+        return self.get_snapshot_index().get(self.resolve_backupable_id(resource))
+
+    def snapshot_in_progress(self, snapshot):
+        pass
+
+    def snapshot_completed(self, snapshot):
+        pass
+
+    def describe_snapshots_by_id(self, snapshots):
+        """
+        :return: the snapshots as they are now, leaving out any that are gone
+        """
+        pass
+
+    def refresh_in_progress(self, snapshots):
+        """
+        :return: the snapshots that are still in progress
+        """
+        return [snap for snap in self.describe_snapshots_by_id(snapshots) if self.snapshot_in_progress(snap)]
+
+    def check_not_in_progress(self, resource):
+        """
+        Raise SnapshotDeferred when an earlier snapshot of the resource is still being taken,
+        another create would only be turned down.
+        """
+        for snapshot in self.list_snapshots_for_resource(resource):
+            if self.snapshot_in_progress(snapshot):
+                raise SnapshotDeferred('snapshot %s still in progress' % self.resolve_snapshot_name(snapshot))
+
+    def get_pending_limiter(self):
+        snapshot_index = self.get_snapshot_index()
+        with self.lock:
+            if self.pending_limiter is None and self.max_pending_snapshots:
+                in_progress = [snap for snap in snapshot_index if self.snapshot_in_progress(snap)]
+                self.pending_limiter = PendingSnapshotLimiter(self.max_pending_snapshots, in_progress,
+                                                              self.refresh_in_progress)
+        return self.pending_limiter
+
+    def create_when_ready(self, create, count=1, started=lambda snapshot: [snapshot]):
+        """
+        Call create once there is room for count more snapshots in progress.
+
+        :return: the result of create
+        """
+        from botocore.exceptions import ClientError
+
+        limiter = self.get_pending_limiter()
+        if limiter is not None and not limiter.acquire(count, self.out_of_time):
+            raise OutOfTime('out of time waiting for %s snapshots in progress' % self.max_pending_snapshots)
+
+        result = None
+        try:
+            result = create()
+            return result
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in SNAPSHOT_BUSY_ERROR_CODES:
+                raise SnapshotDeferred(e.response['Error']['Code'])
+            raise
+        finally:
+            if limiter is not None:
+                limiter.release(count, started(result) if result is not None else [])
+
+    def export_inventory(self):
+        """
+        :return: the listings a plan works from, for load_inventory to read back later
+        """
+        pass
+
+    def resolve_backupable_id(self, resource):
+        pass
+
+    def resolve_snapshot_id(self, resource):
+        return self.resolve_snapshot_name(resource)
+
+    def resolve_snapshot_name(self, resource):
+        pass
+
+    def resolve_snapshot_time(self, resource):
+        return resource['StartTime']
+
+    @property
+    def state_prefix(self):
+        prefix = '%(service)s/%(region)s' % {
+            'service': self.service_name,
+            'region': self.conn.meta.region_name
+        }
+
+        # Each account assumed into keeps its cursors apart, under its account id
+        if self.role_arn is not None:
+            prefix = self.role_arn.split(':')[4] + '/' + prefix
+        return prefix
+
+    @property
+    def shard_suffix(self):
+        # Each shard keeps its own state, it does not share any work with the others
+        if self.shard_count <= 1:
+            return ''
+        return '/shard-%d-of-%d' % (self.shard_index, self.shard_count)
+
+    @property
+    def client_slot(self):
+        # Shards run in the one process and a DR region's manager run alongside its source region's
+        # each get clients of their own, so their call stats and rate limits stay apart
+        return self.shard_suffix + ('/copies' if self.copies_only else '') or None
+
+    @property
+    def state_key(self):
+        return self.state_prefix + '/' + self.period + self.shard_suffix
+
+    @property
+    def sweep_state_key(self):
+        return self.state_prefix + '/sweep' + self.shard_suffix
+
+    @property
+    def index_state_key(self):
+        # Shared by every schedule in the region, which all see each other's snapshots
+        return self.state_prefix + '/snapshot-index' + self.shard_suffix
+
+    def out_of_time(self):
+        if self.time_remaining is None:
+            return False
+        return self.time_remaining() < self.deadline_margin * 1000
+
+    def resume_from(self, cursor):
+        """
+        Limit the run to the work left in the cursor saved by an earlier invocation.
+        """
+        self.date_suffix = cursor['date_suffix']
+        self.resume_phases = cursor['phases']
+
+    def defer(self, phase, pending):
+        """
+        Leave the pending work of a phase to the next invocation.
+        """
+        if self.cursor is None:
+            self.cursor = {
+                'period': self.period,
+                'date_suffix': self.date_suffix,
+                'phases': {}
+            }
+        self.cursor['phases'][phase] = pending
+
+    def snapshot_reference(self, snapshot):
+        reference = dict((key, snapshot[key]) for key in self.snapshot_reference_keys if key in snapshot)
+        for key in SNAPSHOT_TIME_KEYS:
+            if key in snapshot:
+                reference[key] = format_timestamp(snapshot[key])
+        return reference
+
+    @staticmethod
+    def snapshot_from_reference(reference):
+        snapshot = dict(reference)
+        for key in SNAPSHOT_TIME_KEYS:
+            if key in snapshot:
+                snapshot[key] = parse_timestamp(snapshot[key])
+        return snapshot
+
+    def until_deadline(self, items, phase='backup', references=None):
+        """
+        Yield items until the invocation is about to run out of time, then record
+        what is left in the cursor instead, as the list references gives for each item.
+        """
+        references = references or self.work_item_ids
+
+        iterator = iter(items)
+        for item in iterator:
+            if self.out_of_time():
+                pending = list(references(item))
+                for left in iterator:
+                    pending.extend(references(left))
+
+                print('Running out of time, stopping the %(phase)s phase with %(count)s left' % {
+                    'phase': phase,
+                    'count': len(pending)
+                })
+                self.defer(phase, pending)
+                return
+            yield item
+
+    def process_backup(self):
+        # Setup logging
+        start_message = 'Started taking %(period)s snapshots at %(date)s' % {
+            'period': self.period,
+            'date': datetime.today().strftime('%d-%m-%Y %H:%M:%S')
+        }
+        self.report = RunReport(service=self.service_name, period=self.period)
+        self.report.add(start_message + "\n\n")
+        errors = []
+
+        # Counters, shared with the worker threads when running concurrently
+        metrics = BackupMetrics()
+
+        expired = []
+        deferred = []
+        skipped = []
+        kept = []
+        unstarted = []
+        if self.resume_phases is None:
+            backupables = self.get_backable_resources()
+        elif 'backup' in self.resume_phases:
+            pending = set(self.resume_phases['backup'])
+            backupables = (item for item in self.get_backable_resources()
+                           if self.resolve_backupable_id(item) in pending)
+        else:
+            backupables = []
+        if self.resume_phases is not None:
+            expired.extend(self.snapshot_from_reference(ref) for ref in self.resume_phases.get('delete', []))
+
+        self.cursor = None
+        self.changes = {'creates': [], 'deletes': []}
+        backupables = (item for item in self.group_resources(backupables) if self.in_shard(self.shard_key(item)))
+        backupables = self.until_deadline(backupables)
+        for section, errmsg, changes in self.map_resources(lambda item: self.process_resource(item, metrics),
+                                                           backupables):
+            self.report.add(section)
+            if errmsg:
+                errors.append(errmsg)
+                self.report.record('error', message=errmsg)
+            for create in changes['creates']:
+                self.report.record('create', **create)
+            for resource_id in changes['deferred']:
+                self.report.record('deferred', resource_id=resource_id)
+            for resource_id, reason in changes['skipped']:
+                self.report.record('skipped', resource_id=resource_id, reason=reason)
+            self.changes['creates'].extend(changes['creates'])
+            expired.extend(changes['expired'])
+            deferred.extend(changes['deferred'])
+            skipped.extend(resource_id for resource_id, reason in changes['skipped'])
+            kept.extend(changes['kept'])
+            unstarted.extend(changes['unstarted'])
+
+        # Resources whose turn came too late to start a snapshot go back in the cursor,
+        # along with any that were never reached
+        if unstarted:
+            self.defer('backup', unstarted + (self.cursor['phases'].get('backup', []) if self.cursor else []))
+
+        # Deletes run as a stage of their own once every snapshot is taken, so a backlog of
+        # expired snapshots never holds up the next resource's backup
+        errors.append(self.expire(expired, metrics))
+
+        # Copies follow once the account's own snapshots are seen to, a run that stopped early
+        # leaves them to the next run, which finds the same snapshots still without a copy
+        if self.copy_settings and self.cursor is None and self.inventory is None:
+            errors.append(self.copy_stage(kept, metrics))
+
+        # The closing lines always make it into the report, whatever detail is left out
+        sections = []
+        if deferred:
+            sections.append('\nDeferred %(count)s resources with snapshots still in progress: %(ids)s\n' % {
+                'count': len(deferred),
+                'ids': summarise_ids(deferred)
+            })
+        if skipped:
+            sections.append('\nSkipped %(count)s resources, the reasons are in the report: %(ids)s\n' % {
+                'count': len(skipped),
+                'ids': summarise_ids(skipped)
+            })
+
+        unprocessed = len(self.cursor['phases'].get('backup', [])) if self.cursor else 0
+        if unprocessed:
+            sections.append('\nStopped before the deadline with %(count)s resources left for the next invocation\n' % {
+                'count': unprocessed
+            })
+
+        if self.plan_only:
+            sections.append('\nPlan only, no snapshots were created or deleted\n')
+
+        result = '\nFinished making snapshots at %(date)s with %(count_success)s snapshots of %(count_total)s possible.\n\n' % {
+            'date': datetime.today().strftime('%d-%m-%Y %H:%M:%S'),
+            'count_success': metrics['success'],
+            'count_total': metrics['total']
+        }
+
+        sections.append(result)
+        sections.append("\nTotal snapshots created: " + str(metrics['creates']))
+        sections.append("\nTotal snapshots errors: " + str(metrics['errors']))
+        sections.append("\nTotal snapshots deferred: " + str(metrics['deferred']))
+        sections.append("\nTotal snapshots skipped: " + str(metrics['skipped']))
+        sections.append("\nTotal snapshots deleted: " + str(metrics['deletes']))
+        sections.append("\nTotal snapshot delete errors: " + str(metrics['delete_errors']) + "\n")
+        if self.copy_settings:
+            sections.append("\nTotal snapshots copied to " + self.copy_settings['region'] + ": " +
+                            str(metrics['copies']))
+            sections.append("\nTotal snapshot copy errors: " + str(metrics['copy_errors']))
+            sections.append("\nTotal snapshots waiting to be copied: " + str(metrics['copies_waiting']))
+            sections.append("\nTotal copies deleted: " + str(metrics['copy_deletes']) + "\n")
+
+        closing = ''.join(sections)
+        print(closing)
+        self.message = self.report.render(closing)
+        self.errmsg += ''.join(errors)
+
+        api_stats = [self.api_stats]
+        if self.replica_mgr is not None:
+            api_stats.append(self.replica_mgr.api_stats)
+        api_calls = sum(stats.total_calls() for stats in api_stats)
+
+        return {
+            "total_resources": metrics['total'],
+            "total_creates": metrics['creates'],
+            "total_errors": metrics['errors'],
+            "total_deferred": metrics['deferred'],
+            "total_skipped": metrics['skipped'],
+            "total_deletes": metrics['deletes'],
+            "total_delete_errors": metrics['delete_errors'],
+            "total_pending_deletes": len(self.cursor['phases'].get('delete', [])) if self.cursor else 0,
+            "total_unprocessed": unprocessed,
+            "total_copies": metrics['copies'],
+            "total_copy_errors": metrics['copy_errors'],
+            "total_copies_waiting": metrics['copies_waiting'],
+            "total_copy_deletes": metrics['copy_deletes'],
+            "total_api_calls": api_calls,
+            "api_calls_per_resource": round(float(api_calls) / metrics['total'], 2) if metrics['total'] else 0,
+            "api_calls": merge_stats([stats.summary() for stats in api_stats]),
+            "phase_timings": metrics.timing_summary(),
+        }
+
+    def emit_metrics(self, metrics):
+        """
+        Print the run's metrics as CloudWatch Embedded Metric Format log lines.
+        """
+        count_units = dict((name, 'Count') for name in ('Resources', 'Creates', 'Deletes', 'Errors', 'DeleteErrors',
+                                                        'Deferred', 'ApiCalls', 'ApiCallsPerResource'))
+        print_emf({'Service': self.service_name, 'Period': self.period}, {
+            'Resources': metrics['total_resources'],
+            'Creates': metrics['total_creates'],
+            'Deletes': metrics['total_deletes'],
+            'Errors': metrics['total_errors'],
+            'DeleteErrors': metrics['total_delete_errors'],
+            'Deferred': metrics['total_deferred'],
+            'ApiCalls': metrics['total_api_calls'],
+            'ApiCallsPerResource': metrics['api_calls_per_resource'],
+        }, count_units)
+
+        latency_units = {'Calls': 'Count', 'Retries': 'Count', 'Throttles': 'Count',
+                         'LatencyP50': 'Milliseconds', 'LatencyP95': 'Milliseconds', 'LatencyMax': 'Milliseconds'}
+        for operation, stats in sorted(metrics['api_calls'].items()):
+            print_emf({'Operation': operation}, {
+                'Calls': stats['calls'],
+                'Retries': stats['retries'],
+                'Throttles': stats['throttles'],
+                'LatencyP50': stats['p50_ms'],
+                'LatencyP95': stats['p95_ms'],
+                'LatencyMax': stats['max_ms'],
+            }, latency_units)
+
+        for phase, stats in sorted(metrics['phase_timings'].items()):
+            print_emf({'Service': self.service_name, 'Phase': phase}, {
+                'LatencyP50': stats['p50_ms'],
+                'LatencyP95': stats['p95_ms'],
+                'LatencyMax': stats['max_ms'],
+            }, latency_units)
+
+    def map_resources(self, func, resources, max_workers=None):
+        """
+        Apply func to each resource and yield the results in the order the resources
+        were given, using a bounded pool of worker threads when max_workers > 1.
+        """
+        max_workers = max_workers or self.max_workers
+        if max_workers <= 1:
+            for resource in resources:
+                yield func(resource)
+            return
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            # Only keep a couple of resources queued per worker, so results can be
+            # handed back in order without holding every future in memory
+            pending = deque()
+            for resource in resources:
+                pending.append(executor.submit(func, resource))
+                if len(pending) >= max_workers * 2:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            executor.shutdown(wait=True)
+
+    def change_record(self, snapshot):
+        return {
+            'region': self.conn.meta.region_name,
+            'role_arn': self.role_arn,
+            'resource_id': self.resolve_backupable_id(snapshot),
+            'snapshot_id': self.resolve_snapshot_id(snapshot),
+            'snapshot_name': self.resolve_snapshot_name(snapshot),
+            'snapshot_time': format_timestamp(self.resolve_snapshot_time(snapshot)),
+        }
+
+    def process_resource(self, backup_item, metrics):
+        """
+        Snapshot a single resource and rotate its old snapshots.
+
+        :return: the report section for the resource, any error message, and the snapshots
+                 created and expired, the expired ones are left for delete_expired
+        """
+        message = ''
+        errmsg = ''
+        changes = {'creates': [], 'expired': [], 'deferred': [], 'skipped': [], 'kept': [], 'unstarted': []}
+        new_snapshot = None
+        deferred = False
+        skipped = False
+        refused = None
+
+        backup_id = self.resolve_backupable_id(backup_item)
+        timer = PhaseTimer()
+
+        message += 'Processing backup item %(id)s\n' % {
+            'id': backup_id
+        }
+
+        try:
+            with timer.phase('tag'):
+                tags_volume = self.get_resource_tags(backup_item)
+            description = self.snapshot_description(backup_id)
+            try:
+                self.check_not_in_progress(backup_item)
+                if self.plan_only:
+                    new_snapshot = self.planned_snapshot(resource=backup_item, description=description,
+                                                         tags=tags_volume)
+                    message += '    New Snapshot planned with description: %s and tags: %s\n' % (
+                        description, str(tags_volume))
+                else:
+                    with timer.phase('create'):
+                        new_snapshot = self.create_when_ready(lambda: self.snapshot_resource(
+                            resource=backup_item, description=description, tags=tags_volume))
+                    message += '    New Snapshot created with description: %s and tags: %s\n' % (
+                        description, str(tags_volume))
+                changes['creates'].append(self.change_record(new_snapshot))
+                metrics.increment('creates')
+            except OutOfTime as e:
+                message += '    Left for the next invocation: %s\n' % e
+                changes['unstarted'].append(backup_id)
+                return message, errmsg, changes
+            except SnapshotDeferred as e:
+                message += '    Deferred to a later run: %s\n' % e
+                changes['deferred'].append(backup_id)
+                deferred = True
+            except SnapshotSkipped as e:
+                message += '    Skipped: %s\n' % e
+                changes['skipped'].append((backup_id, str(e)))
+                skipped = True
+            except SnapshotRefused as e:
+                message += '    Not snapshot: %s\n' % e
+                refused = e
+            except Exception as e:
+                print("Unexpected error:", sys.exc_info()[0])
+                print(e)
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                          limit=2, file=sys.stdout)
+                pass
+
+            section, keeplist, deletelist = self.rotate_snapshots(backup_item, new_snapshot, timer)
+            message += section
+            changes['expired'].extend(deletelist)
+            if self.copy_settings:
+                changes['kept'].extend(keeplist)
+        except Exception as ex:
+            print("Unexpected error:", sys.exc_info()[0])
+            print(ex)
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                      limit=2, file=sys.stdout)
+            metrics.increment('total')
+            logging.error('Error in processing volume with id: ' + backup_id)
+            errmsg += 'Error in processing volume with id: ' + backup_id
+            metrics.increment('errors')
+        else:
+            metrics.increment('total')
+            if refused is not None:
+                # Retention still ran, but the resource goes without a snapshot until it is seen to
+                logging.error('Error in snapshotting %s: %s' % (backup_id, refused))
+                errmsg += 'Error in snapshotting %s: %s' % (backup_id, refused)
+                metrics.increment('errors')
+            elif skipped:
+                metrics.increment('skipped')
+            else:
+                metrics.increment('deferred' if deferred else 'success')
+
+        metrics.record_timings(timer)
+        message += '    Timings: %s\n' % timer
+
+        return message, errmsg, changes
+
+    def snapshot_description(self, item_id):
+        return '%(period)s_snapshot %(item_id)s_%(period)s_%(date_suffix)s by snapshot script at %(date)s' % {
+            'period': self.period,
+            'item_id': item_id,
+            'date_suffix': self.date_suffix,
+            'date': datetime.today().strftime('%d-%m-%Y %H:%M:%S')
+        }
+
+    def rotate_snapshots(self, backup_item, new_snapshot, timer):
+        """
+        Work out which of the resource's snapshots retention keeps, counting the one just taken.
+
+        :return: the report section for the rotation, and the snapshots kept and expired
+        """
+        message = ''
+
+        with timer.phase('list'):
+            snapshots = self.list_snapshots_for_resource(resource=backup_item)
+        if self.plan_only and new_snapshot is not None:
+            # Never taken, so not listed, but retention has to count it all the same
+            snapshots.append(new_snapshot)
+        rotation = []
+
+        for snap in snapshots:
+            if self.snapshot_in_period(snap, self.retention_periods):
+                rotation.append(snap)
+            else:
+                print('  Skipping other backup schedule: ' + self.resolve_snapshot_name(snap))
+
+        keeplist, deletelist = self.retention_planner.plan(rotation, self.resolve_snapshot_time,
+                                                           self.resolve_snapshot_name)
 
-    def lookup_period_prefix(self):
-        return self.period
+        # Every snapshot in rotation only goes to the logs, the report just counts them
+        for snap in sorted(keeplist + deletelist, key=self.resolve_snapshot_time):
+            print('    In rotation: {0} - {1}'.format(self.resolve_snapshot_name(snap),
+                                                    self.resolve_snapshot_time(snap)))
 
-    def get_resource_tags(self, resource_id):
-        pass
+        message += "\n    {0} backups in rotation (keeping {1})\n".format(len(rotation), self.retention_planner)
 
-    def set_resource_tags(self, resource, tags):
-        pass
+        for snap in deletelist:
+            message += '    Expiring snapshot ' + self.resolve_snapshot_name(snap) + '\n'
 
-    def get_backable_resources(self):
-        pass
+        return message, keeplist, deletelist
 
-    def snapshot_resource(self, resource, description, tags):
-        pass
+    def expire(self, expired, metrics):
+        """
+        Delete the expired snapshots, or only record them when planning, or leave them all to
+        the next invocation when the run already stopped early.
 
-    def list_snapshots_for_resource(self, resource):
-        pass
+        :return: any error message
+        """
+        if self.plan_only:
+            self.changes['deletes'] = [self.change_record(snap) for snap in expired]
+            metrics.increment('deletes', len(expired))
+            return ''
 
-    def resolve_backupable_id(self, resource):
-        pass
+        if self.cursor is not None:
+            self.defer('delete', [self.snapshot_reference(snap) for snap in expired])
+            return ''
 
-    def resolve_snapshot_name(self, resource):
-        pass
+        if not expired:
+            return ''
 
-    def resolve_snapshot_time(self, resource):
-        return resource['StartTime']
+        self.report.add('\nDeleting %(count)s expired snapshots\n' % {'count': len(expired)})
+        return self.delete_expired(expired, metrics)
 
-    def process_backup(self):
-        # Setup logging
-        start_message = 'Started taking %(period)s snapshots at %(date)s' % {
-            'period': self.period,
-            'date': datetime.today().strftime('%d-%m-%Y %H:%M:%S')
-        }
-        self.message = start_message + "\n\n"
-        print(start_message)
+    def replica(self, region_name):
+        """
+        :return: a manager of the same service in the region, to keep the copies with
+        """
+        pass
 
-        # Counters
-        total_creates = 0
-        total_deletes = 0
-        count_errors = 0
+    def replica_settings(self):
+        """
+        The settings for the DR region's manager, which keeps the copies with a retention of
+        its own when the copy settings give one.
+        """
+        if 'keep_count' in self.copy_settings or 'retention' in self.copy_settings:
+            keep_count, retention = self.copy_settings.get('keep_count'), self.copy_settings.get('retention')
+        else:
+            keep_count, retention = self.keep_count, self.retention
+
+        # The API rate limits of the DR region are its own
+        rate_limiter = None
+        if self.rate_limiter is not None:
+            rate_limiter = ApiRateLimiter(rates=self.rate_limiter.rates, max_attempts=self.rate_limiter.max_attempts)
+
+        return dict(period=self.period,
+                    tag_name=self.tag_name,
+                    tag_value=self.tag_value,
+                    date_suffix=self.date_suffix,
+                    keep_count=keep_count,
+                    retention=retention,
+                    max_workers=self.max_workers,
+                    delete_workers=self.delete_workers,
+                    rate_limiter=rate_limiter,
+                    time_remaining=self.time_remaining,
+                    deadline_margin=self.deadline_margin,
+                    page_size=self.page_size,
+                    role_arn=self.role_arn,
+                    plan_only=self.plan_only,
+                    copies_only=True)
+
+    def get_replica(self):
+        with self.lock:
+            if self.replica_mgr is None:
+                self.replica_mgr = self.replica(self.copy_settings['region'])
+        return self.replica_mgr
+
+    def copy_tags(self, snapshot):
+        """
+        The tags for the DR copy of a snapshot, its own along with the snapshot copied and when
+        it was taken, as a copy's own time is when the copy was started.
+        """
+        tags = self.resolve_snapshot_tags(snapshot)
+        bookkeeping = dict((key, tags[key]) for key in (PERIOD_TAG, DATE_SUFFIX_TAG, SCHEDULE_TAG) if key in tags)
+        bookkeeping.update({
+            COPY_OF_TAG: self.resolve_snapshot_id(snapshot),
+            SOURCE_TAG: self.resolve_backupable_id(snapshot),
+            SOURCE_TIME_TAG: format_timestamp(self.resolve_snapshot_time(snapshot)),
+        })
 
-        # Number of snapshots to keep
-        count_success = 0
-        count_total = 0
+        return self.fit_tags(self.resolve_snapshot_id(snapshot), bookkeeping, tags)
 
-        backupables = self.get_backable_resources()
-        for backup_item in backupables:
+    def copy_snapshot_from(self, snapshot, source_region, tags, kms_key_id=None):
+        """
+        Start a copy of a snapshot in another region into this one.
 
-            count_total += 1
-            backup_id = self.resolve_backupable_id(backup_item)
+        :return: the copy
+        """
+        pass
 
-            self.message += 'Processing backup item %(id)s\n' % {
-                'id': backup_id
-            }
+    def resolve_copy_time(self, snapshot):
+        source_time = self.resolve_snapshot_tags(snapshot).get(SOURCE_TIME_TAG)
+        if source_time is None:
+            return self.resolve_snapshot_time(snapshot)
+        return parse_timestamp(source_time)
+
+    def copy_stage(self, kept, metrics):
+        """
+        Copy the kept snapshots that have no copy in the DR region yet and that retention there would
+        keep, newest first and with no more than max_in_flight copies in progress there at once, then
+        apply retention to the copies.
+        Whatever does not fit is left for the next run, which finds the same snapshots still without
+        a copy.
+
+        :return: any error message
+        """
+        replica = self.get_replica()
+        copy_index = replica.get_snapshot_index()
+        source_region = self.conn.meta.region_name
+        errors = []
+
+        copied = set()
+        in_flight = 0
+        for replica_snapshot in copy_index:
+            copied.add(replica.resolve_snapshot_tags(replica_snapshot)[COPY_OF_TAG])
+            if replica.snapshot_in_progress(replica_snapshot):
+                in_flight += 1
+
+        uncopied = {}
+        for snap in kept:
+            if self.snapshot_completed(snap) and self.resolve_snapshot_id(snap) not in copied:
+                uncopied.setdefault(self.resolve_backupable_id(snap), []).append(snap)
+
+        # Only copy what retention in the DR region would keep, planned over the copies already there along
+        # with the snapshots still without one, anything else would be deleted there as soon as it was copied.
+        # A snapshot without a copy is dated by its own time, as its copy would be
+        candidates = []
+        for resource_id in sorted(uncopied):
+            rotation = [snap for snap in copy_index.get(resource_id) + uncopied[resource_id]
+                        if replica.snapshot_in_period(snap, replica.retention_periods)]
+            keeplist, deletelist = replica.retention_planner.plan(rotation, replica.resolve_copy_time,
+                                                                  replica.resolve_snapshot_name)
+            dropped = set(id(snap) for snap in deletelist)
+            candidates.extend(snap for snap in uncopied[resource_id] if id(snap) not in dropped)
+        candidates.sort(key=self.resolve_snapshot_time, reverse=True)
+        room = max(0, self.copy_settings.get('max_in_flight', DEFAULT_COPIES_IN_FLIGHT) - in_flight)
+
+        self.report.add('\nCopying snapshots to %(region)s, %(count)s to keep there without a copy and %(in_flight)s '
+                        'copies already in progress\n' % {
+                            'region': replica.conn.meta.region_name,
+                            'count': len(candidates),
+                            'in_flight': in_flight
+                        })
+
+        self.changes['copies'] = []
+        started = 0
+        for snapshot in candidates[:room]:
+            if self.out_of_time():
+                break
+            started += 1
+
+            name = self.resolve_snapshot_name(snapshot)
+            record = self.change_record(snapshot)
+            if self.plan_only:
+                self.changes['copies'].append(record)
+                metrics.increment('copies')
+                continue
 
             try:
-                tags_volume = self.get_resource_tags(backup_item)
-                description = '%(period)s_snapshot %(item_id)s_%(period)s_%(date_suffix)s by snapshot script at %(date)s' % {
-                    'period': self.period,
-                    'item_id': backup_id,
-                    'date_suffix': self.date_suffix,
-                    'date': datetime.today().strftime('%d-%m-%Y %H:%M:%S')
-                }
-                try:
-                    self.snapshot_resource(resource=backup_item, description=description, tags=tags_volume)
-                    self.message += '    New Snapshot created with description: %s and tags: %s\n' % (
-                        description, str(tags_volume))
-                    total_creates += 1
-                except Exception as e:
-                    print("Unexpected error:", sys.exc_info()[0])
-                    print(e)
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    traceback.print_exception(exc_type, exc_value, exc_traceback,
-                                              limit=2, file=sys.stdout)
-                    pass
-
-                snapshots = self.list_snapshots_for_resource(resource=backup_item)
-                deletelist = []
-
-                # Sort the list based on the dates of the objects
-                snapshots.sort(self.date_compare)
-
-                for snap in snapshots:
-                    sndesc = self.resolve_snapshot_name(snap)
-                    if sndesc.startswith(self.lookup_period_prefix()):
-                        deletelist.append(snap)
-                    else:
-                        print('  Skipping other backup schedule: ' + sndesc)
-
-                self.message += "\n    Current backups in rotation (keeping {0})\n".format(self.keep_count)
-                self.message += "    ---------------------------\n"
-
-                for snap in deletelist:
-                    self.message += "    {0} - {1}\n".format(self.resolve_snapshot_name(snap),
-                                                             self.resolve_snapshot_time(snap))
-                self.message += "    ---------------------------\n"
-
-                deletelist.sort(self.date_compare)
-                delta = len(deletelist) - self.keep_count
-
-                for i in range(delta):
-                    self.message += '    Deleting snapshot ' + self.resolve_snapshot_name(deletelist[i]) + '\n'
-                    self.delete_snapshot(deletelist[i])
-                    total_deletes += 1
-                    # time.sleep(3)
+                replica_snapshot = replica.copy_snapshot_from(snapshot, source_region, self.copy_tags(snapshot),
+                                                              kms_key_id=self.copy_settings.get('kms_key_id'))
             except Exception as ex:
-                print("Unexpected error:", sys.exc_info()[0])
-                print(ex)
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                traceback.print_exception(exc_type, exc_value, exc_traceback,
-                                          limit=2, file=sys.stdout)
-                logging.error('Error in processing volume with id: ' + backup_id)
-                self.errmsg += 'Error in processing volume with id: ' + backup_id
-                count_errors += 1
-            else:
-                count_success += 1
-
-        result = '\nFinished making snapshots at %(date)s with %(count_success)s snapshots of %(count_total)s possible.\n\n' % {
-            'date': datetime.today().strftime('%d-%m-%Y %H:%M:%S'),
-            'count_success': count_success,
-            'count_total': count_total
+                print('Unable to copy snapshot %s: %s' % (name, ex))
+                metrics.increment('copy_errors')
+                self.report.add('    Failed to copy snapshot %s: %s\n' % (name, ex))
+                self.report.record('copy_error', error=str(ex), **record)
+                errors.append('Error copying snapshot %s: %s\n' % (name, ex))
+                continue
+
+            copy_index.add(replica_snapshot)
+            metrics.increment('copies')
+            self.report.add('    Copying snapshot %s as %s\n' % (name, replica.resolve_snapshot_id(replica_snapshot)))
+            self.report.record('copy', copy_id=replica.resolve_snapshot_id(replica_snapshot), **record)
+            self.changes['copies'].append(record)
+        metrics.increment('copies_waiting', len(candidates) - started)
+
+        # Retention in the DR region works from its own listing, with the copies dated by their source
+        expired = []
+        for resource_id in sorted(set(self.resolve_backupable_id(snap) for snap in kept)):
+            rotation = [snap for snap in copy_index.get(resource_id)
+                        if replica.snapshot_in_period(snap, replica.retention_periods)]
+            keeplist, deletelist = replica.retention_planner.plan(rotation, replica.resolve_copy_time,
+                                                                  replica.resolve_snapshot_name)
+            expired.extend(deletelist)
+
+        replica_metrics = BackupMetrics()
+        replica.report = self.report
+        replica.changes = {'creates': [], 'deletes': []}
+        replica.cursor = None
+        errors.append(replica.expire(expired, replica_metrics))
+        self.changes['copy_deletes'] = replica.changes['deletes']
+        metrics.increment('copy_deletes', replica_metrics['deletes'])
+
+        return ''.join(errors)
+
+    def is_tool_snapshot(self, snapshot):
+        """
+        Whether the snapshot was taken by this tool, by its bookkeeping tags or, for snapshots
+        older than those, by the name given to snapshots of the periods this run knows about.
+        """
+        return PERIOD_TAG in self.resolve_snapshot_tags(snapshot) or \
+            self.snapshot_in_period(snapshot, self.retention_periods)
+
+    def sweep_orphans(self, grace_days=30, keep_count=1):
+        """
+        Delete the snapshots this tool took of resources it no longer backs up, as they were
+        deleted or untagged, which retention never sees, along with their copies in the DR region.
+        The newest keep_count snapshots of each resource are kept, as is any snapshot younger than
+        grace_days.
+        """
+        start_message = 'Started sweeping orphaned %(service)s snapshots at %(date)s' % {
+            'service': self.service_name,
+            'date': datetime.today().strftime('%d-%m-%Y %H:%M:%S')
         }
+        self.report = RunReport(service=self.service_name, period='sweep')
+        self.report.add(start_message + "\n\n")
 
-        self.message += result
-        self.message += "\nTotal snapshots created: " + str(total_creates)
-        self.message += "\nTotal snapshots errors: " + str(count_errors)
-        self.message += "\nTotal snapshots deleted: " + str(total_deletes) + "\n"
+        metrics = BackupMetrics()
+        self.cursor = None
+        self.changes = {'creates': [], 'deletes': []}
+
+        expired = []
+        copies_expired = []
+        if self.resume_phases is not None:
+            expired.extend(self.snapshot_from_reference(ref) for ref in self.resume_phases.get('delete', []))
+        else:
+            live = set(self.resolve_backupable_id(resource) for resource in self.get_backable_resources())
+
+            # One pass over the index, grouping the snapshots of resources not backed up by this schedule
+            # by the resource they were taken from. Copies made in this region are left to the DR region's sweep
+            candidates = {}
+            for snapshot in self.get_snapshot_index():
+                metrics.increment('scanned')
+                resource_id = self.resolve_backupable_id(snapshot)
+                if resource_id not in live and self.in_shard(resource_id) and self.is_tool_snapshot(snapshot) and \
+                        COPY_OF_TAG not in self.resolve_snapshot_tags(snapshot):
+                    candidates.setdefault(resource_id, []).append(snapshot)
+
+            # The copies in the DR region are never seen by retention there once their resource is
+            # gone either, so they are swept along with the snapshots they were copied from
+            copy_candidates = {}
+            if self.copy_settings and self.inventory is None:
+                replica = self.get_replica()
+                for snapshot in replica.get_snapshot_index():
+                    metrics.increment('scanned')
+                    resource_id = replica.resolve_snapshot_tags(snapshot).get(SOURCE_TAG)
+                    if resource_id not in live and self.in_shard(resource_id):
+                        copy_candidates.setdefault(resource_id, []).append(snapshot)
+
+            existing = self.existing_resource_ids(sorted(set(candidates) | set(copy_candidates)))
+            expired.extend(self.plan_orphans(self, candidates, existing, grace_days, keep_count, metrics))
+            if copy_candidates:
+                self.report.add('\nCopies in %s\n' % replica.conn.meta.region_name)
+                copies_expired = self.plan_orphans(replica, copy_candidates, existing, grace_days, keep_count,
+                                                   metrics)
+
+        errmsg = self.expire(expired, metrics)
+
+        # Copies that do not fit in the invocation are found again by the next sweep
+        if copies_expired and self.cursor is None:
+            replica_metrics = BackupMetrics()
+            replica.report = self.report
+            replica.changes = {'creates': [], 'deletes': []}
+            replica.cursor = None
+            errmsg += replica.expire(copies_expired, replica_metrics)
+            self.changes['deletes'].extend(replica.changes['deletes'])
+            metrics.increment('copy_deletes', replica_metrics['deletes'])
+            metrics.increment('delete_errors', replica_metrics['delete_errors'])
+
+        pending_deletes = len(self.cursor['phases'].get('delete', [])) if self.cursor else 0
+        sections = []
+        sections.append('\nFinished sweeping at %(date)s, %(orphans)s orphaned snapshots found in %(scanned)s\n' % {
+            'date': datetime.today().strftime('%d-%m-%Y %H:%M:%S'),
+            'orphans': metrics['orphans'],
+            'scanned': metrics['scanned']
+        })
+        sections.append("\nTotal snapshots deleted: " + str(metrics['deletes']))
+        if self.copy_settings:
+            sections.append("\nTotal copies deleted from " + self.copy_settings['region'] + ": " +
+                            str(metrics['copy_deletes']))
+        sections.append("\nTotal snapshot delete errors: " + str(metrics['delete_errors']))
+        sections.append("\nTotal snapshots left for the next invocation: " + str(pending_deletes) + "\n")
+
+        closing = ''.join(sections)
+        print(closing)
+        self.message = self.report.render(closing)
+        self.errmsg += errmsg
+
+        api_stats = [self.api_stats]
+        if self.replica_mgr is not None:
+            api_stats.append(self.replica_mgr.api_stats)
 
         return {
-            "total_resources": count_total,
-            "total_creates": total_creates,
-            "total_errors": count_errors,
-            "total_deletes": total_deletes,
+            "total_scanned": metrics['scanned'],
+            "total_orphans": metrics['orphans'],
+            "total_deletes": metrics['deletes'],
+            "total_copy_deletes": metrics['copy_deletes'],
+            "total_delete_errors": metrics['delete_errors'],
+            "total_pending_deletes": pending_deletes,
+            "total_api_calls": sum(stats.total_calls() for stats in api_stats),
+            "api_calls": merge_stats([stats.summary() for stats in api_stats]),
         }
 
+    def plan_orphans(self, manager, candidates, existing, grace_days, keep_count, metrics):
+        """
+        Pick out the orphaned snapshots, kept by manager, of each candidate resource, those of a resource
+        still there only when they were taken under this schedule.
+
+        :return: the snapshots to delete, all but the newest keep_count of each resource older than grace_days
+        """
+        # A resource that is still there may be backed up by another schedule, only the snapshots
+        # it was seen to take under this one are orphaned by the resource being untagged
+        orphans = {}
+        for resource_id in sorted(candidates):
+            snapshots = candidates[resource_id]
+            if resource_id in existing:
+                snapshots = [snap for snap in snapshots
+                             if manager.resolve_snapshot_tags(snap).get(SCHEDULE_TAG) == self.schedule]
+            if snapshots:
+                orphans[resource_id] = snapshots
+
+        # Copies are dated by the snapshot they were copied from
+        time_func = manager.resolve_copy_time if manager.copies_only else manager.resolve_snapshot_time
+        cutoff = datetime.now(UTC) - timedelta(days=grace_days)
+        planner = RetentionPlanner(keep_count=keep_count)
+        expired = []
+        for resource_id in sorted(orphans):
+            keep, delete = planner.plan(orphans[resource_id], time_func, manager.resolve_snapshot_name)
+            delete = [snap for snap in delete if time_func(snap) < cutoff]
+
+            self.report.add('    %(id)s is %(state)s, %(count)s snapshots left, expiring %(expired)s\n' % {
+                'id': resource_id,
+                'state': 'no longer tagged' if resource_id in existing else 'gone',
+                'count': len(orphans[resource_id]),
+                'expired': len(delete)
+            })
+            metrics.increment('orphans', len(orphans[resource_id]))
+            expired.extend(delete)
+        return expired
+
+    def existing_resource_ids(self, resource_ids):
+        """
+        :return: those of the resource ids that still exist, tagged or not
+        """
+        if not resource_ids:
+            return set()
+
+        # An inventory only lists the tagged resources, the others it knows about are listed by id
+        if self.inventory is not None:
+            if 'ExistingResourceIds' not in self.inventory:
+                raise ValueError('The inventory does not say which resources still exist, export it again '
+                                 'to plan a sweep from it')
+            return set(self.inventory['ExistingResourceIds']) & set(resource_ids)
+        return self.describe_existing_resource_ids(resource_ids)
+
+    def describe_existing_resource_ids(self, resource_ids):
+        """
+        :return: those of the resource ids that still exist, looked up in the account
+        """
+        pass
+
+    def snapshot_resource_ids(self, snapshots):
+        """
+        :return: the ids of the resources still there that the snapshots were taken of, for an inventory
+        """
+        resource_ids = set(self.resolve_backupable_id(snap) for snap in snapshots)
+        resource_ids.discard(None)
+        return sorted(self.existing_resource_ids(sorted(resource_ids)))
+
+    def delete_expired(self, expired, metrics):
+        """
+        Delete the expired snapshots of every resource on a bounded pool of workers, carrying
+        on past any that fail, such as a snapshot still in use by an image.
+
+        :return: any error message
+        """
+        errors = []
+
+        expired = self.until_deadline(expired, phase='delete', references=lambda snap: [self.snapshot_reference(snap)])
+        for snapshot, error in self.map_resources(lambda snap: self.try_delete_snapshot(snap, metrics), expired,
+                                                  max_workers=self.delete_workers):
+            name = self.resolve_snapshot_name(snapshot)
+            record = self.change_record(snapshot)
+            if error is None:
+                self.report.add('    Deleted snapshot %s\n' % name)
+                self.report.record('delete', **record)
+                self.changes['deletes'].append(record)
+            else:
+                self.report.add('    Failed to delete snapshot %s: %s\n' % (name, error))
+                self.report.record('delete_error', error=str(error), **record)
+                errors.append('Error deleting snapshot %s: %s\n' % (name, error))
+
+        return ''.join(errors)
+
+    def try_delete_snapshot(self, snapshot, metrics):
+        """
+        :return: the snapshot and the error deleting it, None when it was deleted
+        """
+        timer = PhaseTimer()
+        try:
+            with timer.phase('delete'):
+                self.delete_snapshot(snapshot)
+        except Exception as ex:
+            if getattr(ex, 'response', {}).get('Error', {}).get('Code') in SNAPSHOT_GONE_ERROR_CODES:
+                # Deleted outside the tool, which an index saved by an earlier run can be behind on
+                print('Snapshot %s was already deleted' % self.resolve_snapshot_name(snapshot))
+                if self.snapshot_index is not None:
+                    self.snapshot_index.discard(snapshot)
+                metrics.increment('deletes')
+                return snapshot, None
+
+            print('Unable to delete snapshot %s: %s' % (self.resolve_snapshot_name(snapshot), ex))
+            metrics.increment('delete_errors')
+            return snapshot, ex
+        finally:
+            metrics.record_timings(timer)
+
+        metrics.increment('deletes')
+        return snapshot, None
+
     def delete_snapshot(self, snapshot):
         pass
 
 
 class EC2BackupManager(BaseBackupManager):
-    def __init__(self, ec2_region_name, period, tag_name, tag_value, date_suffix, keep_count):
+    service_name = 'ec2'
+    snapshot_reference_keys = ('SnapshotId', 'VolumeId', 'Description')
+    snapshot_index_keys = snapshot_reference_keys + ('StartTime', 'State', 'Tags')
+
+    def __init__(self, ec2_region_name, period, tag_name, tag_value, date_suffix, keep_count,
+                 instance_snapshots=False, **kwargs):
         super(EC2BackupManager, self).__init__(period=period,
                                                tag_name=tag_name,
                                                tag_value=tag_value,
                                                date_suffix=date_suffix,
-                                               keep_count=keep_count)
+                                               keep_count=keep_count,
+                                               **kwargs)
 
-        # Connect to AWS using the credentials provided above or in Environment vars or using IAM role.
-        print('Connecting to AWS')
-        self.conn = boto3.client('ec2', region_name=ec2_region_name)
+        self.conn = self.connect(self.service_name, ec2_region_name)
 
-    @staticmethod
-    def date_compare(snap1, snap2):
-        if snap1['StartTime'] < snap2['StartTime']:
-            return -1
-        elif snap1['StartTime'] == snap2['StartTime']:
-            return 0
-        return 1
+        # Tags resolved through describe_tags, for resources discovered without them
+        self.tag_cache = {}
+
+        # Snapshot the tagged volumes of each instance together, in one crash consistent set
+        self.instance_snapshots = instance_snapshots
 
-    def lookup_period_prefix(self):
-        return self.period + "_snapshot"
+    def lookup_period_prefix(self, period=None):
+        return (period or self.period) + "_snapshot"
+
+    def is_tool_snapshot(self, snapshot):
+        # Every description the tool writes ends the same way, whatever the period
+        return ' by snapshot script' in snapshot.get('Description', '') or \
+            super(EC2BackupManager, self).is_tool_snapshot(snapshot)
 
     def get_resource_tags(self, resource):
+        # describe_volumes already hands back the tags, no need to ask again
+        if 'Tags' in resource:
+            return self.tag_list_to_dict(resource['Tags'])
+
         resource_id = self.resolve_backupable_id(resource)
-        resource_tags = {}
-        if resource_id:
-            tags = self.conn.describe_tags(Filters=[{"Name": "resource-id",
-                                                     "Values": [resource_id]}])
-            for tag in tags["Tags"]:
-                # Tags starting with 'aws:' are reserved for internal use
-                if not tag['Key'].startswith('aws:'):
-                    resource_tags[tag['Key']] = tag['Value']
-        return resource_tags
+        if not resource_id:
+            return {}
+
+        if resource_id not in self.tag_cache:
+            self.prefetch_resource_tags([resource_id])
+        return dict(self.tag_cache[resource_id])
+
+    def prefetch_resource_tags(self, resource_ids):
+        missing = [resource_id for resource_id in resource_ids if resource_id not in self.tag_cache]
+
+        paginator = self.conn.get_paginator('describe_tags')
+        for start in range(0, len(missing), TAG_LOOKUP_BATCH_SIZE):
+            batch = missing[start:start + TAG_LOOKUP_BATCH_SIZE]
+            for resource_id in batch:
+                self.tag_cache[resource_id] = {}
+
+            for page in paginator.paginate(Filters=[{"Name": "resource-id", "Values": batch}]):
+                for tag in page['Tags']:
+                    if not tag['Key'].startswith('aws:'):
+                        self.tag_cache[tag['ResourceId']][tag['Key']] = tag['Value']
 
     def set_resource_tags(self, resource, tags):
         resource_id = resource['SnapshotId']
-        for tag_key, tag_value in tags.iteritems():
-            print('Tagging %(resource_id)s with [%(tag_key)s: %(tag_value)s]' % {
-                'resource_id': resource_id,
-                'tag_key': tag_key,
-                'tag_value': tag_value
-            })
+        print('Tagging %(resource_id)s with %(count)s tags' % {
+            'resource_id': resource_id,
+            'count': len(tags)
+        })
 
-            self.conn.create_tags(Resources=[resource_id],
-                                  Tags=[{"Key": tag_key, "Value": tag_value}])
+        self.conn.create_tags(Resources=[resource_id], Tags=self.tag_dict_to_list(tags))
 
     def get_backable_resources(self):
         # Get all the volumes that match the tag criteria
@@ -215,29 +2336,328 @@ class EC2BackupManager(BaseBackupManager):
             'tag_name': self.tag_name,
             'tag_value': self.tag_value
         })
-        volumes = self.conn.describe_volumes(Filters=[{"Name": 'tag:' + self.tag_name,
-                                                       "Values": [self.tag_value]}])["Volumes"]
+        pages = self.list_pages('describe_volumes', 'Volumes',
+                                Filters=[{"Name": 'tag:' + self.tag_name,
+                                          "Values": [self.tag_value]}],
+                                PaginationConfig=self.pagination_config())
+
+        count = 0
+        for page in pages:
+            volumes = page["Volumes"]
+
+            # Resolve tags in bulk for any volume the response came back without
+            self.prefetch_resource_tags([self.resolve_backupable_id(volume) for volume in volumes
+                                         if 'Tags' not in volume])
+
+            for volume in volumes:
+                # Already filtered by the API, but not when read from an inventory
+                if self.get_resource_tags(volume).get(self.tag_name) != self.tag_value:
+                    continue
+                count += 1
+                yield volume
+
+        print('Found %(count)s volumes to manage' % {'count': count})
+
+    def group_resources(self, resources):
+        """
+        With instance_snapshots, gather the volumes attached to each instance into one work item,
+        volumes that are detached or attached to several instances are still snapshot one by one.
+        """
+        if not self.instance_snapshots:
+            for volume in resources:
+                yield volume
+            return
+
+        # The API copies each volume's tags over as they are, so a volume with more tags than fit
+        # alongside the bookkeeping tags is snapshot on its own, where they can be cut down
+        room = MAX_TAGS_PER_RESOURCE - len(self.bookkeeping_tags(None))
+
+        instance_volumes = {}
+        for volume in resources:
+            attachments = volume.get('Attachments') or []
+            if len(attachments) == 1 and len(self.get_resource_tags(volume)) <= room:
+                instance_volumes.setdefault(attachments[0]['InstanceId'], []).append(volume)
+            else:
+                yield volume
+
+        # Only a real create needs to know the instance's other volumes, to leave them out of the set
+        instances = {}
+        if not self.plan_only:
+            instances = self.describe_instances(sorted(instance_volumes))
+
+        for instance_id in sorted(instance_volumes):
+            # Without the instance its other volumes cannot be left out of the set, and would be
+            # snapshot along with it with nothing to rotate them
+            if not self.plan_only and instance_id not in instances:
+                print('Instance %s not found, snapshotting its volumes one by one' % instance_id)
+                for volume in instance_volumes[instance_id]:
+                    yield volume
+                continue
+
+            yield {
+                'InstanceId': instance_id,
+                'Instance': instances.get(instance_id),
+                'Volumes': instance_volumes[instance_id],
+            }
+
+    def describe_existing_resource_ids(self, resource_ids):
+        existing = set()
+        for start in range(0, len(resource_ids), ID_FILTER_BATCH_SIZE):
+            batch = resource_ids[start:start + ID_FILTER_BATCH_SIZE]
+            for page in self.list_pages('describe_volumes', 'Volumes',
+                                        Filters=[{"Name": "volume-id", "Values": batch}]):
+                existing.update(self.resolve_backupable_id(volume) for volume in page['Volumes'])
+        return existing & set(resource_ids)
+
+    def describe_instances(self, instance_ids):
+        instances = {}
+
+        paginator = self.conn.get_paginator('describe_instances')
+        for start in range(0, len(instance_ids), ID_FILTER_BATCH_SIZE):
+            batch = instance_ids[start:start + ID_FILTER_BATCH_SIZE]
+            for page in paginator.paginate(Filters=[{"Name": "instance-id", "Values": batch}]):
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        instances[instance['InstanceId']] = instance
+        return instances
+
+    def shard_key(self, item):
+        # The volumes of an instance go with it, to be snapshot together
+        if 'Volumes' in item:
+            return item['InstanceId']
+        return super(EC2BackupManager, self).shard_key(item)
+
+    def work_item_ids(self, item):
+        if 'Volumes' in item:
+            return [self.resolve_backupable_id(volume) for volume in item['Volumes']]
+        return super(EC2BackupManager, self).work_item_ids(item)
+
+    def process_resource(self, backup_item, metrics):
+        if 'Volumes' in backup_item:
+            return self.process_instance(backup_item, metrics)
+        return super(EC2BackupManager, self).process_resource(backup_item, metrics)
+
+    def process_instance(self, instance_item, metrics):
+        """
+        Snapshot the tagged volumes of an instance with a single create_snapshots call, then
+        rotate the snapshots of each volume as usual.
+
+        :return: the report section for the instance, any error message, and the snapshots
+                 created and expired
+        """
+        message = ''
+        errmsg = ''
+        changes = {'creates': [], 'expired': [], 'deferred': [], 'skipped': [], 'kept': [], 'unstarted': []}
+        new_snapshots = {}
+        deferred = False
+
+        instance_id = instance_item['InstanceId']
+        volumes = instance_item['Volumes']
+        timer = PhaseTimer()
+
+        message += 'Processing instance %(id)s with volumes %(volumes)s\n' % {
+            'id': instance_id,
+            'volumes': ', '.join(self.work_item_ids(instance_item))
+        }
+
+        description = self.snapshot_description(instance_id)
+        try:
+            # The set is taken whole or not at all, one volume still in progress holds up the others
+            for volume in volumes:
+                self.check_not_in_progress(volume)
+
+            if self.plan_only:
+                with timer.phase('tag'):
+                    for volume in volumes:
+                        new_snapshots[self.resolve_backupable_id(volume)] = self.planned_snapshot(
+                            resource=volume, description=description, tags=self.get_resource_tags(volume))
+                message += '    New Snapshots planned with description: %s\n' % description
+            else:
+                with timer.phase('create'):
+                    new_snapshots = self.create_when_ready(lambda: self.snapshot_instance(instance_item, description),
+                                                           count=len(volumes),
+                                                           started=lambda snapshots: list(snapshots.values()))
+                message += '    New Snapshots created with description: %s\n' % description
+
+            for volume in volumes:
+                new_snapshot = new_snapshots.get(self.resolve_backupable_id(volume))
+                if new_snapshot is not None:
+                    changes['creates'].append(self.change_record(new_snapshot))
+                    metrics.increment('creates')
+        except OutOfTime as e:
+            message += '    Left for the next invocation: %s\n' % e
+            changes['unstarted'].extend(self.work_item_ids(instance_item))
+            return message, errmsg, changes
+        except SnapshotDeferred as e:
+            message += '    Deferred to a later run: %s\n' % e
+            changes['deferred'].extend(self.work_item_ids(instance_item))
+            deferred = True
+        except Exception as e:
+            print("Unexpected error:", sys.exc_info()[0])
+            print(e)
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                      limit=2, file=sys.stdout)
+
+        metrics.increment('total', len(volumes))
+        for volume in volumes:
+            volume_id = self.resolve_backupable_id(volume)
+            message += '\n  Volume %s\n' % volume_id
+            try:
+                section, keeplist, deletelist = self.rotate_snapshots(volume, new_snapshots.get(volume_id), timer)
+                message += section
+                changes['expired'].extend(deletelist)
+                if self.copy_settings:
+                    changes['kept'].extend(keeplist)
+            except Exception as ex:
+                print("Unexpected error:", sys.exc_info()[0])
+                print(ex)
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                          limit=2, file=sys.stdout)
+                logging.error('Error in processing volume with id: ' + volume_id)
+                errmsg += 'Error in processing volume with id: ' + volume_id
+                metrics.increment('errors')
+            else:
+                metrics.increment('deferred' if deferred else 'success')
+
+        metrics.record_timings(timer)
+        message += '    Timings: %s\n' % timer
 
-        print('Found %(count)s volumes to manage' % {'count': len(volumes)})
+        return message, errmsg, changes
 
-        return volumes
+    def snapshot_instance(self, instance_item, description):
+        """
+        Take crash consistent snapshots of the tagged volumes of an instance, the instance's other
+        volumes are left out and each snapshot is given the tags of its volume.
+
+        :return: the new snapshots by volume id
+        """
+        snapshot_index = self.get_snapshot_index()
+
+        volume_ids = set(self.work_item_ids(instance_item))
+        specification = {'InstanceId': instance_item['InstanceId'], 'ExcludeBootVolume': False}
+
+        instance = instance_item['Instance']
+        excluded = []
+        for mapping in instance.get('BlockDeviceMappings', []):
+            volume_id = mapping.get('Ebs', {}).get('VolumeId')
+            if volume_id is None or volume_id in volume_ids:
+                continue
+            if mapping.get('DeviceName') == instance.get('RootDeviceName'):
+                specification['ExcludeBootVolume'] = True
+            else:
+                excluded.append(volume_id)
+        if excluded:
+            specification['ExcludeDataVolumeIds'] = excluded
+
+        # The volume tags are copied over by the API, only the bookkeeping tags are given here
+        bookkeeping = self.bookkeeping_tags(instance_item['InstanceId'])
+        bookkeeping[INSTANCE_TAG] = bookkeeping.pop(SOURCE_TAG)
+        response = self.conn.create_snapshots(
+            InstanceSpecification=specification,
+            Description=description,
+            CopyTagsFromSource='volume',
+            TagSpecifications=[{"ResourceType": "snapshot", "Tags": self.tag_dict_to_list(bookkeeping)}])
+
+        new_snapshots = {}
+        for snapshot in response['Snapshots']:
+            snapshot_index.add(snapshot)
+            new_snapshots[snapshot['VolumeId']] = snapshot
+        return new_snapshots
 
     def snapshot_resource(self, resource, description, tags):
+        # Make sure the index is listed before the create, so the new snapshot is added exactly once
+        snapshot_index = self.get_snapshot_index()
+
+        # Tagged as part of the create call, so there is never a snapshot without its tags
+        tag_list = self.build_snapshot_tags(resource, tags)
+
         current_snap = self.conn.create_snapshot(VolumeId=self.resolve_backupable_id(resource),
-                                                 Description=description)
-        self.set_resource_tags(current_snap, tags)
+                                                 Description=description,
+                                                 TagSpecifications=[{"ResourceType": "snapshot",
+                                                                     "Tags": tag_list}])
 
-    def list_snapshots_for_resource(self, resource):
-        snapshots = self.conn.describe_snapshots(Filters=[
-            {"Name": "volume-id",
-             "Values": [self.resolve_backupable_id(resource)]
-             }])
+        # Keep the index in step so retention sees the snapshot just taken
+        snapshot_index.add(current_snap)
+        return current_snap
+
+    def planned_snapshot(self, resource, description, tags):
+        return {
+            'SnapshotId': None,
+            'VolumeId': self.resolve_backupable_id(resource),
+            'Description': description,
+            'StartTime': datetime.now(UTC),
+            'Tags': self.build_snapshot_tags(resource, tags),
+        }
+
+    def iter_snapshots(self):
+        print('Listing all snapshots owned by this account')
+        for page in self.list_pages('describe_snapshots', 'Snapshots', OwnerIds=['self']):
+            for snapshot in page['Snapshots']:
+                yield snapshot
+
+    def replica(self, region_name):
+        return EC2BackupManager(ec2_region_name=region_name, **self.replica_settings())
+
+    def copy_snapshot_from(self, snapshot, source_region, tags, kms_key_id=None):
+        params = {}
+        if kms_key_id:
+            params = {'Encrypted': True, 'KmsKeyId': kms_key_id}
+
+        response = self.conn.copy_snapshot(SourceRegion=source_region,
+                                           SourceSnapshotId=snapshot['SnapshotId'],
+                                           Description=snapshot.get('Description', ''),
+                                           TagSpecifications=[{"ResourceType": "snapshot",
+                                                               "Tags": tags}],
+                                           **params)
+
+        # The copy's VolumeId is not the source's, so it is filed under its tags instead
+        replica_snapshot = {
+            'SnapshotId': response['SnapshotId'],
+            'VolumeId': snapshot['VolumeId'],
+            'Description': snapshot.get('Description', ''),
+            'StartTime': datetime.now(UTC),
+            'State': 'pending',
+            'Tags': tags,
+        }
+        return replica_snapshot
+
+    def export_inventory(self):
+        # Tags are written out with each volume, so planning from the inventory never has to look them up
+        volumes = [dict(volume, Tags=self.tag_dict_to_list(self.get_resource_tags(volume)))
+                   for volume in self.get_backable_resources()]
+        snapshots = list(self.get_snapshot_index())
+
+        return {
+            'Volumes': volumes,
+            'Snapshots': snapshots,
+            'ExistingResourceIds': self.snapshot_resource_ids(snapshots),
+        }
 
-        return snapshots['Snapshots']
+    def snapshot_in_progress(self, snapshot):
+        return snapshot.get('State') == 'pending'
+
+    def snapshot_completed(self, snapshot):
+        return snapshot.get('State') == 'completed'
+
+    def describe_snapshots_by_id(self, snapshots):
+        snapshot_ids = [snapshot['SnapshotId'] for snapshot in snapshots]
+
+        current = []
+        paginator = self.conn.get_paginator('describe_snapshots')
+        for start in range(0, len(snapshot_ids), ID_FILTER_BATCH_SIZE):
+            batch = snapshot_ids[start:start + ID_FILTER_BATCH_SIZE]
+            for page in paginator.paginate(OwnerIds=['self'], Filters=[{"Name": "snapshot-id", "Values": batch}]):
+                current.extend(page['Snapshots'])
+        return current
 
     def resolve_backupable_id(self, resource):
         return resource["VolumeId"]
 
+    def resolve_snapshot_id(self, resource):
+        return resource.get('SnapshotId')
+
     def resolve_snapshot_name(self, resource):
         return resource['Description']
 
@@ -247,58 +2667,78 @@ class EC2BackupManager(BaseBackupManager):
     def delete_snapshot(self, snapshot):
         self.conn.delete_snapshot(SnapshotId=snapshot["SnapshotId"])
 
+        if self.snapshot_index is not None:
+            self.snapshot_index.discard(snapshot)
 
-class RDSBackupManager(BaseBackupManager):
-    account_number = None
 
-    def __init__(self, rds_region_name, period, tag_name, tag_value, date_suffix, keep_count):
+class RDSBackupManager(BaseBackupManager):
+    service_name = 'rds'
+    snapshot_reference_keys = ('DBSnapshotIdentifier', 'DBInstanceIdentifier',
+                               'DBClusterSnapshotIdentifier', 'DBClusterIdentifier')
+    snapshot_index_keys = snapshot_reference_keys + ('DBSnapshotArn', 'DBClusterSnapshotArn', 'SnapshotCreateTime',
+                                                     'Status', 'TagList')
+
+    def __init__(self, rds_region_name, period, tag_name, tag_value, date_suffix, keep_count,
+                 promote_automated=None, **kwargs):
         super(RDSBackupManager, self).__init__(period=period,
                                                tag_name=tag_name,
                                                tag_value=tag_value,
                                                date_suffix=date_suffix,
-                                               keep_count=keep_count)
+                                               keep_count=keep_count,
+                                               **kwargs)
 
-        # Connect to AWS using the credentials provided above or in Environment vars or using IAM role.
-        print('Connecting to AWS')
-        self.conn = boto3.client('rds', region_name=rds_region_name)
+        self.conn = self.connect(self.service_name, rds_region_name)
 
-    @staticmethod
-    def date_compare(snap1, snap2):
-        utc = pytz.UTC
-        now = datetime.utcnow().replace(tzinfo=utc)
-        if snap1.get('SnapshotCreateTime', now) < snap2.get('SnapshotCreateTime', now):
-            return -1
-        elif snap1.get('SnapshotCreateTime', now) == snap2.get('SnapshotCreateTime', now):
-            return 0
-        return 1
-
-    def lookup_period_prefix(self):
-        return self.period
+        # Tags fetched through list_tags_for_resource by ARN, so each is only asked for once a run
+        self.tag_cache = {}
+
+        # Copy the latest automated snapshot as the period's snapshot rather than take a new one,
+        # e.g. {"max_age_hours": 24}, and the newest automated snapshot of each database, once listed
+        self.promote_automated = promote_automated
+        self.automated_snapshots = None
+
+    def lookup_period_prefix(self, period=None):
+        return period or self.period
 
     def get_resource_tags(self, resource):
+        # describe_db_instances and describe_db_clusters hand back the tags with the resource
+        if 'TagList' in resource:
+            return self.tag_list_to_dict(resource['TagList'])
+
         resource_id = self.resolve_backupable_id(resource)
-        resource_tags = {}
-        if resource_id:
-            arn = self.build_arn_for_id(resource_id)
+        if not resource_id:
+            return {}
+
+        if 'DBInstanceIdentifier' in resource:
+            arn = resource.get('DBInstanceArn') or self.build_arn(resource)
+        else:
+            arn = resource.get('DBClusterArn') or self.build_arn_for_id(resource_id, resource_type='cluster')
+
+        if arn not in self.tag_cache:
             tags = self.conn.list_tags_for_resource(ResourceName=arn)['TagList']
+            self.tag_cache[arn] = self.tag_list_to_dict(tags)
+        return dict(self.tag_cache[arn])
 
-            for tag in tags:
-                # Tags starting with 'aws:' are reserved for internal use
-                if not tag['Key'].startswith('aws:'):
-                    resource_tags[tag['Key']] = tag['Value']
-        return resource_tags
+    def resolve_snapshot_tags(self, snapshot):
+        return self.tag_list_to_dict(snapshot.get('TagList', []))
+
+    def is_tool_snapshot(self, snapshot):
+        if PERIOD_TAG in self.resolve_snapshot_tags(snapshot):
+            return True
+
+        # Older snapshots are only known by their name, period-resource-date-suffix
+        name = self.resolve_snapshot_name(snapshot)
+        prefix = '-' + self.resolve_backupable_id(snapshot) + '-'
+        return any(name.startswith(period + prefix) for period in self.retention_periods)
 
     def set_resource_tags(self, resource, tags):
-        resource_id = resource['SnapshotId']
-        for tag_key, tag_value in tags.iteritems():
-            print('Tagging %(resource_id)s with [%(tag_key)s: %(tag_value)s]' % {
-                'resource_id': resource_id,
-                'tag_key': tag_key,
-                'tag_value': tag_value
-            })
+        resource_arn = resource.get('DBClusterSnapshotArn') or resource.get('DBSnapshotArn')
+        print('Tagging %(resource_arn)s with %(count)s tags' % {
+            'resource_arn': resource_arn,
+            'count': len(tags)
+        })
 
-            self.conn.create_tags(Resources=[resource_id],
-                                  Tags=[{"Key": tag_key, "Value": tag_value}])
+        self.conn.add_tags_to_resource(ResourceName=resource_arn, Tags=self.tag_dict_to_list(tags))
 
     def get_backable_resources(self):
         # Get all the volumes that match the tag criteria
@@ -306,52 +2746,253 @@ class RDSBackupManager(BaseBackupManager):
             'tag_name': self.tag_name,
             'tag_value': self.tag_value
         })
-        all_instances = self.conn.describe_db_instances()['DBInstances']
-        found = []
-
-        for db_instance in all_instances:
-            if self.db_has_tag(db_instance):
-                # prevent multiple cluster backup
-                if 'DBClusterIdentifier' in db_instance:
-                    if not any(d.get('DBClusterIdentifier', None) == db_instance['DBClusterIdentifier'] for d in found):
-                        found.append(db_instance)
+        count = 0
+
+        # prevent multiple cluster backup, a cluster is backed up once whether it is
+        # tagged itself or through any of its instances
+        found_clusters = set()
+
+        for page in self.list_pages('describe_db_clusters', 'DBClusters', PaginationConfig=self.pagination_config()):
+            for db_cluster in page['DBClusters']:
+                if self.db_has_tag(db_cluster):
+                    found_clusters.add(db_cluster['DBClusterIdentifier'])
+                    count += 1
+                    yield db_cluster
+
+        for page in self.list_pages('describe_db_instances', 'DBInstances',
+                                    PaginationConfig=self.pagination_config()):
+            for db_instance in page['DBInstances']:
+                cluster_id = db_instance.get('DBClusterIdentifier')
+                if cluster_id in found_clusters:
                     continue
-                found.append(db_instance)
 
-        print('Found %(count)s databases to manage' % {'count': len(found)})
+                if self.db_has_tag(db_instance):
+                    if cluster_id:
+                        found_clusters.add(cluster_id)
+                    count += 1
+                    yield db_instance
 
-        return found
-
-    def snapshot_resource(self, resource, description, tags):
+        print('Found %(count)s databases to manage' % {'count': count})
 
-        aws_tagset = []
-        for k in tags:
-            aws_tagset.append({"Key": k, "Value": tags[k]})
+    def describe_existing_resource_ids(self, resource_ids):
+        existing = set()
+        for page in self.list_pages('describe_db_clusters', 'DBClusters', PaginationConfig=self.pagination_config()):
+            existing.update(db_cluster['DBClusterIdentifier'] for db_cluster in page['DBClusters'])
+        for page in self.list_pages('describe_db_instances', 'DBInstances',
+                                    PaginationConfig=self.pagination_config()):
+            existing.update(db_instance['DBInstanceIdentifier'] for db_instance in page['DBInstances'])
+        return existing & set(resource_ids)
 
+    def build_snapshot_id(self, resource):
         date = datetime.today().strftime('%d-%m-%Y-%H-%M-%S')
-        snapshot_id = self.period + '-' + self.resolve_backupable_id(resource) + "-" + date + "-" + self.date_suffix
+        return self.period + '-' + self.resolve_backupable_id(resource) + "-" + date + "-" + self.date_suffix
+
+    def get_automated_snapshots(self):
+        """
+        The newest available automated snapshot of each database and cluster, from a single listing.
+        """
+        with self.lock:
+            if self.automated_snapshots is None:
+                newest = {}
+                for snapshot in self.iter_snapshots(snapshot_type='automated'):
+                    # An inventory holds the manual snapshots alone, whatever was asked for
+                    if snapshot.get('SnapshotType') != 'automated' or not self.snapshot_completed(snapshot):
+                        continue
+                    resource_id = self.resolve_backupable_id(snapshot)
+                    if resource_id not in newest or \
+                            snapshot['SnapshotCreateTime'] > newest[resource_id]['SnapshotCreateTime']:
+                        newest[resource_id] = snapshot
+                self.automated_snapshots = newest
+        return self.automated_snapshots
+
+    def promotable_snapshot(self, resource):
+        """
+        :return: the automated snapshot to copy as the resource's snapshot for the period, or None
+                 and the reason there is none recent enough that was not already copied in this period
+        """
+        automated = self.get_automated_snapshots().get(self.resolve_backupable_id(resource))
+        if automated is None:
+            return None, 'no automated snapshot to promote'
+
+        max_age_hours = self.promote_automated.get('max_age_hours', DEFAULT_PROMOTE_MAX_AGE_HOURS)
+        automated_id = self.resolve_snapshot_name(automated)
+        if datetime.now(UTC) - automated['SnapshotCreateTime'] > timedelta(hours=max_age_hours):
+            return None, 'automated snapshot %s is older than %s hours' % (automated_id, max_age_hours)
+
+        for snapshot in self.list_snapshots_for_resource(resource):
+            if self.resolve_snapshot_tags(snapshot).get(PROMOTED_FROM_TAG) == automated_id and \
+                    self.snapshot_in_period(snapshot):
+                return None, 'automated snapshot %s was already promoted in this period' % automated_id
+        return automated, None
+
+    def snapshot_source(self, resource):
+        """
+        :return: the automated snapshot to promote, or None to take a snapshot of the database, which
+                 with promote_automated is only done when fallback_to_snapshot allows it
+        """
+        if self.promote_automated is None:
+            return None
+
+        automated, reason = self.promotable_snapshot(resource)
+        if automated is None:
+            # A snapshot of the database suspends its I/O, which promoting is there to avoid
+            if not self.promote_automated.get('fallback_to_snapshot', False):
+                raise SnapshotSkipped(reason)
+            print('Taking a snapshot of %s instead, %s' % (self.resolve_backupable_id(resource), reason))
+        return automated
+
+    def new_snapshot_tags(self, resource, tags, automated):
+        if automated is None:
+            return self.build_snapshot_tags(resource, tags)
+        return self.build_snapshot_tags(resource, tags, {PROMOTED_FROM_TAG: self.resolve_snapshot_name(automated)})
 
+    def snapshot_resource(self, resource, description, tags):
+        # Make sure the index is listed before the create, so the new snapshot is added exactly once
+        snapshot_index = self.get_snapshot_index()
+
+        automated = self.snapshot_source(resource)
+        tag_list = self.new_snapshot_tags(resource, tags, automated)
+        snapshot_id = self.build_snapshot_id(resource)
+
+        if automated is not None:
+            # A copy puts no load on the database, unlike a snapshot taken of it
+            print('Promoting automated snapshot ' + self.resolve_snapshot_name(automated))
+            current_snap = self.promote_snapshot(automated, snapshot_id, tag_list)
+        else:
+            current_snap = self.create_snapshot(resource, snapshot_id, tag_list)
+
+        # Keep the index in step so retention sees the snapshot just taken
+        snapshot_index.add(current_snap)
+        return current_snap
+
+    def create_snapshot(self, resource, snapshot_id, tags):
+        from botocore.exceptions import ClientError
+
+        try:
+            if 'DBClusterIdentifier' in resource:
+                return self.conn.create_db_cluster_snapshot(DBClusterIdentifier=self.resolve_backupable_id(resource),
+                                                            DBClusterSnapshotIdentifier=snapshot_id,
+                                                            Tags=tags)['DBClusterSnapshot']
+            return self.conn.create_db_snapshot(DBInstanceIdentifier=self.resolve_backupable_id(resource),
+                                                DBSnapshotIdentifier=snapshot_id,
+                                                Tags=tags)['DBSnapshot']
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in DB_STATE_ERROR_CODES:
+                raise
+
+            status = self.current_status(resource)
+            if status in DB_PASSING_STATUSES:
+                raise SnapshotDeferred('%s is %s' % (self.resolve_backupable_id(resource), status))
+            raise SnapshotRefused('%s is %s' % (self.resolve_backupable_id(resource), status))
+
+    def current_status(self, resource):
+        """
+        :return: the status of the database or cluster now, rather than when it was listed
+        """
+        resource_id = self.resolve_backupable_id(resource)
         if 'DBClusterIdentifier' in resource:
-            current_snap = self.conn.create_db_cluster_snapshot(
-                DBClusterIdentifier=self.resolve_backupable_id(resource),
-                DBClusterSnapshotIdentifier=snapshot_id,
-                Tags=aws_tagset)
+            return self.conn.describe_db_clusters(DBClusterIdentifier=resource_id)['DBClusters'][0]['Status']
+        return self.conn.describe_db_instances(DBInstanceIdentifier=resource_id)['DBInstances'][0]['DBInstanceStatus']
+
+    def promote_snapshot(self, automated, snapshot_id, tags):
+        """
+        Copy an automated snapshot as a manual one, which retention then looks after.
+
+        :return: the copy
+        """
+        if 'DBClusterSnapshotIdentifier' in automated:
+            snapshot = self.conn.copy_db_cluster_snapshot(
+                SourceDBClusterSnapshotIdentifier=automated['DBClusterSnapshotIdentifier'],
+                TargetDBClusterSnapshotIdentifier=snapshot_id,
+                Tags=tags)['DBClusterSnapshot']
         else:
-            current_snap = self.conn.create_db_snapshot(DBInstanceIdentifier=self.resolve_backupable_id(resource),
-                                                        DBSnapshotIdentifier=snapshot_id,
-                                                        Tags=aws_tagset)
-
-    def list_snapshots_for_resource(self, resource):
+            snapshot = self.conn.copy_db_snapshot(SourceDBSnapshotIdentifier=automated['DBSnapshotIdentifier'],
+                                                  TargetDBSnapshotIdentifier=snapshot_id,
+                                                  Tags=tags)['DBSnapshot']
+
+        # The next run in the period finds it was promoted by its tags
+        snapshot.setdefault('TagList', tags)
+        return snapshot
+
+    def planned_snapshot(self, resource, description, tags):
+        snapshot = {
+            'SnapshotCreateTime': datetime.now(UTC),
+            'TagList': self.new_snapshot_tags(resource, tags, self.snapshot_source(resource)),
+        }
         if 'DBClusterIdentifier' in resource:
-            snapshots = self.conn.describe_db_cluster_snapshots(
-                DBClusterIdentifier=self.resolve_backupable_id(resource),
-                SnapshotType='manual')
-            return snapshots['DBClusterSnapshots']
+            snapshot['DBClusterIdentifier'] = self.resolve_backupable_id(resource)
+            snapshot['DBClusterSnapshotIdentifier'] = self.build_snapshot_id(resource)
         else:
-            snapshots = self.conn.describe_db_snapshots(DBInstanceIdentifier=self.resolve_backupable_id(resource),
-                                                        SnapshotType='manual')
+            snapshot['DBInstanceIdentifier'] = self.resolve_backupable_id(resource)
+            snapshot['DBSnapshotIdentifier'] = self.build_snapshot_id(resource)
+        return snapshot
+
+    def iter_snapshots(self, snapshot_type='manual'):
+        print('Listing all %s snapshots in this account' % snapshot_type)
+        for page in self.list_pages('describe_db_cluster_snapshots', 'DBClusterSnapshots', SnapshotType=snapshot_type):
+            for snapshot in page['DBClusterSnapshots']:
+                yield snapshot
+        for page in self.list_pages('describe_db_snapshots', 'DBSnapshots', SnapshotType=snapshot_type):
+            for snapshot in page['DBSnapshots']:
+                yield snapshot
+
+    def replica(self, region_name):
+        return RDSBackupManager(rds_region_name=region_name, **self.replica_settings())
+
+    def copy_snapshot_from(self, snapshot, source_region, tags, kms_key_id=None):
+        params = {'SourceRegion': source_region, 'Tags': tags}
+        if kms_key_id:
+            params['KmsKeyId'] = kms_key_id
+
+        if 'DBClusterSnapshotIdentifier' in snapshot:
+            replica_snapshot = self.conn.copy_db_cluster_snapshot(
+                SourceDBClusterSnapshotIdentifier=snapshot['DBClusterSnapshotArn'],
+                TargetDBClusterSnapshotIdentifier=snapshot['DBClusterSnapshotIdentifier'],
+                **params)['DBClusterSnapshot']
+        else:
+            replica_snapshot = self.conn.copy_db_snapshot(
+                SourceDBSnapshotIdentifier=snapshot['DBSnapshotArn'],
+                TargetDBSnapshotIdentifier=snapshot['DBSnapshotIdentifier'],
+                **params)['DBSnapshot']
+
+        replica_snapshot['TagList'] = tags
+        return replica_snapshot
+
+    def export_inventory(self):
+        # Tags are written out with each database, so planning from the inventory never has to look them up
+        databases = [dict(database, TagList=self.tag_dict_to_list(self.get_resource_tags(database)))
+                     for database in self.get_backable_resources()]
+        snapshots = list(self.get_snapshot_index())
+
+        return {
+            'DBClusters': [database for database in databases if 'DBInstanceIdentifier' not in database],
+            'DBInstances': [database for database in databases if 'DBInstanceIdentifier' in database],
+            'DBClusterSnapshots': [snap for snap in snapshots if 'DBClusterSnapshotIdentifier' in snap],
+            'DBSnapshots': [snap for snap in snapshots if 'DBSnapshotIdentifier' in snap],
+            'ExistingResourceIds': self.snapshot_resource_ids(snapshots),
+        }
+
+    def snapshot_in_progress(self, snapshot):
+        return snapshot.get('Status') == 'creating'
+
+    def snapshot_completed(self, snapshot):
+        return snapshot.get('Status') == 'available'
 
-            return snapshots['DBSnapshots']
+    def describe_snapshots_by_id(self, snapshots):
+        cluster_ids = [snap['DBClusterSnapshotIdentifier'] for snap in snapshots
+                       if 'DBClusterSnapshotIdentifier' in snap]
+        instance_ids = [snap['DBSnapshotIdentifier'] for snap in snapshots if 'DBSnapshotIdentifier' in snap]
+
+        current = []
+        for operation_name, result_key, filter_name, snapshot_ids in (
+                ('describe_db_cluster_snapshots', 'DBClusterSnapshots', 'db-cluster-snapshot-id', cluster_ids),
+                ('describe_db_snapshots', 'DBSnapshots', 'db-snapshot-id', instance_ids)):
+            paginator = self.conn.get_paginator(operation_name)
+            for start in range(0, len(snapshot_ids), ID_FILTER_BATCH_SIZE):
+                batch = snapshot_ids[start:start + ID_FILTER_BATCH_SIZE]
+                for page in paginator.paginate(Filters=[{"Name": filter_name, "Values": batch}]):
+                    current.extend(page[result_key])
+        return current
 
     def resolve_backupable_id(self, resource):
         return resource.get("DBClusterIdentifier") or resource.get("DBInstanceIdentifier")
@@ -360,7 +3001,8 @@ class RDSBackupManager(BaseBackupManager):
         return resource.get('DBClusterSnapshotIdentifier') or resource.get('DBSnapshotIdentifier')
 
     def resolve_snapshot_time(self, resource):
-        now = datetime.utcnow()
+        # Snapshots still being created have no time yet, they are the newest there are
+        now = datetime.now(UTC)
         return resource.get('SnapshotCreateTime', now)
 
     def delete_snapshot(self, snapshot):
@@ -369,37 +3011,422 @@ class RDSBackupManager(BaseBackupManager):
         else:
             self.conn.delete_db_snapshot(DBSnapshotIdentifier=snapshot["DBSnapshotIdentifier"])
 
-    def db_has_tag(self, db_instance):
-        arn = self.build_arn(db_instance)
-        tags = self.conn.list_tags_for_resource(ResourceName=arn)['TagList']
-
-        for tag in tags:
-            if tag['Key'] == self.tag_name and tag['Value'] == self.tag_value:
-                return True
+        if self.snapshot_index is not None:
+            self.snapshot_index.discard(snapshot)
 
-        return False
+    def db_has_tag(self, db_instance):
+        return self.get_resource_tags(db_instance).get(self.tag_name) == self.tag_value
 
     def resolve_account_number(self):
-
-        if self.account_number is None:
-            groups = self.conn.describe_db_security_groups()['DBSecurityGroups']
-            if groups is None or len(groups) == 0:
-                self.account_number = 0
-            else:
-                self.account_number = groups[0]['OwnerId']
-
-        return self.account_number
+        return get_account_id(self.role_arn)
 
     def build_arn(self, instance):
         return self.build_arn_for_id(instance['DBInstanceIdentifier'])
 
-    def build_arn_for_id(self, instance_id):
+    def build_arn_for_id(self, instance_id, resource_type='db'):
         # "arn:aws:rds:<region>:<account number>:<resourcetype>:<name>"
 
         region = self.conn.meta.region_name
         account_number = self.resolve_account_number()
 
-        return "arn:aws:rds:{0}:{1}:db:{2}".format(region, account_number, instance_id)
+        return "arn:aws:rds:{0}:{1}:{2}:{3}".format(region, account_number, resource_type, instance_id)
+
+
+def load_checkpoint(backup_mgr, state_store, key=None):
+    """
+    Resume the manager from the cursor an earlier invocation saved.
+
+    :return: False when there is no cursor, meaning the manager already finished
+    """
+    key = key or backup_mgr.state_key
+    cursor = state_store.load(key)
+    if cursor is None:
+        print('Nothing left to resume for ' + key)
+        return False
+
+    backup_mgr.resume_from(cursor)
+    return True
+
+
+def save_checkpoint(backup_mgr, state_store, key=None):
+    """
+    Save the cursor of a run that stopped early, or clear it once the run completes.
+
+    :return: True when there is work left for another invocation
+    """
+    key = key or backup_mgr.state_key
+    if backup_mgr.cursor is None:
+        state_store.delete(key)
+        return False
+
+    state_store.save(key, backup_mgr.cursor)
+    return True
+
+
+def load_snapshot_index(backup_mgr, state_store, resync_runs=DEFAULT_RESYNC_RUNS,
+                        max_age_hours=DEFAULT_INDEX_MAX_AGE_HOURS):
+    """
+    Start the manager from the snapshot index an earlier run saved, refreshing the snapshots that
+    were in progress then, rather than listing every snapshot again.
+
+    :return: False when there is no index to start from, or it is due to be listed again in full
+    """
+    key = backup_mgr.index_state_key
+    state = state_store.load(key)
+    if state is None or state['keys'] != list(backup_mgr.snapshot_index_keys):
+        print('No snapshot index saved for ' + key)
+        return False
+
+    age = datetime.now(UTC) - parse_timestamp(state['watermark'])
+    if state['runs'] + 1 >= resync_runs or age > timedelta(hours=max_age_hours):
+        print('Listing every snapshot again, the index saved for %(key)s was listed %(runs)s runs ago' % {
+            'key': key,
+            'runs': state['runs'] + 1
+        })
+        return False
+
+    # Still dated by the last full listing, so max_age_hours counts from that rather than the last run
+    backup_mgr.index_watermark = parse_timestamp(state['watermark'])
+    backup_mgr.index_runs = state['runs'] + 1
+    backup_mgr.index_loaded = datetime.now(UTC)
+    index = backup_mgr.restore_snapshot_index(state)
+    refreshed = backup_mgr.refresh_snapshot_index(index)
+    backup_mgr.snapshot_index = index
+
+    print('Restored %(count)s snapshots from the index saved at %(saved)s, refreshing %(refreshed)s '
+          'in progress' % {'count': len(index), 'saved': state['saved'], 'refreshed': refreshed})
+    return True
+
+
+def save_snapshot_index(backup_mgr, state_store):
+    """
+    Save the manager's snapshot index for the next run. When another run saved the index after this one
+    listed or restored it, this run's changes are made to that one instead, so neither run's are lost.
+    """
+    index = backup_mgr.snapshot_index
+    if index is None:
+        return
+
+    key = backup_mgr.index_state_key
+    stored = state_store.load(key)
+    if stored is not None and stored['keys'] == list(backup_mgr.snapshot_index_keys) and \
+            stored['saved'] > format_timestamp(backup_mgr.index_loaded):
+        print('Merging into the snapshot index saved for %s by another run' % key)
+        merged = backup_mgr.restore_snapshot_index(stored)
+        merged.replay(index.journal)
+
+        state = backup_mgr.snapshot_index_state(merged)
+        state.update(watermark=stored['watermark'], runs=max(stored['runs'], backup_mgr.index_runs))
+    else:
+        state = backup_mgr.snapshot_index_state(index)
+
+    state_store.save(key, state)
+
+
+def run_sweep(backup_mgr, settings, state_store, resume=False):
+    """
+    Sweep the orphaned snapshots with the manager, after any backup it ran.
+
+    :return: the result of the sweep, None when resuming a sweep that already finished,
+             and whether there is work left for another invocation
+    """
+    # The backup's own resume point has nothing to do with the sweep's
+    backup_mgr.resume_phases = None
+    if resume and not load_checkpoint(backup_mgr, state_store, backup_mgr.sweep_state_key):
+        return None, False
+
+    metrics = backup_mgr.sweep_orphans(**settings)
+
+    sweep_result = {"metrics": metrics, "report": backup_mgr.message}
+    if backup_mgr.plan_only:
+        sweep_result["deletes"] = backup_mgr.changes['deletes']
+        return sweep_result, False
+
+    return sweep_result, save_checkpoint(backup_mgr, state_store, backup_mgr.sweep_state_key)
+
+
+MANAGER_CLASSES = {
+    'ec2': EC2BackupManager,
+    'rds': RDSBackupManager,
+}
+
+SERVICE_LABELS = {
+    'ec2': 'EC2',
+    'rds': 'RDS',
+}
+
+
+def build_targets(event):
+    """
+    Every service, region and account the event covers. Region names can be given as one
+    name or a list, and role_arns lists the roles to assume into other accounts, where a
+    null entry stands for the execution role's own account.
+
+    :return: a list of (service name, region name, role ARN)
+    """
+    targets = []
+    for role_arn in event.get('role_arns') or [None]:
+        for service_name in sorted(MANAGER_CLASSES):
+            region_names = event.get(service_name + '_region_name') or []
+            if not isinstance(region_names, list):
+                region_names = [region_names]
+
+            for region_name in region_names:
+                targets.append((service_name, region_name, role_arn))
+    return targets
+
+
+def merge_stats(stats_list):
+    """
+    Combine latency stats, adding up the counts. Percentiles can not be added up, so the
+    merged latencies are the worst of any of them.
+    """
+    merged = {}
+    for stats in stats_list:
+        for name, values in stats.items():
+            totals = merged.setdefault(name, {})
+            for key, value in values.items():
+                if key.endswith('_ms'):
+                    totals[key] = max(totals.get(key, 0), value)
+                else:
+                    totals[key] = totals.get(key, 0) + value
+    return merged
+
+
+def merge_metrics(metrics_list):
+    """
+    Combine the metrics of several managers into one set for the whole run.
+    """
+    if len(metrics_list) == 1:
+        return metrics_list[0]
+
+    merged = {}
+    for metrics in metrics_list:
+        for key, value in metrics.items():
+            if key.startswith('total_'):
+                merged[key] = merged.get(key, 0) + value
+
+    if 'api_calls_per_resource' in metrics_list[0]:
+        resources = merged['total_resources']
+        merged['api_calls_per_resource'] = round(float(merged['total_api_calls']) / resources, 2) if resources else 0
+    for key in ('api_calls', 'phase_timings'):
+        if key in metrics_list[0]:
+            merged[key] = merge_stats([metrics[key] for metrics in metrics_list])
+    return merged
+
+
+def run_target(target, settings, state_store, resume=False, sweep=None, sweep_only=False, inventory=None,
+               snapshot_index=None):
+    """
+    Back up, and sweep, a single service in a single region and account. Failures are
+    reported in the outcome, so they never stop the other targets.
+
+    :return: the outcome of the target
+    """
+    service_name, region_name, role_arn = target
+    outcome = {
+        'service': service_name,
+        'region': region_name,
+        'role_arn': role_arn,
+        'metrics': None,
+        'report': '',
+        'errmsg': '',
+        'plan': None,
+        'sweep': None,
+        'incomplete': False,
+    }
+
+    try:
+        backup_mgr = MANAGER_CLASSES[service_name](role_arn=role_arn,
+                                                   inventory=inventory,
+                                                   **dict(settings, **{service_name + '_region_name': region_name}))
+
+        # An inventory is a listing of its own, there is nothing to restore or save
+        persist_index = snapshot_index is not None and inventory is None
+        if persist_index:
+            load_snapshot_index(backup_mgr, state_store, **snapshot_index)
+
+        if not sweep_only and (not resume or load_checkpoint(backup_mgr, state_store)):
+            outcome['metrics'] = backup_mgr.process_backup()
+            outcome['report'] = backup_mgr.message
+            backup_mgr.emit_metrics(outcome['metrics'])
+
+            # A plan changes nothing, so there is nothing to resume
+            if backup_mgr.plan_only:
+                outcome['plan'] = backup_mgr.changes
+            else:
+                outcome['incomplete'] = save_checkpoint(backup_mgr, state_store)
+
+        if sweep is not None:
+            outcome['sweep'], sweep_incomplete = run_sweep(backup_mgr, sweep, state_store, resume)
+            outcome['incomplete'] = outcome['incomplete'] or sweep_incomplete
+
+        if persist_index and not backup_mgr.plan_only:
+            save_snapshot_index(backup_mgr, state_store)
+
+        outcome['errmsg'] = backup_mgr.errmsg
+    except Exception as e:
+        print("Unexpected error:", sys.exc_info()[0])
+        print(e)
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                  limit=2, file=sys.stdout)
+        outcome['errmsg'] += 'Error in processing %(service)s in %(region)s: %(error)s\n' % {
+            'service': service_name,
+            'region': region_name,
+            'error': e
+        }
+
+    return outcome
+
+
+def report_heading(outcome):
+    heading = '%s %s' % (SERVICE_LABELS[outcome['service']], outcome['region'])
+    if outcome['role_arn']:
+        heading += ' as ' + outcome['role_arn']
+    return '==== %s ====\n' % heading
+
+
+def merge_reports(outcomes, report_func):
+    """
+    Join the reports of several targets, each under a heading naming it once there is more than one.
+    """
+    if len(outcomes) == 1:
+        return report_func(outcomes[0])
+    return '\n'.join(report_heading(outcome) + report_func(outcome) for outcome in outcomes)
+
+
+def publish(topic_arn, message, subject):
+    # The topic can be in any region, its ARN says which
+    print('Publishing to ' + topic_arn)
+    get_client('sns', region_name=topic_arn.split(':')[3]).publish(TopicArn=topic_arn,
+                                                                  Message=truncate_message(message),
+                                                                  Subject=subject)
+
+
+def invoke_continuation(context, payload):
+    function_arn = getattr(context, 'invoked_function_arn', None)
+    if not function_arn:
+        print('Unable to continue automatically, no function to invoke')
+        return
+
+    print('Invoking ' + function_arn + ' to continue the run')
+    get_client('lambda').invoke(FunctionName=function_arn, InvocationType='Event', Payload=json.dumps(payload))
+
+
+def invoke_shard(context, payload):
+    """
+    Run a shard as an invocation of the function and wait for its result, or run it right here
+    when there is no function to invoke, as from the command line.
+    """
+    function_arn = getattr(context, 'invoked_function_arn', None)
+    if not function_arn:
+        return json.loads(lambda_handler(payload, context))
+
+    # Never sent again, a shard whose invocation timed out or lost its connection may well still be
+    # running, and a second copy would snapshot the same resources and race it on its checkpoint.
+    # The coordinator reports the failure as the shard's error instead
+    print('Invoking %s for shard %s' % (function_arn, payload['shard_index']))
+    response = get_client('lambda', retries={'max_attempts': 0}).invoke(FunctionName=function_arn,
+                                                                        InvocationType='RequestResponse',
+                                                                        Payload=json.dumps(payload))
+    body = response['Payload'].read().decode('utf-8')
+    if response.get('FunctionError'):
+        raise RuntimeError('shard %s failed: %s' % (payload['shard_index'], body))
+
+    # The handler hands back its result already encoded as JSON
+    return json.loads(json.loads(body))
+
+
+def coordinate_shards(event, context):
+    """
+    Run every shard of the event at once and merge their results into one, which is published as
+    the one report for them all. The shards publish their own errors.
+
+    :return: the merged result
+    """
+    shard_count = event['shard_count']
+    plan_only = event.get('mode', 'backup') == 'plan' or bool(event.get('inventory'))
+
+    shard_events = []
+    for shard_index in range(shard_count):
+        shard_event = dict(event, shard_index=shard_index)
+        shard_event.pop('arn', None)
+
+        # The shards stop taking on work earlier, leaving the coordinator time to merge their results
+        shard_event['deadline_margin'] = 2 * event.get('deadline_margin', 30)
+        shard_events.append(shard_event)
+
+    def run(shard_event):
+        try:
+            return invoke_shard(context, shard_event), None
+        except Exception as e:
+            print("Unexpected error:", sys.exc_info()[0])
+            print(e)
+            return None, e
+
+    executor = ThreadPoolExecutor(max_workers=shard_count)
+    try:
+        outcomes = list(executor.map(run, shard_events))
+    finally:
+        executor.shutdown(wait=True)
+
+    result = event
+    result['shards'] = []
+    errors = []
+    for shard_index, (shard_result, error) in enumerate(outcomes):
+        shard = {'shard_index': shard_index, 'metrics': (shard_result or {}).get('metrics')}
+        if error is not None:
+            shard['error'] = str(error)
+            errors.append('Error in processing shard %s: %s\n' % (shard_index, error))
+        if shard_result and 'continuation' in shard_result:
+            shard['continuation'] = shard_result['continuation']
+        result['shards'].append(shard)
+
+    results = [(shard_index, shard_result) for shard_index, (shard_result, error) in enumerate(outcomes)
+               if shard_result is not None]
+
+    metrics = [shard_result['metrics'] for shard_index, shard_result in results if 'metrics' in shard_result]
+    if metrics:
+        result['metrics'] = merge_metrics(metrics)
+
+    def merge_shard_reports(reports):
+        return '\n'.join('==== Shard %s of %s ====\n' % (shard_index + 1, shard_count) + report
+                         for shard_index, report in reports)
+
+    for service_name in sorted(MANAGER_CLASSES):
+        report_key = service_name + '_backup_result'
+        reports = [(shard_index, shard_result[report_key]) for shard_index, shard_result in results
+                   if report_key in shard_result]
+        if reports:
+            result[report_key] = merge_shard_reports(reports)
+
+        sweeps = [(shard_index, shard_result['sweep'][service_name]) for shard_index, shard_result in results
+                  if service_name in shard_result.get('sweep', {})]
+        if sweeps:
+            sweep_result = {
+                'metrics': merge_metrics([sweep['metrics'] for shard_index, sweep in sweeps]),
+                'report': merge_shard_reports((shard_index, sweep['report']) for shard_index, sweep in sweeps),
+            }
+            if plan_only:
+                sweep_result['deletes'] = [delete for shard_index, sweep in sweeps for delete in sweep['deletes']]
+            result.setdefault('sweep', {})[service_name] = sweep_result
+
+        plans = [shard_result['plan'][service_name] for shard_index, shard_result in results
+                 if service_name in shard_result.get('plan', {})]
+        if plans:
+            service_plan = {}
+            for plan in plans:
+                for key, changes in plan.items():
+                    service_plan.setdefault(key, []).extend(changes)
+            result.setdefault('plan', {})[service_name] = service_plan
+
+        if event.get('arn') and reports and not plan_only:
+            publish(event['arn'], result[report_key], 'Finished AWS %s snapshotting' % SERVICE_LABELS[service_name])
+
+    if errors and event.get('error_arn'):
+        publish(event['error_arn'], ''.join(errors), 'Error with AWS Snapshot')
+    return result
 
 
 def lambda_handler(event, context={}):
@@ -409,15 +3436,39 @@ def lambda_handler(event, context={}):
             "period_label": "day",
             "period_format": "%a%H",
 
-            "ec2_region_name": "ap-southeast-2",
+            "ec2_region_name": ["ap-southeast-2", "us-east-1"],
             "rds_region_name": "ap-southeast-2",
+            "role_arns": [null, "arn:aws:iam::123456789012:role/backuplambda"],
+            "parallel_targets": 4,
 
             "tag_name": "MakeSnapshot",
             "tag_value": "True",
 
             "arn": "blart",
 
-            "keep_count": 12
+            "keep_count": 12,
+            "retention": {"day": 14, "week": 12, "month": 6},
+
+            "max_workers": 16,
+            "delete_workers": 4,
+            "instance_snapshots": true,
+            "max_pending_snapshots": 50,
+            "promote_automated": {"max_age_hours": 24},
+            "api_rate_limits": {"describe": 20, "mutate": 5, "DeleteSnapshot": 2},
+
+            "state_store": "s3://bucket/backuplambda/",
+            "snapshot_index": {"resync_runs": 24, "max_age_hours": 48},
+            "deadline_margin": 30,
+            "auto_continue": true,
+
+            "shard_count": 4,
+            "shard_index": 0,
+
+            "mode": "plan",
+            "inventory": "inventory.json",
+
+            "sweep": {"grace_days": 30, "keep_count": 1},
+            "copy": {"region": "us-west-2", "max_in_flight": 5, "keep_count": 7}
         }
     :param event:
     :param context:
@@ -426,76 +3477,217 @@ def lambda_handler(event, context={}):
 
     print("Received event: " + json.dumps(event, indent=2))
 
-    period = event["period_label"]
-    period_format = event["period_format"]
+    # A continuation runs in a container of its own, which only a durable store hands the cursors on to
+    if (event.get('resume') or event.get('auto_continue')) and \
+            build_state_store(event.get('state_store')) is MEMORY_STATE_STORE:
+        raise ValueError('resume and auto_continue need a state_store that outlives the container, '
+                         'such as s3://bucket/prefix/')
 
-    tag_name = event['tag_name']
-    tag_value = event['tag_value']
+    # An event split into shards without saying which one to run is handed out to all of them
+    shard_count = event.get('shard_count', 1)
+    if shard_count > 1 and 'shard_index' not in event:
+        return json.dumps(coordinate_shards(event, context), indent=2)
+    if not 0 <= event.get('shard_index', 0) < shard_count:
+        raise ValueError('shard_index must be from 0 to shard_count - 1')
 
-    ec2_region_name = event.get('ec2_region_name', None)
-    rds_region_name = event.get('rds_region_name', None)
+    # Copy the event before the results are added, it is the basis for any continuation
+    continuation = dict(event)
+
+    period = event["period_label"]
+    period_format = event["period_format"]
 
     sns_arn = event.get('arn')
     error_sns_arn = event.get('error_arn')
-    keep_count = event['keep_count']
 
-    date_suffix = datetime.today().strftime(period_format)
+    # Each service, region and account, run a few at a time
+    targets = build_targets(event)
+    parallel_targets = event.get('parallel_targets', 4)
+
+    # API rate limits apply per account and region, so each of those gets its own limiter
+    # shared by both services
+    rate_limiters = {}
+    for service_name, region_name, role_arn in targets:
+        if (region_name, role_arn) not in rate_limiters:
+            rate_limiters[(region_name, role_arn)] = ApiRateLimiter(rates=event.get('api_rate_limits'),
+                                                                    max_attempts=event.get('api_max_attempts', 8))
+
+    state_store = build_state_store(event.get('state_store'))
+    resume = event.get('resume', False)
+
+    # A plan works out the creates and deletes without making them, from the account or a saved inventory
+    inventory = None
+    if event.get('inventory'):
+        with open(event['inventory']) as fp:
+            inventory = load_inventory(fp)
+    plan_only = event.get('mode', 'backup') == 'plan' or inventory is not None
+
+    # Orphaned snapshots are swept after the backups, or on their own in sweep mode
+    sweep_only = event.get('mode') == 'sweep'
+    sweep = event.get('sweep', {} if sweep_only else None)
+
+    # The snapshot listings are saved between runs and refreshed, rather than listed in full every time
+    snapshot_index = event.get('snapshot_index')
+
+    settings = {
+        'period': period,
+        'tag_name': event['tag_name'],
+        'tag_value': event['tag_value'],
+        'date_suffix': datetime.today().strftime(period_format),
+        'keep_count': event.get('keep_count'),
+        'retention': event.get('retention'),
+        'max_workers': event.get('max_workers', 1),
+        'delete_workers': event.get('delete_workers'),
+        # Stop taking on new work when the invocation is about to time out
+        'time_remaining': getattr(context, 'get_remaining_time_in_millis', None),
+        'deadline_margin': event.get('deadline_margin', 30),
+        'page_size': event.get('page_size'),
+        'plan_only': plan_only,
+        'max_pending_snapshots': event.get('max_pending_snapshots'),
+        'copy': event.get('copy'),
+        'shard_index': event.get('shard_index', 0),
+        'shard_count': shard_count,
+    }
+
+    # Options only one of the services takes
+    service_settings = {
+        'ec2': {'instance_snapshots': event.get('instance_snapshots', False)},
+        'rds': {'promote_automated': event.get('promote_automated')},
+    }
+
+    def run(target):
+        service_name, region_name, role_arn = target
+        return run_target(target, dict(settings, rate_limiter=rate_limiters[(region_name, role_arn)],
+                                       **service_settings.get(service_name, {})),
+                          state_store, resume=resume, sweep=sweep, sweep_only=sweep_only,
+                          inventory=inventory.get(service_name, {}) if inventory is not None else None,
+                          snapshot_index=snapshot_index)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(parallel_targets, len(targets))))
+    try:
+        outcomes = list(executor.map(run, targets))
+    finally:
+        executor.shutdown(wait=True)
 
     result = event
-    if ec2_region_name:
-        backup_mgr = EC2BackupManager(ec2_region_name=ec2_region_name,
-                                      period=period,
-                                      tag_name=tag_name,
-                                      tag_value=tag_value,
-                                      date_suffix=date_suffix,
-                                      keep_count=keep_count)
-
-        metrics = backup_mgr.process_backup()
-
-        result["metrics"] = metrics
-        result["ec2_backup_result"] = backup_mgr.message
-        print('\n' + backup_mgr.message + '\n')
-
-        sns_boto = None
-
-        # Connect to SNS
-        if sns_arn or error_sns_arn:
-            print('Connecting to SNS')
-            sns_boto = boto3.client('sns', region_name=ec2_region_name)
-
-        if error_sns_arn and backup_mgr.errmsg:
-            sns_boto.publish(TopicArn=error_sns_arn, Message='Error in processing volumes: ' + backup_mgr.errmsg,
-                             Subject='Error with AWS Snapshot')
-
-        if sns_arn:
-            sns_boto.publish(TopicArn=sns_arn, Message=backup_mgr.message, Subject='Finished AWS EC2 snapshotting')
-
-    if rds_region_name:
-        backup_mgr = RDSBackupManager(rds_region_name=rds_region_name,
-                                      period=period,
-                                      tag_name=tag_name,
-                                      tag_value=tag_value,
-                                      date_suffix=date_suffix,
-                                      keep_count=keep_count)
-
-        metrics = backup_mgr.process_backup()
-
-        result["metrics"] = metrics
-        result["rds_backup_result"] = backup_mgr.message
-        print('\n' + backup_mgr.message + '\n')
-
-        sns_boto = None
+    if len(targets) > 1:
+        result["targets"] = [dict((key, outcome[key]) for key in ('service', 'region', 'role_arn', 'metrics'))
+                             for outcome in outcomes]
+
+    backups = [outcome for outcome in outcomes if outcome['metrics'] is not None]
+    if backups:
+        result["metrics"] = merge_metrics([outcome['metrics'] for outcome in backups])
+
+    for service_name in sorted(MANAGER_CLASSES):
+        service_outcomes = [outcome for outcome in outcomes if outcome['service'] == service_name]
+        service_backups = [outcome for outcome in service_outcomes if outcome['metrics'] is not None]
+        service_sweeps = [outcome for outcome in service_outcomes if outcome['sweep'] is not None]
+
+        if service_backups:
+            result[service_name + "_backup_result"] = merge_reports(service_backups, lambda outcome: outcome['report'])
+
+        if service_sweeps:
+            sweep_result = {
+                "metrics": merge_metrics([outcome['sweep']['metrics'] for outcome in service_sweeps]),
+                "report": merge_reports(service_sweeps, lambda outcome: outcome['sweep']['report']),
+            }
+            if plan_only:
+                sweep_result["deletes"] = [delete for outcome in service_sweeps
+                                           for delete in outcome['sweep']['deletes']]
+            result.setdefault("sweep", {})[service_name] = sweep_result
+
+        # A plan changes nothing, so there is nothing to announce
+        if plan_only:
+            if service_backups:
+                service_plan = {}
+                for key in ('creates', 'deletes', 'copies', 'copy_deletes'):
+                    if any(key in outcome['plan'] for outcome in service_backups):
+                        service_plan[key] = [change for outcome in service_backups
+                                             for change in outcome['plan'].get(key, [])]
+                result.setdefault("plan", {})[service_name] = service_plan
+            continue
+
+        failures = [outcome for outcome in service_outcomes if outcome['errmsg']]
+        if error_sns_arn and failures:
+            errmsg = merge_reports(failures, lambda outcome: outcome['errmsg'])
+            publish(error_sns_arn, 'Error in processing %s: %s' % (SERVICE_LABELS[service_name], errmsg),
+                    'Error with AWS Snapshot')
+
+        if sns_arn and service_backups:
+            publish(sns_arn, result[service_name + "_backup_result"],
+                    'Finished AWS %s snapshotting' % SERVICE_LABELS[service_name])
+
+    # Hand back what a follow up invocation needs to pick up where this one stopped
+    if any(outcome['incomplete'] for outcome in outcomes) and state_store is MEMORY_STATE_STORE:
+        print('Stopped early with nowhere durable to save the rest, it is left to the next scheduled run')
+    elif any(outcome['incomplete'] for outcome in outcomes):
+        continuation["resume"] = True
+        result["continuation"] = continuation
+
+        if event.get('auto_continue'):
+            invoke_continuation(context, continuation)
 
-        # Connect to SNS
-        if sns_arn or error_sns_arn:
-            print('Connecting to SNS')
-            sns_boto = boto3.client('sns', region_name=rds_region_name)
+    return json.dumps(result, indent=2)
 
-        if error_sns_arn and backup_mgr.errmsg:
-            sns_boto.publish(TopicArn=error_sns_arn, Message='Error in processing RDS: ' + backup_mgr.errmsg,
-                             Subject='Error with AWS Snapshot')
 
-        if sns_arn:
-            sns_boto.publish(TopicArn=sns_arn, Message=backup_mgr.message, Subject='Finished AWS RDS snapshotting')
+def main(argv=None):
+    """
+    Run the function from the command line, mostly to check a plan before a deploy, e.g.
 
-    return json.dumps(result, indent=2)
+        python backuplambda.py event.json --export-inventory inventory.json
+        python backuplambda.py event.json --inventory inventory.json > plan.json
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Snapshot and rotate tagged EBS volumes and RDS databases.')
+    parser.add_argument('event', help='JSON file with the event to run, as the schedule would pass it')
+    parser.add_argument('--plan', action='store_true',
+                        help='print the snapshots that would be created and deleted, without making any changes')
+    parser.add_argument('--inventory', help='plan from an inventory saved by --export-inventory')
+    parser.add_argument('--export-inventory', metavar='FILE',
+                        help='save the volumes, databases and snapshots a plan works from, then exit')
+    args = parser.parse_args(argv)
+
+    with open(args.event) as event_file:
+        event = json.load(event_file)
+
+    if args.export_inventory:
+        inventory = {}
+        settings = dict(period=event['period_label'],
+                        tag_name=event['tag_name'],
+                        tag_value=event['tag_value'],
+                        date_suffix=None,
+                        keep_count=event.get('keep_count'),
+                        retention=event.get('retention'),
+                        page_size=event.get('page_size'))
+
+        for service_name, region_name, role_arn in build_targets(event):
+            if service_name in inventory:
+                parser.error('an inventory holds a single region and account for each service')
+
+            backup_mgr = MANAGER_CLASSES[service_name](role_arn=role_arn,
+                                                       **dict(settings, **{service_name + '_region_name': region_name}))
+            inventory[service_name] = backup_mgr.export_inventory()
+
+        with open(args.export_inventory, 'w') as inventory_file:
+            dump_inventory(inventory, inventory_file)
+        return 0
+
+    if args.plan or args.inventory:
+        event['mode'] = 'plan'
+    if args.inventory:
+        event['inventory'] = args.inventory
+
+    # The run reports progress with print, keep stdout for the result
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        result = json.loads(lambda_handler(event))
+    finally:
+        sys.stdout = stdout
+
+    print(json.dumps(result.get('plan', result), indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,740 @@
+"""
+Scale benchmark for the backup managers.
+
+Fills an in-memory stand in for EC2 and RDS with a fleet of volumes, databases,
+Aurora clusters and existing snapshots, drives lambda_handler end to end against
+it and reports wall time, peak memory and API calls per resource. The run fails
+when the calls made go over the budget committed in benchmark_budget.json.
+
+    PYTHONPATH=lambda python tests/benchmark.py --sizes 100 1000 10000
+
+The fake clients emit the same botocore events as real ones, so the rate limiter
+and the API call stats run exactly as they would against AWS, and latency and
+throttling can be injected to see how the managers hold up.
+"""
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import botocore.session
+from botocore.exceptions import ClientError
+from botocore.hooks import HierarchicalEmitter, first_non_none_response
+from dateutil.tz import tzutc
+
+import backuplambda
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+ACCOUNT_ID = '123456789012'
+
+BUDGET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_budget.json')
+
+_botocore_session = botocore.session.get_session()
+
+
+class FakeHttpResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeMeta(object):
+    def __init__(self, service_name, region_name):
+        self.events = HierarchicalEmitter()
+        self.region_name = region_name
+        self.service_model = _botocore_session.get_service_model(service_name)
+
+
+class FakePaginator(object):
+    def __init__(self, client, operation_name):
+        self.client = client
+        self.operation_name = operation_name
+        self.config = _botocore_session.get_paginator_model(client.service_name).get_paginator(operation_name)
+
+    def paginate(self, PaginationConfig=None, **kwargs):
+        params = dict(kwargs)
+        page_size = (PaginationConfig or {}).get('PageSize')
+        if page_size:
+            params[self.config['limit_key']] = page_size
+
+        while True:
+            page = self.client.make_api_call(self.operation_name, params)
+            yield page
+
+            token = page.get(self.config['output_token'])
+            if not token:
+                return
+            params[self.config['input_token']] = token
+
+
+class FakeClient(object):
+    """
+    Stands in for a boto3 client, handing calls to the FakeBackend while emitting
+    the botocore events the managers hook into.
+    """
+
+    def __init__(self, backend, service_name, region_name):
+        self.backend = backend
+        self.service_name = service_name
+        self.meta = FakeMeta(service_name, region_name)
+        self.operations = dict((botocore.xform_name(name), name)
+                               for name in self.meta.service_model.operation_names)
+
+    def __getattr__(self, name):
+        if name not in self.operations:
+            raise AttributeError(name)
+        operation_name = self.operations[name]
+        return lambda **kwargs: self.make_api_call(operation_name, kwargs)
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(self, self.operations[operation_name])
+
+    def make_api_call(self, operation_name, params):
+        model = self.meta.service_model.operation_model(operation_name)
+        suffix = '%s.%s' % (self.service_name, operation_name)
+        events = self.meta.events
+
+        events.emit('before-call.' + suffix, model=model, params=params, request_signer=None, context={})
+
+        attempts = 0
+        while True:
+            attempts += 1
+            events.emit('request-created.' + suffix, request=None, operation_name=operation_name)
+            response = self.backend.call(self.service_name, self.meta.region_name, operation_name, params)
+
+            delay = first_non_none_response(events.emit('needs-retry.' + suffix, response=response, endpoint=None,
+                                                         operation=model, attempts=attempts,
+                                                         caught_exception=None, request_dict={}))
+            if delay is None:
+                break
+            time.sleep(delay * self.backend.backoff_scale)
+
+        http_response, parsed = response
+        events.emit('after-call.' + suffix, http_response=http_response, parsed=parsed, model=model, context={})
+
+        if http_response.status_code >= 300:
+            raise ClientError(parsed, operation_name)
+        return parsed
+
+
+def page(params, items, result_key, token_key, limit_key, default_limit):
+    """
+    Slice a listing into a page the way the AWS APIs do, with an opaque offset token.
+    """
+    start = int(params.get(token_key) or 0)
+    limit = int(params.get(limit_key) or default_limit)
+
+    response = {result_key: items[start:start + limit]}
+    if start + limit < len(items):
+        response[token_key] = str(start + limit)
+    return response
+
+
+def tag_filter_values(params, name):
+    for filter_spec in params.get('Filters', []):
+        if filter_spec['Name'] == name:
+            return set(filter_spec['Values'])
+    return None
+
+
+class FakeBackend(object):
+    """
+    In-memory EC2 and RDS state for a single account, with injectable latency and throttling.
+    """
+
+    def __init__(self, latency=0, throttle_rate=0, backoff_scale=1.0, seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.backoff_scale = backoff_scale
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+        self.volumes = {}
+        self.instances = {}
+        self.snapshots = {}
+        self.db_instances = {}
+        self.db_clusters = {}
+        self.db_snapshots = {}
+        self.db_cluster_snapshots = {}
+
+        self.calls = {}
+
+    def next_id(self, prefix):
+        return '%s-%08x' % (prefix, next(self.ids))
+
+    def arn(self, region_name, resource_type, resource_id):
+        return 'arn:aws:rds:%s:%s:%s:%s' % (region_name, ACCOUNT_ID, resource_type, resource_id)
+
+    def call(self, service_name, region_name, operation_name, params):
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            key = '%s.%s' % (service_name, operation_name)
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+            if self.throttle_rate and self.random.random() < self.throttle_rate:
+                return FakeHttpResponse(400), {'Error': {'Code': 'RequestLimitExceeded', 'Message': 'Throttled'}}
+
+            handler = getattr(self, 'handle_%s_%s' % (service_name, botocore.xform_name(operation_name)), None)
+            if handler is None:
+                raise NotImplementedError(key)
+            try:
+                return FakeHttpResponse(200), handler(region_name, params)
+            except KeyError as e:
+                return FakeHttpResponse(400), {'Error': {'Code': 'NotFound', 'Message': str(e)}}
+
+    # Fleet setup
+
+    def add_volume(self, tags, snapshot_count=0, snapshot_tags=None, age_days=0):
+        volume_id = self.next_id('vol')
+        self.volumes[volume_id] = {
+            'VolumeId': volume_id,
+            'Size': 100,
+            'State': 'in-use',
+            'Tags': [{'Key': k, 'Value': v} for k, v in tags.items()],
+        }
+        for i in range(snapshot_count):
+            snapshot_id = self.next_id('snap')
+            self.snapshots[snapshot_id] = {
+                'SnapshotId': snapshot_id,
+                'VolumeId': volume_id,
+                'OwnerId': ACCOUNT_ID,
+                'State': 'completed',
+                'StartTime': datetime.now(tzutc()) - timedelta(days=age_days + i + 1),
+                'Description': 'day_snapshot %s_day_old by snapshot script' % volume_id,
+                'Tags': [{'Key': k, 'Value': v} for k, v in (snapshot_tags or {}).items()],
+            }
+        return volume_id
+
+    def add_instance(self, volume_ids):
+        instance_id = self.next_id('i')
+        mappings = []
+        for index, volume_id in enumerate(volume_ids):
+            device_name = '/dev/sd' + chr(ord('a') + index)
+            mappings.append({'DeviceName': device_name, 'Ebs': {'VolumeId': volume_id, 'Status': 'attached'}})
+            self.volumes[volume_id]['Attachments'] = [{'InstanceId': instance_id, 'VolumeId': volume_id,
+                                                       'Device': device_name, 'State': 'attached'}]
+
+        self.instances[instance_id] = {
+            'InstanceId': instance_id,
+            'RootDeviceName': '/dev/sda',
+            'BlockDeviceMappings': mappings,
+        }
+        return instance_id
+
+    def add_db_snapshot(self, region_name, db_instance_id, created, tags=None, snapshot_type='manual',
+                        snapshot_id=None, status='available'):
+        snapshot_id = snapshot_id or 'day-%s-%s' % (db_instance_id, self.next_id('snap'))
+        self.db_snapshots[snapshot_id] = {
+            'DBSnapshotIdentifier': snapshot_id,
+            'DBSnapshotArn': self.arn(region_name, 'snapshot', snapshot_id),
+            'DBInstanceIdentifier': db_instance_id,
+            'SnapshotCreateTime': created,
+            'SnapshotType': snapshot_type,
+            'Status': status,
+            'TagList': [{'Key': k, 'Value': v} for k, v in (tags or {}).items()],
+        }
+        return snapshot_id
+
+    def add_db_cluster_snapshot(self, region_name, db_cluster_id, created, tags=None, snapshot_type='manual',
+                                snapshot_id=None, status='available'):
+        snapshot_id = snapshot_id or 'day-%s-%s' % (db_cluster_id, self.next_id('snap'))
+        self.db_cluster_snapshots[snapshot_id] = {
+            'DBClusterSnapshotIdentifier': snapshot_id,
+            'DBClusterSnapshotArn': self.arn(region_name, 'cluster-snapshot', snapshot_id),
+            'DBClusterIdentifier': db_cluster_id,
+            'SnapshotCreateTime': created,
+            'SnapshotType': snapshot_type,
+            'Status': status,
+            'TagList': [{'Key': k, 'Value': v} for k, v in (tags or {}).items()],
+        }
+        return snapshot_id
+
+    def add_db_instance(self, region_name, tags, snapshot_count=0, cluster_id=None):
+        db_instance_id = self.next_id('db')
+        db_instance = {
+            'DBInstanceIdentifier': db_instance_id,
+            'DBInstanceArn': self.arn(region_name, 'db', db_instance_id),
+            'DBInstanceStatus': 'available',
+            'TagList': [{'Key': k, 'Value': v} for k, v in tags.items()],
+        }
+        if cluster_id:
+            db_instance['DBClusterIdentifier'] = cluster_id
+        self.db_instances[db_instance_id] = db_instance
+
+        for i in range(snapshot_count):
+            self.add_db_snapshot(region_name, db_instance_id, datetime.now(tzutc()) - timedelta(days=i + 1))
+        return db_instance_id
+
+    def add_db_cluster(self, region_name, tags, member_count=2, snapshot_count=0):
+        db_cluster_id = self.next_id('cluster')
+        self.db_clusters[db_cluster_id] = {
+            'DBClusterIdentifier': db_cluster_id,
+            'DBClusterArn': self.arn(region_name, 'cluster', db_cluster_id),
+            'Status': 'available',
+            'TagList': [{'Key': k, 'Value': v} for k, v in tags.items()],
+        }
+        for i in range(member_count):
+            self.add_db_instance(region_name, {}, cluster_id=db_cluster_id)
+
+        for i in range(snapshot_count):
+            self.add_db_cluster_snapshot(region_name, db_cluster_id, datetime.now(tzutc()) - timedelta(days=i + 1))
+        return db_cluster_id
+
+    def complete_snapshots(self):
+        """
+        Finish every snapshot still in progress, as the time between scheduled runs would.
+        """
+        with self.lock:
+            for snapshots, key, done in ((self.snapshots, 'State', 'completed'),
+                                         (self.db_snapshots, 'Status', 'available'),
+                                         (self.db_cluster_snapshots, 'Status', 'available')):
+                for snapshot_id, snapshot in list(snapshots.items()):
+                    snapshots[snapshot_id] = dict(snapshot, **{key: done})
+
+    # STS
+
+    def handle_sts_get_caller_identity(self, region_name, params):
+        return {'Account': ACCOUNT_ID, 'Arn': 'arn:aws:iam::%s:role/backup' % ACCOUNT_ID, 'UserId': 'backup'}
+
+    # EC2
+
+    def handle_ec2_describe_volumes(self, region_name, params):
+        volumes = list(self.volumes.values())
+        for filter_spec in params.get('Filters', []):
+            if filter_spec['Name'] == 'volume-id':
+                volumes = [v for v in volumes if v['VolumeId'] in filter_spec['Values']]
+            elif filter_spec['Name'].startswith('tag:'):
+                key = filter_spec['Name'][len('tag:'):]
+                volumes = [v for v in volumes
+                           if any(t['Key'] == key and t['Value'] in filter_spec['Values'] for t in v['Tags'])]
+        return page(params, volumes, 'Volumes', 'NextToken', 'MaxResults', 500)
+
+    def handle_ec2_describe_tags(self, region_name, params):
+        resource_ids = tag_filter_values(params, 'resource-id') or set(self.volumes)
+        tags = [dict(tag, ResourceId=volume_id, ResourceType='volume')
+                for volume_id in sorted(resource_ids) if volume_id in self.volumes
+                for tag in self.volumes[volume_id]['Tags']]
+        return page(params, tags, 'Tags', 'NextToken', 'MaxResults', 1000)
+
+    def handle_ec2_describe_snapshots(self, region_name, params):
+        snapshots = list(self.snapshots.values())
+        volume_ids = tag_filter_values(params, 'volume-id')
+        if volume_ids is not None:
+            snapshots = [s for s in snapshots if s['VolumeId'] in volume_ids]
+        if params.get('SnapshotIds'):
+            snapshots = [self.snapshots[snapshot_id] for snapshot_id in params['SnapshotIds']]
+        snapshot_ids = tag_filter_values(params, 'snapshot-id')
+        if snapshot_ids is not None:
+            snapshots = [s for s in snapshots if s['SnapshotId'] in snapshot_ids]
+        return page(params, snapshots, 'Snapshots', 'NextToken', 'MaxResults', 1000)
+
+    def handle_ec2_create_snapshot(self, region_name, params):
+        volume = self.volumes[params['VolumeId']]
+        snapshot_id = self.next_id('snap')
+        tags = []
+        for spec in params.get('TagSpecifications', []):
+            tags.extend(spec['Tags'])
+
+        self.snapshots[snapshot_id] = {
+            'SnapshotId': snapshot_id,
+            'VolumeId': volume['VolumeId'],
+            'OwnerId': ACCOUNT_ID,
+            'State': 'pending',
+            'StartTime': datetime.now(tzutc()),
+            'Description': params.get('Description', ''),
+            'Tags': tags,
+        }
+        return dict(self.snapshots[snapshot_id])
+
+    def handle_ec2_describe_instances(self, region_name, params):
+        instance_ids = tag_filter_values(params, 'instance-id') or set(self.instances)
+        instances = [self.instances[instance_id] for instance_id in sorted(instance_ids)]
+        response = page(params, instances, 'Instances', 'NextToken', 'MaxResults', 1000)
+        response['Reservations'] = [{'Instances': response.pop('Instances')}]
+        return response
+
+    def handle_ec2_create_snapshots(self, region_name, params):
+        specification = params['InstanceSpecification']
+        instance = self.instances[specification['InstanceId']]
+        excluded = set(specification.get('ExcludeDataVolumeIds', []))
+
+        snapshots = []
+        for mapping in instance['BlockDeviceMappings']:
+            if mapping['DeviceName'] == instance['RootDeviceName']:
+                if specification.get('ExcludeBootVolume'):
+                    continue
+            elif mapping['Ebs']['VolumeId'] in excluded:
+                continue
+
+            volume = self.volumes[mapping['Ebs']['VolumeId']]
+            snapshot = self.handle_ec2_create_snapshot(region_name, dict(params, VolumeId=volume['VolumeId']))
+            if params.get('CopyTagsFromSource') == 'volume':
+                snapshot['Tags'].extend(volume['Tags'])
+                self.snapshots[snapshot['SnapshotId']]['Tags'] = snapshot['Tags']
+            snapshots.append(snapshot)
+        return {'Snapshots': snapshots}
+
+    def handle_ec2_create_tags(self, region_name, params):
+        for resource_id in params['Resources']:
+            self.snapshots[resource_id]['Tags'].extend(params['Tags'])
+        return {}
+
+    def handle_ec2_delete_snapshot(self, region_name, params):
+        del self.snapshots[params['SnapshotId']]
+        return {}
+
+    # RDS
+
+    def handle_rds_describe_db_instances(self, region_name, params):
+        return page(params, list(self.db_instances.values()), 'DBInstances', 'Marker', 'MaxRecords', 100)
+
+    def handle_rds_describe_db_clusters(self, region_name, params):
+        return page(params, list(self.db_clusters.values()), 'DBClusters', 'Marker', 'MaxRecords', 100)
+
+    def handle_rds_list_tags_for_resource(self, region_name, params):
+        resource_id = params['ResourceName'].split(':')[-1]
+        resource = self.db_instances.get(resource_id) or self.db_clusters[resource_id]
+        return {'TagList': resource['TagList']}
+
+    def handle_rds_add_tags_to_resource(self, region_name, params):
+        return {}
+
+    def describe_snapshots(self, snapshots, params, id_key, snapshot_id_key, filter_name):
+        results = list(snapshots.values())
+        if params.get(id_key):
+            results = [s for s in results if s[id_key] == params[id_key]]
+        snapshot_ids = tag_filter_values(params, filter_name)
+        if snapshot_ids is not None:
+            results = [s for s in results if s[snapshot_id_key] in snapshot_ids]
+        if params.get('SnapshotType'):
+            results = [s for s in results if s['SnapshotType'] == params['SnapshotType']]
+        return results
+
+    def handle_rds_describe_db_snapshots(self, region_name, params):
+        snapshots = self.describe_snapshots(self.db_snapshots, params, 'DBInstanceIdentifier',
+                                            'DBSnapshotIdentifier', 'db-snapshot-id')
+        return page(params, snapshots, 'DBSnapshots', 'Marker', 'MaxRecords', 100)
+
+    def handle_rds_describe_db_cluster_snapshots(self, region_name, params):
+        snapshots = self.describe_snapshots(self.db_cluster_snapshots, params, 'DBClusterIdentifier',
+                                            'DBClusterSnapshotIdentifier', 'db-cluster-snapshot-id')
+        return page(params, snapshots, 'DBClusterSnapshots', 'Marker', 'MaxRecords', 100)
+
+    def handle_rds_create_db_snapshot(self, region_name, params):
+        snapshot_id = self.add_db_snapshot(region_name, self.db_instances[params['DBInstanceIdentifier']]['DBInstanceIdentifier'],
+                                           datetime.now(tzutc()),
+                                           tags=dict((t['Key'], t['Value']) for t in params.get('Tags', [])),
+                                           snapshot_id=params['DBSnapshotIdentifier'], status='creating')
+        return {'DBSnapshot': dict(self.db_snapshots[snapshot_id])}
+
+    def handle_rds_create_db_cluster_snapshot(self, region_name, params):
+        snapshot_id = self.add_db_cluster_snapshot(region_name,
+                                                   self.db_clusters[params['DBClusterIdentifier']]['DBClusterIdentifier'],
+                                                   datetime.now(tzutc()),
+                                                   tags=dict((t['Key'], t['Value']) for t in params.get('Tags', [])),
+                                                   snapshot_id=params['DBClusterSnapshotIdentifier'],
+                                                   status='creating')
+        return {'DBClusterSnapshot': dict(self.db_cluster_snapshots[snapshot_id])}
+
+    def handle_rds_copy_db_snapshot(self, region_name, params):
+        source = self.db_snapshots[params['SourceDBSnapshotIdentifier']]
+        snapshot_id = self.add_db_snapshot(region_name, source['DBInstanceIdentifier'], source['SnapshotCreateTime'],
+                                           tags=dict((t['Key'], t['Value']) for t in params.get('Tags', [])),
+                                           snapshot_id=params['TargetDBSnapshotIdentifier'], status='creating')
+        return {'DBSnapshot': dict(self.db_snapshots[snapshot_id])}
+
+    def handle_rds_copy_db_cluster_snapshot(self, region_name, params):
+        source = self.db_cluster_snapshots[params['SourceDBClusterSnapshotIdentifier']]
+        snapshot_id = self.add_db_cluster_snapshot(region_name, source['DBClusterIdentifier'],
+                                                   source['SnapshotCreateTime'],
+                                                   tags=dict((t['Key'], t['Value']) for t in params.get('Tags', [])),
+                                                   snapshot_id=params['TargetDBClusterSnapshotIdentifier'],
+                                                   status='creating')
+        return {'DBClusterSnapshot': dict(self.db_cluster_snapshots[snapshot_id])}
+
+    def handle_rds_delete_db_snapshot(self, region_name, params):
+        del self.db_snapshots[params['DBSnapshotIdentifier']]
+        return {}
+
+    def handle_rds_delete_db_cluster_snapshot(self, region_name, params):
+        del self.db_cluster_snapshots[params['DBClusterSnapshotIdentifier']]
+        return {}
+
+
+def build_fleet(backend, size, region_name, snapshots_per_resource=3, volumes_per_instance=0, automated=False):
+    """
+    Populate the backend with size tagged volumes and size tagged databases, a tenth
+    of them Aurora clusters, alongside an untagged tenth of each that must be left alone.
+    With volumes_per_instance the tagged volumes are attached to instances that many at a time,
+    and with automated each tagged database has a recent automated snapshot.
+    """
+    tags = {'MakeSnapshot': 'True', 'Name': 'benchmark'}
+    volume_ids = [backend.add_volume(tags, snapshot_count=snapshots_per_resource) for i in range(size)]
+    for i in range(size // 10):
+        backend.add_volume({'Name': 'untagged'})
+    if volumes_per_instance:
+        for start in range(0, size, volumes_per_instance):
+            backend.add_instance(volume_ids[start:start + volumes_per_instance])
+
+    clusters = size // 10
+    automated_time = datetime.now(tzutc()) - timedelta(hours=3)
+    for i in range(size - clusters):
+        db_instance_id = backend.add_db_instance(region_name, tags, snapshot_count=snapshots_per_resource)
+        if automated:
+            backend.add_db_snapshot(region_name, db_instance_id, automated_time, snapshot_type='automated',
+                                    snapshot_id='rds:%s' % db_instance_id)
+    for i in range(clusters):
+        db_cluster_id = backend.add_db_cluster(region_name, tags, snapshot_count=snapshots_per_resource)
+        if automated:
+            backend.add_db_cluster_snapshot(region_name, db_cluster_id, automated_time, snapshot_type='automated',
+                                            snapshot_id='rds:%s' % db_cluster_id)
+    for i in range(size // 10):
+        backend.add_db_instance(region_name, {'Name': 'untagged'})
+
+
+def build_orphans(backend, count, region_name, snapshots_per_resource=3):
+    """
+    Add the snapshots the tool took of count volumes and count databases that have since been deleted.
+    """
+    for i in range(count):
+        volume_id = backend.add_volume({'MakeSnapshot': 'True'}, snapshot_count=snapshots_per_resource, age_days=60)
+        del backend.volumes[volume_id]
+
+    for i in range(count):
+        db_instance_id = backend.next_id('db')
+        for day in range(snapshots_per_resource):
+            backend.add_db_snapshot(region_name, db_instance_id, datetime.now(tzutc()) - timedelta(days=60 + day),
+                                    snapshot_id='day-%s-%s' % (db_instance_id, day))
+
+
+def install_backend(backend):
+    """
+    Route every client the module builds to the fake backend.
+    """
+    clients = {}
+
+    def get_client(service_name, region_name=None, role_arn=None, retries=None, slot=None):
+        key = (service_name, region_name, role_arn, slot)
+        if key not in clients:
+            clients[key] = FakeClient(backend, service_name, region_name or 'ap-southeast-2')
+        return clients[key]
+
+    backuplambda.clear_caches()
+    backuplambda.get_client = get_client
+
+    # Nothing saved against an earlier backend applies to this one
+    backuplambda.MEMORY_STATE_STORE.states.clear()
+
+
+def run_benchmark(service_name, size, latency=0, throttle_rate=0, max_workers=8, keep_count=2, extra_event=None,
+                  orphans=0, volumes_per_instance=0, runs=1, history=3, automated=False):
+    """
+    Run the function against a fresh fleet, runs times with the snapshots completing in between,
+    and report on the last run.
+    """
+    region_name = 'ap-southeast-2'
+
+    backend = FakeBackend(latency=latency, throttle_rate=throttle_rate, backoff_scale=0.01)
+    build_fleet(backend, size, region_name, snapshots_per_resource=history, volumes_per_instance=volumes_per_instance,
+                automated=automated)
+    build_orphans(backend, orphans, region_name)
+    original_get_client = backuplambda.get_client
+    install_backend(backend)
+
+    event = {
+        'period_label': 'day',
+        'period_format': '%a%H',
+        'tag_name': 'MakeSnapshot',
+        'tag_value': 'True',
+        'keep_count': keep_count,
+        'max_workers': max_workers,
+        # Measure the tool rather than the client side limits
+        'api_rate_limits': {'describe': 100000, 'mutate': 100000},
+        service_name + '_region_name': region_name,
+        'instance_snapshots': bool(volumes_per_instance),
+    }
+    event.update(extra_event or {})
+
+    # Keep the per resource progress output out of the report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    try:
+        # The runs before the last one only leave state behind for it
+        for run in range(runs - 1):
+            backuplambda.lambda_handler(dict(event))
+            backend.complete_snapshots()
+        backend.calls.clear()
+
+        if tracemalloc:
+            tracemalloc.start()
+        start = time.time()
+        result = json.loads(backuplambda.lambda_handler(dict(event)))
+    finally:
+        elapsed = time.time() - start
+        sys.stdout.close()
+        sys.stdout = stdout
+        backuplambda.get_client = original_get_client
+
+    peak_memory = 0
+    if tracemalloc:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    calls = dict((key.split('.', 1)[1], count) for key, count in backend.calls.items()
+                 if key.startswith(service_name + '.'))
+
+    # A sweep on its own has no backup metrics, its cost is per snapshot scanned instead
+    if 'metrics' in result:
+        resources = result['metrics']['total_resources']
+        errors = result['metrics']['total_errors']
+    else:
+        resources = result['sweep'][service_name]['metrics']['total_scanned']
+        errors = result['sweep'][service_name]['metrics']['total_delete_errors']
+
+    return {
+        'service': service_name,
+        'size': size,
+        'resources': resources,
+        'errors': errors,
+        'wall_time_s': round(elapsed, 3),
+        'peak_memory_mb': round(peak_memory / (1024.0 * 1024.0), 2),
+        'api_calls': sum(calls.values()),
+        'api_calls_per_resource': round(float(sum(calls.values())) / max(resources, 1), 3),
+        'calls_per_resource': dict((op, round(float(count) / max(resources, 1), 3)) for op, count in calls.items()),
+    }
+
+
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.time()
+import backuplambda
+imported = time.time()
+modules = sorted(set(name.split('.')[0] for name in sys.modules))
+backuplambda.get_client('ec2', 'us-east-1')
+print(json.dumps({'import_ms': round((imported - start) * 1000, 1),
+                  'first_client_ms': round((time.time() - imported) * 1000, 1),
+                  'imported': modules}))
+"""
+
+
+def measure_startup():
+    """
+    Time a cold start in a fresh interpreter, the import of the module and then the
+    first client it builds, and list the top level modules loaded by the import alone.
+    """
+    env = dict(os.environ, AWS_ACCESS_KEY_ID='benchmark', AWS_SECRET_ACCESS_KEY='benchmark',
+               PYTHONPATH=os.pathsep.join(p for p in [os.path.dirname(backuplambda.__file__),
+                                                      os.environ.get('PYTHONPATH')] if p))
+    output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT], env=env)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def check_startup(report, budget):
+    """
+    :return: a list of the modules the import loaded that it should have left until needed
+    """
+    return ['startup: %s is imported with the module' % name
+            for name in budget['startup']['deferred_modules'] if name in report['imported']]
+
+
+def load_budget(path=BUDGET_FILE):
+    with open(path) as budget_file:
+        return json.load(budget_file)
+
+
+def check_budget(report, budget):
+    """
+    :return: a list of the ways the report goes over the budget
+    """
+    failures = []
+    service_budget = budget[report['service']]
+
+    if report['errors']:
+        failures.append('%(service)s/%(size)s: %(errors)s resources failed' % report)
+
+    if report['api_calls_per_resource'] > service_budget['api_calls_per_resource']:
+        failures.append('%s/%s: %s API calls per resource, budget is %s' % (
+            report['service'], report['size'], report['api_calls_per_resource'],
+            service_budget['api_calls_per_resource']))
+
+    for operation, calls in sorted(report['calls_per_resource'].items()):
+        allowed = service_budget['operations'].get(operation)
+        if allowed is not None and calls > allowed:
+            failures.append('%s/%s: %s %s calls per resource, budget is %s' % (
+                report['service'], report['size'], calls, operation, allowed))
+
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--services', nargs='+', default=['ec2', 'rds'])
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every API call')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='fraction of API calls to throttle')
+    parser.add_argument('--max-workers', type=int, default=8)
+    parser.add_argument('--mode', choices=['backup', 'plan', 'sweep'], default='backup')
+    parser.add_argument('--orphans', type=int, default=0,
+                        help='deleted volumes and databases left with snapshots to sweep')
+    parser.add_argument('--volumes-per-instance', type=int, default=0,
+                        help='attach the volumes to instances and snapshot each instance in one call')
+    parser.add_argument('--history', type=int, default=3, help='snapshots each resource starts with')
+    parser.add_argument('--keep-count', type=int, default=2)
+    parser.add_argument('--runs', type=int, default=1,
+                        help='runs to make against each fleet, reporting on the last, e.g. with --snapshot-index')
+    parser.add_argument('--snapshot-index', action='store_true',
+                        help='save the snapshot index between runs and refresh it rather than listing it again')
+    parser.add_argument('--promote-automated', action='store_true',
+                        help='give each database an automated snapshot and promote it rather than take one')
+    parser.add_argument('--startup', action='store_true', help='also time a cold start in a fresh interpreter')
+    parser.add_argument('--budget', default=BUDGET_FILE)
+    args = parser.parse_args(argv)
+
+    budget = load_budget(args.budget)
+    failures = []
+
+    print('%-5s %7s %10s %10s %10s %12s' % ('svc', 'size', 'wall s', 'peak MB', 'calls', 'calls/res'))
+    for service_name in args.services:
+        for size in args.sizes:
+            extra_event = {'mode': args.mode}
+            if args.snapshot_index:
+                extra_event['snapshot_index'] = {}
+            if args.promote_automated:
+                extra_event['promote_automated'] = {}
+            report = run_benchmark(service_name, size, latency=args.latency, throttle_rate=args.throttle_rate,
+                                   max_workers=args.max_workers, extra_event=extra_event, orphans=args.orphans,
+                                   volumes_per_instance=args.volumes_per_instance, runs=args.runs,
+                                   history=args.history, keep_count=args.keep_count,
+                                   automated=args.promote_automated)
+            print('%-5s %7d %10.2f %10.2f %10d %12.3f' % (service_name, size, report['wall_time_s'],
+                                                       report['peak_memory_mb'], report['api_calls'],
+                                                       report['api_calls_per_resource']))
+            failures.extend(check_budget(report, budget))
+
+    if args.startup:
+        report = measure_startup()
+        print('startup: import %(import_ms)s ms, first client %(first_client_ms)s ms' % report)
+        failures.extend(check_startup(report, budget))
+
+    for failure in failures:
+        print('OVER BUDGET ' + failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
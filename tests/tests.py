@@ -1,46 +1,1664 @@
 import boto3
 import json
+import os
+import shutil
+import tempfile
 import unittest
+from datetime import timedelta
+from botocore.exceptions import ClientError
 from backuplambda import *
-from moto import mock_ec2, mock_sns
+from benchmark import check_budget, check_startup, load_budget, measure_startup, run_benchmark
+from moto import mock_ec2, mock_rds, mock_sns, mock_sts
 
 
 def add_volume(tag_name, tag_value, region_name):
     ec2_boto = boto3.client('ec2', region_name=region_name)
 
-    ec2_boto.create_volume(Size=200, AvailabilityZone=region_name + "a")
+    volume = ec2_boto.create_volume(Size=200, AvailabilityZone=region_name + "a")
 
-    vols = ec2_boto.describe_volumes()
+    resource_id = volume["VolumeId"]
+    ec2_boto.create_tags(Resources=[resource_id],
+                         Tags=[{"Key": tag_name, "Value": tag_value}])
+
+    return resource_id
+
+
+def add_volume_snapshot(resource_id, description, region_name):
+    ec2_boto = boto3.client('ec2', region_name=region_name)
+    current_snap = ec2_boto.create_snapshot(VolumeId=resource_id,
+                                            Description=description)
+
+
+def count_api_calls(client):
+    calls = {}
+
+    def _count(model, **kwargs):
+        calls[model.name] = calls.get(model.name, 0) + 1
+
+    client.meta.events.register('before-call', _count)
+    return calls
+
+
+def add_db_instance(db_id, tags, region_name, cluster_id=None):
+    rds_boto = boto3.client('rds', region_name=region_name)
+
+    params = {}
+    if cluster_id:
+        params["DBClusterIdentifier"] = cluster_id
+
+    rds_boto.create_db_instance(DBInstanceIdentifier=db_id,
+                                DBInstanceClass="db.t2.micro",
+                                Engine="aurora-mysql" if cluster_id else "mysql",
+                                AllocatedStorage=10,
+                                MasterUsername="root",
+                                MasterUserPassword="password",
+                                Tags=[{"Key": k, "Value": v} for k, v in tags.items()],
+                                **params)
+
+
+def add_db_cluster(cluster_id, tags, region_name):
+    rds_boto = boto3.client('rds', region_name=region_name)
+
+    rds_boto.create_db_cluster(DBClusterIdentifier=cluster_id,
+                               Engine="aurora-mysql",
+                               MasterUsername="root",
+                               MasterUserPassword="password",
+                               Tags=[{"Key": k, "Value": v} for k, v in tags.items()])
+
+
+class EC2BackupManagerTest(unittest.TestCase):
+    @mock_ec2
+    def test_resolve_resource_bytag(self):
+        add_volume("Snapshot", "True", "ap-southeast-1")
+        add_volume("Name", "Anotherone", "ap-southeast-1")
+
+        mgr = EC2BackupManager(ec2_region_name="ap-southeast-1",
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count="2")
+
+        volumes = list(mgr.get_backable_resources())
+
+        assert len(volumes) == 1
+
+    @mock_ec2
+    def test_resolve_resource_paginated(self):
+        region_name = "ap-southeast-1"
+
+        volumes = [add_volume("Snapshot", "True", region_name) for i in range(12)]
+        add_volume("Name", "Anotherone", region_name)
+
+        mgr = EC2BackupManager(ec2_region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2,
+                               page_size=5)
+
+        found = [mgr.resolve_backupable_id(volume) for volume in mgr.get_backable_resources()]
+
+        self.assertEqual(sorted(found), sorted(volumes))
+
+    def test_prefetch(self):
+        self.assertEqual(list(prefetch(iter(range(10)), depth=2)), list(range(10)))
+
+        def failing():
+            yield 1
+            raise ValueError("page failed")
+
+        with self.assertRaises(ValueError):
+            list(prefetch(failing()))
+
+        # Walking away part way through must not leave the producer stuck
+        pages = prefetch(iter(range(10)))
+        self.assertEqual(next(pages), 0)
+        pages.close()
+
+        # Nor walking away with the last item queued, and the end of the listing still to be put
+        before = set(threading.enumerate())
+        pages = prefetch(iter(range(2)))
+        self.assertEqual(next(pages), 0)
+        time.sleep(0.2)
+        pages.close()
+        time.sleep(0.3)
+        self.assertEqual([thread for thread in threading.enumerate() if thread not in before], [])
+
+    @mock_ec2
+    def test_list_snapshots_from_index(self):
+        region_name = "ap-southeast-1"
+
+        volume = add_volume("Snapshot", "True", region_name)
+        add_volume_snapshot(volume, description="day_snapshot-1", region_name=region_name)
+        add_volume_snapshot(volume, description="day_snapshot-2", region_name=region_name)
+
+        mgr = EC2BackupManager(ec2_region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count="2")
+
+        snapshots = mgr.list_snapshots_for_resource({"VolumeId": volume})
+        self.assertEqual(len(snapshots), 2)
+
+        snapshots = mgr.list_snapshots_for_resource({"VolumeId": "vol-missing"})
+        self.assertEqual(len(snapshots), 0)
+
+    @mock_ec2
+    def test_resource_tags_without_per_volume_lookup(self):
+        region_name = "ap-southeast-1"
+
+        for i in range(3):
+            add_volume("Snapshot", "True", region_name)
+
+        mgr = EC2BackupManager(ec2_region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+        calls = count_api_calls(mgr.conn)
+
+        mgr.process_backup()
+
+        self.assertEqual(calls.get("DescribeVolumes"), 1)
+        self.assertEqual(calls.get("DescribeTags", 0), 0)
+        self.assertEqual(calls.get("DescribeSnapshots"), 1)
+
+    @mock_ec2
+    def test_resource_tags_batched_fallback(self):
+        region_name = "ap-southeast-1"
+
+        volumes = [add_volume("Snapshot", "True", region_name) for i in range(3)]
+
+        mgr = EC2BackupManager(ec2_region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+        calls = count_api_calls(mgr.conn)
+
+        for volume in volumes:
+            self.assertEqual(mgr.get_resource_tags({"VolumeId": volume}), {"Snapshot": "True"})
+
+        mgr.tag_cache = {}
+        mgr.prefetch_resource_tags(volumes)
+        for volume in volumes:
+            self.assertEqual(mgr.get_resource_tags({"VolumeId": volume}), {"Snapshot": "True"})
+
+        self.assertEqual(calls.get("DescribeTags"), 4)
+
+
+    @mock_ec2
+    def test_snapshot_tagged_on_create(self):
+        region_name = "ap-southeast-1"
+
+        volume = add_volume("Snapshot", "True", region_name)
+
+        mgr = EC2BackupManager(ec2_region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+        calls = count_api_calls(mgr.conn)
+
+        mgr.snapshot_resource({"VolumeId": volume}, description="day_snapshot", tags={"Snapshot": "True"})
+
+        self.assertEqual(calls.get("CreateSnapshot"), 1)
+        self.assertEqual(calls.get("CreateTags", 0), 0)
+
+        snapshot = mgr.list_snapshots_for_resource({"VolumeId": volume})[0]
+        self.assertEqual(mgr.resolve_snapshot_tags(snapshot), {"Snapshot": "True",
+                                                                PERIOD_TAG: "day",
+                                                                DATE_SUFFIX_TAG: "dd",
+                                                                SOURCE_TAG: volume,
+                                                                SCHEDULE_TAG: "Snapshot=True"})
+        self.assertTrue(mgr.snapshot_in_period(snapshot))
+
+    def test_snapshot_tags_over_limit(self):
+        mgr = BaseBackupManager(period="day", tag_name="Snapshot", tag_value="True",
+                                date_suffix="dd", keep_count=2)
+        mgr.resolve_backupable_id = lambda resource: resource["VolumeId"]
+
+        tags = dict(("Key%02d" % i, "Value") for i in range(60))
+        tag_list = mgr.build_snapshot_tags({"VolumeId": "vol-1"}, tags)
+
+        self.assertEqual(len(tag_list), MAX_TAGS_PER_RESOURCE)
+        self.assertEqual([tag["Key"] for tag in tag_list[:4]],
+                         [DATE_SUFFIX_TAG, PERIOD_TAG, SCHEDULE_TAG, SOURCE_TAG])
+        self.assertEqual(tag_list[-1]["Key"], "Key45")
+
+    @mock_ec2
+    def test_snapshot_tags_over_limit_in_create(self):
+        region_name = "ap-southeast-1"
+
+        volume = add_volume("Snapshot", "True", region_name)
+        tags = dict(("Key%02d" % i, "Value") for i in range(48))
+        tags["Snapshot"] = "True"
+
+        mgr = EC2BackupManager(ec2_region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+        calls = count_api_calls(mgr.conn)
+
+        mgr.snapshot_resource({"VolumeId": volume}, description="day_snapshot", tags=tags)
+
+        self.assertEqual(calls.get("CreateSnapshot"), 1)
+        self.assertEqual(calls.get("CreateTags", 0), 0)
+
+        snapshot_tags = mgr.resolve_snapshot_tags(mgr.list_snapshots_for_resource({"VolumeId": volume})[0])
+        self.assertEqual(len(snapshot_tags), MAX_TAGS_PER_RESOURCE)
+        self.assertEqual(snapshot_tags[SOURCE_TAG], volume)
+        self.assertNotIn("Snapshot", snapshot_tags)
+
+    def test_snapshot_in_period(self):
+        mgr = EC2BackupManager(ec2_region_name="ap-southeast-1",
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+
+        tagged = {"Description": "anything", "Tags": [{"Key": PERIOD_TAG, "Value": "day"}]}
+        other = {"Description": "day_snapshot", "Tags": [{"Key": PERIOD_TAG, "Value": "week"}]}
+        legacy = {"Description": "day_snapshot vol-1_day_dd by snapshot script"}
+
+        self.assertTrue(mgr.snapshot_in_period(tagged))
+        self.assertFalse(mgr.snapshot_in_period(other))
+        self.assertTrue(mgr.snapshot_in_period(legacy))
+
+    @mock_ec2
+    def test_process_backup_concurrent(self):
+        region_name = "ap-southeast-1"
+
+        volumes = [add_volume("Snapshot", "True", region_name) for i in range(5)]
+        for volume in volumes:
+            add_volume_snapshot(volume, description="day_snapshot-1", region_name=region_name)
+
+        mgr = EC2BackupManager(ec2_region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=1,
+                               max_workers=4)
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(metrics["total_resources"], 5)
+        self.assertEqual(metrics["total_creates"], 5)
+        self.assertEqual(metrics["total_deletes"], 5)
+        self.assertEqual(metrics["total_errors"], 0)
+
+        positions = [mgr.message.index('Processing backup item ' + volume) for volume in volumes]
+        self.assertEqual(positions, sorted(positions))
+
+    @mock_ec2
+    def test_deletes_after_creates(self):
+        region_name = "ap-southeast-1"
+
+        volumes = [add_volume("Snapshot", "True", region_name) for i in range(3)]
+        for volume in volumes:
+            add_volume_snapshot(volume, description="day_snapshot-1", region_name=region_name)
+            add_volume_snapshot(volume, description="day_snapshot-2", region_name=region_name)
+
+        mgr = EC2BackupManager(ec2_region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=1,
+                               delete_workers=4)
+
+        calls = []
+        mgr.conn.meta.events.register('before-call', lambda model, **kwargs: calls.append(model.name))
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(metrics["total_creates"], 3)
+        self.assertEqual(metrics["total_deletes"], 6)
+        mutating = [call for call in calls if not call.startswith("Describe")]
+        self.assertEqual(mutating, ["CreateSnapshot"] * 3 + ["DeleteSnapshot"] * 6)
+        self.assertEqual(len(mgr.changes["deletes"]), 6)
+
+    @mock_ec2
+    def test_instance_snapshots(self):
+        region_name = "ap-southeast-1"
+        ec2_boto = boto3.client('ec2', region_name=region_name)
+
+        reservation = ec2_boto.run_instances(ImageId="ami-12c6146b", MinCount=1, MaxCount=1,
+                                             Placement={"AvailabilityZone": region_name + "a"})
+        instance_id = reservation["Instances"][0]["InstanceId"]
+
+        attached = [add_volume("Snapshot", "True", region_name) for i in range(2)]
+        untagged = add_volume("Name", "scratch", region_name)
+        for device, volume in zip(["/dev/sdf", "/dev/sdg", "/dev/sdh"], attached + [untagged]):
+            ec2_boto.attach_volume(VolumeId=volume, InstanceId=instance_id, Device=device)
+        detached = add_volume("Snapshot", "True", region_name)
+
+        mgr = EC2BackupManager(ec2_region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=1,
+                               instance_snapshots=True)
+
+        calls = []
+        mgr.conn.meta.events.register('before-parameter-build',
+                                      lambda model, params, **kwargs: calls.append((model.name, params)))
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(metrics["total_resources"], 3)
+        self.assertEqual(metrics["total_creates"], 3)
+        self.assertEqual(metrics["total_errors"], 0)
+
+        creates = [(name, params) for name, params in calls if name.startswith("CreateSnapshot")]
+        self.assertEqual(sorted(name for name, params in creates), ["CreateSnapshot", "CreateSnapshots"])
+        specification = [params for name, params in creates if name == "CreateSnapshots"][0]["InstanceSpecification"]
+        self.assertEqual(specification["InstanceId"], instance_id)
+        self.assertTrue(specification["ExcludeBootVolume"])
+        self.assertEqual(specification["ExcludeDataVolumeIds"], [untagged])
+
+        # Each snapshot of the set is filed under its own volume, for retention to rotate
+        for volume in attached:
+            snapshots = mgr.list_snapshots_for_resource({"VolumeId": volume})
+            self.assertEqual(len(snapshots), 1)
+            tags = mgr.resolve_snapshot_tags(snapshots[0])
+            self.assertEqual(tags[INSTANCE_TAG], instance_id)
+            self.assertNotIn(SOURCE_TAG, tags)
+        self.assertEqual(sorted(create["resource_id"] for create in mgr.changes["creates"]),
+                         sorted(attached + [detached]))
+
+    @mock_ec2
+    def test_instance_snapshots_without_instance(self):
+        region_name = "ap-southeast-1"
+        ec2_boto = boto3.client('ec2', region_name=region_name)
+
+        reservation = ec2_boto.run_instances(ImageId="ami-12c6146b", MinCount=1, MaxCount=1,
+                                             Placement={"AvailabilityZone": region_name + "a"})
+        instance_id = reservation["Instances"][0]["InstanceId"]
+        attached = [add_volume("Snapshot", "True", region_name) for i in range(2)]
+        for device, volume in zip(["/dev/sdf", "/dev/sdg"], attached):
+            ec2_boto.attach_volume(VolumeId=volume, InstanceId=instance_id, Device=device)
+
+        mgr = EC2BackupManager(ec2_region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=1,
+                               instance_snapshots=True)
+        calls = count_api_calls(mgr.conn)
+
+        # Gone by the time it is described, so its untagged volumes could not be left out
+        mgr.describe_instances = lambda instance_ids: {}
+        metrics = mgr.process_backup()
+
+        self.assertEqual(metrics["total_creates"], 2)
+        self.assertEqual(calls.get("CreateSnapshot"), 2)
+        self.assertNotIn("CreateSnapshots", calls)
+
+    def test_instance_volume_with_too_many_tags(self):
+        mgr = EC2BackupManager(ec2_region_name="ap-southeast-1",
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=1,
+                               instance_snapshots=True,
+                               plan_only=True)
+
+        attachments = [{"InstanceId": "i-1"}]
+        crowded = {"VolumeId": "vol-1", "Attachments": attachments,
+                   "Tags": [{"Key": "Key%02d" % i, "Value": "Value"} for i in range(47)]}
+        tagged = {"VolumeId": "vol-2", "Attachments": attachments, "Tags": [{"Key": "Snapshot", "Value": "True"}]}
+
+        items = list(mgr.group_resources([crowded, tagged]))
+
+        # Copied over whole by CreateSnapshots, its tags would not fit alongside the bookkeeping tags
+        self.assertEqual(items[0], crowded)
+        self.assertEqual(items[1]["Volumes"], [tagged])
+
+    @mock_ec2
+    def test_snapshot_in_progress_deferred(self):
+        region_name = "ap-southeast-1"
+
+        busy = add_volume("Snapshot", "True", region_name)
+        add_volume_snapshot(busy, description="day_snapshot-1", region_name=region_name)
+        throttled = add_volume("Snapshot", "True", region_name)
+        add_volume("Snapshot", "True", region_name)
+
+        mgr = EC2BackupManager(ec2_region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+
+        for snapshot in mgr.list_snapshots_for_resource({"VolumeId": busy}):
+            snapshot["State"] = "pending"
+
+        snapshot_resource = mgr.snapshot_resource
+
+        def rate_exceeded(resource, description, tags):
+            if resource["VolumeId"] == throttled:
+                raise ClientError({"Error": {"Code": "SnapshotCreationPerVolumeRateExceeded"}}, "CreateSnapshot")
+            return snapshot_resource(resource, description, tags)
+
+        mgr.snapshot_resource = rate_exceeded
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(metrics["total_resources"], 3)
+        self.assertEqual(metrics["total_creates"], 1)
+        self.assertEqual(metrics["total_deferred"], 2)
+        self.assertEqual(metrics["total_errors"], 0)
+        self.assertEqual(mgr.errmsg, "")
+        self.assertIn("Deferred to a later run: snapshot day_snapshot-1 still in progress", mgr.message)
+        self.assertIn("Deferred to a later run: SnapshotCreationPerVolumeRateExceeded", mgr.message)
+
+    @mock_ec2
+    def test_copy_to_dr_region(self):
+        region_name = "ap-southeast-1"
+        dr_region_name = "ap-southeast-2"
+
+        volume = add_volume("Snapshot", "True", region_name)
+        add_volume_snapshot(volume, description="day_snapshot-1", region_name=region_name)
+        add_volume_snapshot(volume, description="day_snapshot-2", region_name=region_name)
+
+        def dr_copies():
+            snapshots = boto3.client('ec2', region_name=dr_region_name).describe_snapshots(OwnerIds=["self"])
+            return [snap for snap in snapshots["Snapshots"]
+                    if COPY_OF_TAG in EC2BackupManager.tag_list_to_dict(snap.get("Tags", []))]
+
+        def run(dr_keep_count=1, max_in_flight=1):
+            # Snapshot times only go down to the second, keep each run's apart
+            time.sleep(1)
+            mgr = EC2BackupManager(ec2_region_name=region_name,
+                                   period="day",
+                                   tag_name="Snapshot",
+                                   tag_value="True",
+                                   date_suffix="dd",
+                                   keep_count=5,
+                                   copy={"region": dr_region_name, "max_in_flight": max_in_flight,
+                                         "keep_count": dr_keep_count})
+            return mgr.process_backup()
+
+        # Only completed snapshots are copied, and only as many as the DR region keeps, the one just
+        # taken waits for the next run
+        metrics = run()
+        self.assertEqual(metrics["total_copies"], 1)
+        self.assertEqual(metrics["total_copies_waiting"], 0)
+        self.assertEqual(metrics["total_copy_errors"], 0)
+
+        copies = dr_copies()
+        self.assertEqual(len(copies), 1)
+        self.assertEqual(EC2BackupManager.tag_list_to_dict(copies[0]["Tags"])[SOURCE_TAG], volume)
+
+        # The next run copies the snapshot taken since, and retention in the DR region keeps its own count
+        for i in range(3):
+            metrics = run()
+            self.assertEqual(metrics["total_copies"], 1)
+            self.assertEqual(metrics["total_copy_deletes"], 1)
+            self.assertEqual(len(dr_copies()), 1)
+
+        # Room for more in the DR region, the older snapshots are copied one at a time
+        metrics = run(dr_keep_count=3)
+        self.assertEqual(metrics["total_copies"], 1)
+        self.assertEqual(metrics["total_copies_waiting"], 1)
+        self.assertEqual(metrics["total_copy_deletes"], 0)
+
+    @mock_ec2
+    def test_failed_delete_carries_on(self):
+        region_name = "ap-southeast-1"
+
+        volume = add_volume("Snapshot", "True", region_name)
+        add_volume_snapshot(volume, description="day_snapshot-in-use", region_name=region_name)
+        add_volume_snapshot(volume, description="day_snapshot-2", region_name=region_name)
+
+        mgr = EC2BackupManager(ec2_region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=0)
+
+        delete_snapshot = mgr.delete_snapshot
+
+        def delete_unless_in_use(snapshot):
+            if snapshot["Description"].endswith("in-use"):
+                raise Exception("InvalidSnapshot.InUse")
+            delete_snapshot(snapshot)
+
+        mgr.delete_snapshot = delete_unless_in_use
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(metrics["total_deletes"], 2)
+        self.assertEqual(metrics["total_delete_errors"], 1)
+        self.assertEqual(metrics["total_errors"], 0)
+        self.assertIn("Failed to delete snapshot day_snapshot-in-use", mgr.message)
+        self.assertIn("day_snapshot-in-use", mgr.errmsg)
+
+    @mock_ec2
+    def test_deletes_left_for_next_invocation(self):
+        region_name = "ap-southeast-1"
+
+        volume = add_volume("Snapshot", "True", region_name)
+        add_volume_snapshot(volume, description="day_snapshot-1", region_name=region_name)
+        add_volume_snapshot(volume, description="day_snapshot-2", region_name=region_name)
+
+        # Enough time for the backup, but not for the deletes
+        remaining = [60000, 60000, 1000]
+
+        mgr = EC2BackupManager(ec2_region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=1,
+                               time_remaining=lambda: remaining.pop(0) if len(remaining) > 1 else remaining[0])
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(metrics["total_creates"], 1)
+        self.assertEqual(metrics["total_deletes"], 1)
+        self.assertEqual(metrics["total_pending_deletes"], 1)
+        self.assertNotIn("backup", mgr.cursor["phases"])
+
+        cursor = json.loads(json.dumps(mgr.cursor))
+
+        mgr = EC2BackupManager(ec2_region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=1)
+        mgr.resume_from(cursor)
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(metrics["total_resources"], 0)
+        self.assertEqual(metrics["total_deletes"], 1)
+        self.assertIsNone(mgr.cursor)
+
+
+    @mock_ec2
+    def test_out_of_time_waiting_for_room(self):
+        region_name = "ap-southeast-1"
+
+        volumes = [add_volume("Snapshot", "True", region_name) for _ in range(2)]
+
+        # Time runs out while the first volume waits for a snapshot in progress to finish
+        remaining = [60000, 1000]
+
+        mgr = EC2BackupManager(ec2_region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=1,
+                               max_pending_snapshots=1,
+                               time_remaining=lambda: remaining.pop(0) if len(remaining) > 1 else remaining[0])
+        mgr.pending_limiter = PendingSnapshotLimiter(1, ["snap-busy"], lambda snapshots: snapshots,
+                                                     poll_interval=0.01)
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(metrics["total_creates"], 0)
+        self.assertEqual(metrics["total_deferred"], 0)
+        self.assertEqual(metrics["total_resources"], 0)
+        self.assertEqual(metrics["total_unprocessed"], 2)
+        self.assertEqual(sorted(mgr.cursor["phases"]["backup"]), sorted(volumes))
+
+        cursor = json.loads(json.dumps(mgr.cursor))
+
+        mgr = EC2BackupManager(ec2_region_name=region_name,
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=1)
+        mgr.resume_from(cursor)
+
+        metrics = mgr.process_backup()
+
+        self.assertEqual(metrics["total_creates"], 2)
+        self.assertIsNone(mgr.cursor)
+
+class RDSBackupManagerTest(unittest.TestCase):
+    @mock_rds
+    def test_resolve_resource_bytag(self):
+        region_name = "ap-southeast-2"
+
+        add_db_instance("db-tagged", {"MakeSnapshot": "True"}, region_name)
+        add_db_instance("db-other", {"Name": "Anotherone"}, region_name)
+
+        add_db_cluster("cluster-tagged", {"MakeSnapshot": "True"}, region_name)
+        add_db_instance("cluster-tagged-1", {"MakeSnapshot": "True"}, region_name, cluster_id="cluster-tagged")
+
+        add_db_cluster("cluster-untagged", {}, region_name)
+        add_db_instance("cluster-untagged-1", {"MakeSnapshot": "True"}, region_name, cluster_id="cluster-untagged")
+        add_db_instance("cluster-untagged-2", {"MakeSnapshot": "True"}, region_name, cluster_id="cluster-untagged")
+
+        mgr = RDSBackupManager(rds_region_name=region_name,
+                               period="day",
+                               tag_name="MakeSnapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+        calls = count_api_calls(mgr.conn)
+
+        found = [mgr.resolve_backupable_id(db) for db in mgr.get_backable_resources()]
+
+        self.assertEqual(sorted(found), ["cluster-tagged", "cluster-untagged", "db-tagged"])
+        self.assertEqual(calls.get("ListTagsForResource", 0), 0)
+
+    @mock_rds
+    @mock_sts
+    def test_build_arn_with_cached_account(self):
+        clear_caches()
+        region_name = "ap-southeast-2"
+
+        sts_calls = count_api_calls(get_client('sts'))
+
+        mgr = RDSBackupManager(rds_region_name=region_name,
+                               period="day",
+                               tag_name="MakeSnapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+        again = RDSBackupManager(rds_region_name=region_name,
+                                 period="week",
+                                 tag_name="MakeSnapshot",
+                                 tag_value="True",
+                                 date_suffix="dd",
+                                 keep_count=2)
+
+        self.assertIs(mgr.conn, again.conn)
+        self.assertEqual(mgr.build_arn({"DBInstanceIdentifier": "db-1"}),
+                         "arn:aws:rds:ap-southeast-2:123456789012:db:db-1")
+        self.assertEqual(again.build_arn_for_id("cluster-1", resource_type="cluster"),
+                         "arn:aws:rds:ap-southeast-2:123456789012:cluster:cluster-1")
+        self.assertEqual(sts_calls.get("GetCallerIdentity"), 1)
+
+    @mock_rds
+    def test_database_state_errors(self):
+        region_name = "ap-southeast-2"
+
+        add_db_instance("db-busy", {"MakeSnapshot": "True"}, region_name)
+        add_db_instance("db-stopped", {"MakeSnapshot": "True"}, region_name)
+        boto3.client('rds', region_name=region_name).stop_db_instance(DBInstanceIdentifier="db-stopped")
+
+        mgr = RDSBackupManager(rds_region_name=region_name,
+                               period="day",
+                               tag_name="MakeSnapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=2)
+
+        class Response(object):
+            status_code = 400
+            headers = {}
+
+        def refuse(**kwargs):
+            return Response(), {"Error": {"Code": "InvalidDBInstanceState", "Message": "not available"}}
+
+        mgr.conn.meta.events.register('before-call.rds.CreateDBSnapshot', refuse)
+        try:
+            metrics = mgr.process_backup()
+        finally:
+            mgr.conn.meta.events.unregister('before-call.rds.CreateDBSnapshot', refuse)
+
+        # An available database will take a snapshot again shortly, a stopped one needs seeing to
+        self.assertEqual(metrics["total_deferred"], 1)
+        self.assertEqual(metrics["total_errors"], 1)
+        self.assertIn("db-stopped is stopped", mgr.errmsg)
+        self.assertNotIn("db-busy", mgr.errmsg)
+
+    @mock_rds
+    def test_promote_automated_snapshot(self):
+        region_name = "ap-southeast-2"
+
+        add_db_instance("db-automated", {"MakeSnapshot": "True"}, region_name)
+        add_db_instance("db-manual", {"MakeSnapshot": "True"}, region_name)
+
+        # A stopped database leaves an automated snapshot behind
+        rds_boto = boto3.client('rds', region_name=region_name)
+        rds_boto.stop_db_instance(DBInstanceIdentifier="db-automated", DBSnapshotIdentifier="rds:db-automated-1")
+        rds_boto.start_db_instance(DBInstanceIdentifier="db-automated")
+
+        def run(date_suffix, **promote_automated):
+            mgr = RDSBackupManager(rds_region_name=region_name,
+                                   period="day",
+                                   tag_name="MakeSnapshot",
+                                   tag_value="True",
+                                   date_suffix=date_suffix,
+                                   keep_count=2,
+                                   promote_automated=dict({"max_age_hours": 24}, **promote_automated))
+            calls = count_api_calls(mgr.conn)
+            return mgr, mgr.process_backup(), calls
+
+        # Without an automated snapshot the database is left alone rather than snapshot
+        mgr, metrics, calls = run("dd")
+        self.assertEqual(metrics["total_creates"], 1)
+        self.assertEqual(metrics["total_skipped"], 1)
+        self.assertEqual(metrics["total_errors"], 0)
+        self.assertEqual(calls.get("CopyDBSnapshot"), 1)
+        self.assertEqual(calls.get("CreateDBSnapshot", 0), 0)
+        self.assertIn("db-manual", mgr.message)
+        self.assertIn("Skipped: no automated snapshot to promote", mgr.message)
+
+        promoted = [mgr.resolve_snapshot_tags(snapshot).get("backuplambda:promoted-from")
+                    for snapshot in mgr.list_snapshots_for_resource({"DBInstanceIdentifier": "db-automated"})
+                    if mgr.snapshot_in_period(snapshot)]
+        self.assertEqual(promoted, ["rds:db-automated-1"])
+
+        # Already promoted in this period
+        mgr, metrics, calls = run("ee")
+        self.assertEqual(metrics["total_creates"], 0)
+        self.assertEqual(metrics["total_skipped"], 2)
+        self.assertIn("Skipped: automated snapshot rds:db-automated-1 was already promoted in this period",
+                      mgr.message)
+
+        # Too old to promote
+        mgr, metrics, calls = run("ff", max_age_hours=0)
+        self.assertEqual(metrics["total_skipped"], 2)
+        self.assertIn("Skipped: automated snapshot rds:db-automated-1 is older than 0 hours", mgr.message)
+
+        # Falling back to a snapshot of the database when asked to
+        mgr, metrics, calls = run("gg", fallback_to_snapshot=True)
+        self.assertEqual(metrics["total_creates"], 2)
+        self.assertEqual(metrics["total_skipped"], 0)
+        self.assertEqual(calls.get("CopyDBSnapshot", 0), 0)
+        self.assertEqual(calls.get("CreateDBSnapshot"), 2)
+
+
+class RunReportTest(unittest.TestCase):
+    def test_detail_bounded(self):
+        report = RunReport(max_bytes=100)
+        for i in range(10):
+            report.add("Processing backup item vol-%08d\n" % i)
+
+        rendered = report.render("Total snapshots created: 10\n")
+
+        self.assertIn("vol-00000000", rendered)
+        self.assertNotIn("vol-00000009", rendered)
+        self.assertIn("8 more sections left out", rendered)
+        self.assertTrue(rendered.endswith("Total snapshots created: 10\n"))
+
+    def test_truncate_message(self):
+        self.assertEqual(truncate_message("short"), "short")
+
+        message = truncate_message("x" * (SNS_MESSAGE_BYTES * 2))
+        self.assertEqual(len(message.encode("utf-8")), SNS_MESSAGE_BYTES)
+        self.assertTrue(message.endswith("the full report is in the logs\n"))
+
+    def test_summarise_ids(self):
+        self.assertEqual(summarise_ids(["a", "b"]), "a, b")
+        self.assertEqual(summarise_ids(["a", "b", "c"], limit=2), "a, b and 1 more")
+
+
+class PendingSnapshotLimiterTest(unittest.TestCase):
+    def test_waits_for_snapshots_in_progress(self):
+        refreshed = []
+
+        def refresh(snapshots):
+            refreshed.append(len(snapshots))
+            return snapshots[1:]
+
+        limiter = PendingSnapshotLimiter(2, ["snap-1", "snap-2"], refresh, poll_interval=0.01)
+
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(refreshed, [2])
+        limiter.release(started=["snap-3"])
+        self.assertEqual(limiter.in_progress, ["snap-2", "snap-3"])
+
+    def test_out_of_time(self):
+        limiter = PendingSnapshotLimiter(1, ["snap-1"], lambda snapshots: snapshots, poll_interval=0.01)
+
+        self.assertFalse(limiter.acquire(out_of_time=lambda: True))
+        self.assertEqual(limiter.reserved, 0)
+
+    def test_caps_creates_with_none_in_progress(self):
+        limiter = PendingSnapshotLimiter(2, [], lambda snapshots: snapshots, poll_interval=0.01)
+        deadline = time.time() + 0.2
+        results = []
+
+        def acquire():
+            results.append(limiter.acquire(out_of_time=lambda: time.time() > deadline))
+
+        threads = [threading.Thread(target=acquire) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results), [False] * 4 + [True] * 2)
+        self.assertEqual(limiter.reserved, 2)
+
+    def test_oversized_request_goes_ahead_alone(self):
+        limiter = PendingSnapshotLimiter(2, [], lambda snapshots: snapshots, poll_interval=0.01)
+
+        self.assertTrue(limiter.acquire(count=5))
+        self.assertFalse(limiter.acquire(out_of_time=lambda: True))
+
+    def test_release_does_not_wait_for_refresh(self):
+        released = []
+
+        def refresh(snapshots):
+            # Another worker finishing its create while the check is still running
+            releasing = threading.Thread(target=lambda: released.append(limiter.release(started=["snap-3"])))
+            releasing.start()
+            releasing.join(1)
+            self.assertFalse(releasing.is_alive())
+            return []
+
+        limiter = PendingSnapshotLimiter(1, ["snap-1"], refresh, poll_interval=0.01)
+        limiter.reserved = 1
+
+        self.assertFalse(limiter.acquire(out_of_time=lambda: bool(released)))
+        self.assertEqual(limiter.in_progress, ["snap-3"])
+
+
+class ApiRateLimiterTest(unittest.TestCase):
+    class Response(object):
+        def __init__(self, status_code):
+            self.status_code = status_code
+
+    def setUp(self):
+        service_model = boto3.client('ec2', region_name="ap-southeast-2").meta.service_model
+        self.describe = service_model.operation_model('DescribeSnapshots')
+        self.delete = service_model.operation_model('DeleteSnapshot')
+
+    def error(self, status_code, code):
+        return self.Response(status_code), {'Error': {'Code': code}}
+
+    def test_throttled_calls_are_retried(self):
+        limiter = ApiRateLimiter(rates={'describe': 10}, max_attempts=3)
+
+        self.assertIsNotNone(limiter.needs_retry(1, self.describe, response=self.error(503, 'RequestLimitExceeded')))
+        self.assertIsNotNone(limiter.needs_retry(1, self.delete, response=self.error(400, 'RequestLimitExceeded')))
+        self.assertIsNone(limiter.needs_retry(3, self.describe, response=self.error(503, 'RequestLimitExceeded')))
+
+        self.assertEqual(limiter.bucket_for('ec2', 'DescribeSnapshots').rate, 2.5)
+
+    def test_only_read_only_calls_retried_on_errors(self):
+        limiter = ApiRateLimiter()
+
+        self.assertIsNotNone(limiter.needs_retry(1, self.describe, response=self.error(500, 'InternalError')))
+        self.assertIsNone(limiter.needs_retry(1, self.delete, response=self.error(500, 'InternalError')))
+        self.assertIsNone(limiter.needs_retry(1, self.delete, response=(self.Response(200), {})))
+
+    def test_separate_budgets(self):
+        limiter = ApiRateLimiter(rates={'describe': 30, 'mutate': 3, 'DeleteSnapshot': 1})
+
+        self.assertEqual(limiter.bucket_for('ec2', 'DescribeVolumes').rate, 30)
+        self.assertEqual(limiter.bucket_for('ec2', 'CreateSnapshot').rate, 3)
+        self.assertEqual(limiter.bucket_for('ec2', 'DeleteSnapshot').rate, 1)
+
+    @mock_ec2
+    def test_only_rate_limited_clients_skip_botocore_retries(self):
+        clear_caches()
+        mgr = EC2BackupManager(ec2_region_name="ap-southeast-2",
+                               period="day",
+                               tag_name="Snapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=1,
+                               rate_limiter=ApiRateLimiter())
+
+        self.assertEqual(mgr.conn.meta.config.retries['total_max_attempts'], 1)
+        self.assertNotIn('total_max_attempts', get_client('sns', "ap-southeast-2").meta.config.retries)
+        self.assertIsNot(get_client('ec2', "ap-southeast-2"), mgr.conn)
+
+
+class RetentionPlannerTest(unittest.TestCase):
+    def plan(self, planner, days):
+        start = datetime(2024, 1, 1, 12, tzinfo=UTC)
+        snapshots = [{"Name": "snap-%03d" % day, "Time": start + timedelta(days=day)} for day in days]
+
+        keep, delete = planner.plan(snapshots, lambda snap: snap["Time"], lambda snap: snap["Name"])
+        return [snap["Name"] for snap in keep], [snap["Name"] for snap in delete]
 
-    resource_id = vols["Volumes"][0]["VolumeId"]
-    ec2_boto.create_tags(Resources=[resource_id],
-                         Tags=[{"Key": tag_name, "Value": tag_value}])
+    def test_keep_count(self):
+        keep, delete = self.plan(RetentionPlanner(keep_count=2), [3, 0, 2, 1])
 
-    return resource_id
+        self.assertEqual(keep, ["snap-002", "snap-003"])
+        self.assertEqual(delete, ["snap-000", "snap-001"])
 
+    def test_tiers(self):
+        # Daily snapshots for 10 weeks, 2024-01-01 is a Monday
+        keep, delete = self.plan(RetentionPlanner(tiers={"day": 7, "week": 4}), range(70))
 
-def add_volume_snapshot(resource_id, description, region_name):
-    ec2_boto = boto3.client('ec2', region_name=region_name)
-    current_snap = ec2_boto.create_snapshot(VolumeId=resource_id,
-                                            Description=description)
+        # The last 7 days, plus the Sunday of each of the 3 weeks before that
+        self.assertEqual(keep, ["snap-048", "snap-055"] + ["snap-%03d" % day for day in range(62, 70)])
+        self.assertEqual(len(keep) + len(delete), 70)
 
+    def test_same_time_is_deterministic(self):
+        planner = RetentionPlanner(tiers={"day": 1})
+
+        self.assertEqual(self.plan(planner, [0, 0]), (["snap-000"], ["snap-000"]))
+
+    def test_unknown_tier(self):
+        self.assertRaises(ValueError, RetentionPlanner, tiers={"fortnight": 2})
+        self.assertRaises(ValueError, RetentionPlanner)
 
-class EC2BackupManagerTest(unittest.TestCase):
     @mock_ec2
-    def test_resolve_resource_bytag(self):
-        add_volume("Snapshot", "True", "ap-southeast-1")
-        add_volume("Name", "Anotherone", "ap-southeast-1")
+    def test_tiers_take_over_other_periods(self):
+        region_name = "ap-southeast-2"
 
-        mgr = EC2BackupManager(ec2_region_name="ap-southeast-1",
+        volume = add_volume("Snapshot", "True", region_name)
+        add_volume_snapshot(volume, description="week_snapshot-old", region_name=region_name)
+        add_volume_snapshot(volume, description="month_snapshot-old", region_name=region_name)
+
+        mgr = EC2BackupManager(ec2_region_name=region_name,
                                period="day",
                                tag_name="Snapshot",
                                tag_value="True",
                                date_suffix="dd",
-                               keep_count="2")
+                               keep_count=None,
+                               retention={"day": 1, "week": 1})
 
-        volumes = mgr.get_backable_resources()
+        metrics = mgr.process_backup()
 
-        assert len(volumes) == 1
+        # All taken today, so the new one is the newest of the day and of the week
+        self.assertEqual(metrics["total_creates"], 1)
+        self.assertEqual(metrics["total_deletes"], 1)
+        self.assertIn("keeping 1 day, 1 week", mgr.message)
+        self.assertNotIn("Deleting snapshot month_snapshot-old", mgr.message)
+
+
+class CheckpointTest(unittest.TestCase):
+    class Context(object):
+        def __init__(self, remaining):
+            self.remaining = list(remaining)
+
+        def get_remaining_time_in_millis(self):
+            return self.remaining.pop(0) if len(self.remaining) > 1 else self.remaining[0]
+
+    def test_file_state_store(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = build_state_store('file://' + directory)
+
+            self.assertIsNone(store.load('ec2/ap-southeast-2/day'))
+            store.save('ec2/ap-southeast-2/day', {'phases': {'backup': ['vol-1']}})
+            self.assertEqual(store.load('ec2/ap-southeast-2/day'), {'phases': {'backup': ['vol-1']}})
+            store.delete('ec2/ap-southeast-2/day')
+            self.assertIsNone(store.load('ec2/ap-southeast-2/day'))
+        finally:
+            shutil.rmtree(directory)
+
+    @mock_ec2
+    def test_stop_before_deadline_and_resume(self):
+        region_name = "ap-southeast-2"
+
+        volumes = [add_volume("MakeSnapshot", "True", region_name) for i in range(3)]
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = build_state_store('file://' + directory)
+
+        event = {
+            "period_label": "day",
+            "period_format": "%a%H",
+            "ec2_region_name": region_name,
+            "tag_name": "MakeSnapshot",
+            "tag_value": "True",
+            "keep_count": 2,
+            "state_store": "file://" + directory
+        }
+
+        # Enough time for the first volume only
+        dajson = json.loads(lambda_handler(dict(event), self.Context([60000, 1000])))
+
+        self.assertEqual(dajson["metrics"]["total_resources"], 1)
+        self.assertEqual(dajson["metrics"]["total_unprocessed"], 2)
+        self.assertTrue(dajson["continuation"]["resume"])
+
+        cursor = store.load("ec2/%s/day" % region_name)
+        self.assertEqual(sorted(cursor["phases"]["backup"]), sorted(volumes[1:]))
+
+        dajson = json.loads(lambda_handler(dajson["continuation"], self.Context([60000])))
+
+        self.assertEqual(dajson["metrics"]["total_resources"], 2)
+        self.assertEqual(dajson["metrics"]["total_unprocessed"], 0)
+        self.assertNotIn("continuation", dajson)
+        self.assertIsNone(store.load("ec2/%s/day" % region_name))
+
+    @mock_ec2
+    def test_no_continuation_from_memory(self):
+        add_volume("MakeSnapshot", "True", "ap-southeast-2")
+        add_volume("MakeSnapshot", "True", "ap-southeast-2")
+
+        event = {
+            "period_label": "day",
+            "period_format": "%a%H",
+            "ec2_region_name": "ap-southeast-2",
+            "tag_name": "MakeSnapshot",
+            "tag_value": "True",
+            "keep_count": 2
+        }
+
+        # The follow up would run in another container, with nothing saved to pick up from
+        for option in ("resume", "auto_continue"):
+            with self.assertRaises(ValueError):
+                lambda_handler(dict(event, **{option: True}))
+
+        dajson = json.loads(lambda_handler(dict(event), self.Context([60000, 1000])))
+        self.assertEqual(dajson["metrics"]["total_unprocessed"], 1)
+        self.assertNotIn("continuation", dajson)
+
+
+class SnapshotIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.store = build_state_store('file://' + self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def manager(self):
+        return EC2BackupManager(ec2_region_name="ap-southeast-2",
+                                period="day",
+                                tag_name="MakeSnapshot",
+                                tag_value="True",
+                                date_suffix="dd",
+                                keep_count=1)
+
+    @mock_ec2
+    def test_refresh_between_runs(self):
+        region_name = "ap-southeast-2"
+        volumes = [add_volume("MakeSnapshot", "True", region_name) for i in range(2)]
+
+        def saved_snapshots():
+            state = self.store.load("ec2/%s/snapshot-index" % region_name)
+            return state, [row[0] for row in state["snapshots"] if row[1] in volumes]
+
+        mgr = self.manager()
+        self.assertFalse(load_snapshot_index(mgr, self.store))
+        mgr.process_backup()
+        save_snapshot_index(mgr, self.store)
+
+        state, snapshot_ids = saved_snapshots()
+        self.assertEqual(len(snapshot_ids), 2)
+        self.assertEqual(state["runs"], 0)
+        listed = state["watermark"]
+
+        # Deleted outside the tool, which the saved index knows nothing about
+        ec2_boto = boto3.client('ec2', region_name=region_name)
+        ec2_boto.delete_snapshot(SnapshotId=snapshot_ids[0])
+
+        mgr = self.manager()
+        calls = []
+        mgr.conn.meta.events.register('before-parameter-build',
+                                      lambda model, params, **kwargs: calls.append((model.name, params)))
+        self.assertTrue(load_snapshot_index(mgr, self.store, resync_runs=2))
+        metrics = mgr.process_backup()
+        save_snapshot_index(mgr, self.store)
+
+        # The snapshots were saved in progress, so refreshing them finds the one that is gone
+        self.assertEqual(metrics["total_creates"], 2)
+        self.assertEqual(metrics["total_deletes"], 1)
+        self.assertEqual(metrics["total_delete_errors"], 0)
+        self.assertTrue(all("Filters" in params for name, params in calls if name == "DescribeSnapshots"), calls)
+
+        state, snapshot_ids = saved_snapshots()
+        self.assertEqual(len(snapshot_ids), 2)
+        self.assertEqual(state["runs"], 1)
+
+        # Still dated by the full listing, not the refresh
+        self.assertEqual(state["watermark"], listed)
+
+        # Due a full listing once it has been refreshed for resync_runs
+        self.assertFalse(load_snapshot_index(self.manager(), self.store, resync_runs=2))
+
+        # Or once the full listing is older than max_age_hours, however often it was refreshed since
+        state["watermark"] = format_timestamp(datetime.now(UTC) - timedelta(hours=3))
+        self.store.save("ec2/%s/snapshot-index" % region_name, state)
+        self.assertTrue(load_snapshot_index(self.manager(), self.store, max_age_hours=4))
+        self.assertFalse(load_snapshot_index(self.manager(), self.store, max_age_hours=2))
+
+    @mock_ec2
+    def test_save_merges_with_later_save(self):
+        def snapshot(snapshot_id, volume_id):
+            return {"SnapshotId": snapshot_id, "VolumeId": volume_id, "Description": "day_snapshot " + volume_id,
+                    "StartTime": datetime(2024, 1, 1, 12, 30, 15, 250000, tzinfo=UTC), "State": "completed",
+                    "Tags": [{"Key": PERIOD_TAG, "Value": "day"}]}
+
+        first = self.manager()
+        first.snapshot_index = first.new_snapshot_index()
+        first.index_watermark = first.index_loaded = datetime.now(UTC)
+        first.snapshot_index.add(snapshot("snap-1", "vol-1"))
+        first.snapshot_index.add(snapshot("snap-2", "vol-2"))
+        save_snapshot_index(first, self.store)
+
+        # Two runs start from the same index, the second saves first
+        one, other = self.manager(), self.manager()
+        self.assertTrue(load_snapshot_index(one, self.store))
+        self.assertTrue(load_snapshot_index(other, self.store))
+        other.snapshot_index.add(snapshot("snap-3", "vol-2"))
+        save_snapshot_index(other, self.store)
+
+        one.snapshot_index.discard(snapshot("snap-1", "vol-1"))
+        save_snapshot_index(one, self.store)
+
+        restored = self.manager().restore_snapshot_index(self.store.load("ec2/ap-southeast-2/snapshot-index"))
+        self.assertEqual(sorted(snap["SnapshotId"] for snap in restored), ["snap-2", "snap-3"])
+        self.assertEqual(restored.get("vol-2")[0], snapshot("snap-2", "vol-2"))
+
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def event(self, region_name, **kwargs):
+        event = {
+            "period_label": "day",
+            "period_format": "%a%H",
+            "ec2_region_name": region_name,
+            "rds_region_name": region_name,
+            "tag_name": "MakeSnapshot",
+            "tag_value": "True",
+            "keep_count": 1
+        }
+        event.update(kwargs)
+        return event
+
+    def add_fleet(self, region_name):
+        volume = add_volume("MakeSnapshot", "True", region_name)
+        add_volume("Name", "Anotherone", region_name)
+        add_volume_snapshot(volume, description="day_snapshot-1", region_name=region_name)
+        add_volume_snapshot(volume, description="day_snapshot-2", region_name=region_name)
+
+        add_db_instance("db-plan", {"MakeSnapshot": "True"}, region_name)
+        boto3.client('rds', region_name=region_name).create_db_snapshot(DBInstanceIdentifier="db-plan",
+                                                                         DBSnapshotIdentifier="day-db-plan-1")
+        return volume
+
+    @mock_ec2
+    @mock_rds
+    def test_plan_makes_no_changes(self):
+        region_name = "ap-southeast-2"
+        volume = self.add_fleet(region_name)
+
+        ec2_boto = boto3.client('ec2', region_name=region_name)
+        rds_boto = boto3.client('rds', region_name=region_name)
+
+        dajson = json.loads(lambda_handler(self.event(region_name, mode="plan")))
+
+        plan = dajson["plan"]
+        self.assertEqual([create["resource_id"] for create in plan["ec2"]["creates"]], [volume])
+        self.assertEqual(sorted(delete["snapshot_name"] for delete in plan["ec2"]["deletes"]),
+                         ["day_snapshot-1", "day_snapshot-2"])
+        self.assertEqual([create["resource_id"] for create in plan["rds"]["creates"]], ["db-plan"])
+        self.assertEqual([delete["snapshot_id"] for delete in plan["rds"]["deletes"]], ["day-db-plan-1"])
+
+        snapshots = ec2_boto.describe_snapshots(Filters=[{"Name": "volume-id", "Values": [volume]}])['Snapshots']
+        self.assertEqual(len(snapshots), 2)
+        self.assertEqual(len(rds_boto.describe_db_snapshots(SnapshotType='manual')['DBSnapshots']), 1)
+
+        operations = [operation.split('.')[1] for operation in dajson["metrics"]["api_calls"]]
+        self.assertTrue(all(op.startswith("Describe") for op in operations), operations)
+
+    @mock_ec2
+    @mock_rds
+    def test_plan_from_inventory(self):
+        region_name = "ap-southeast-2"
+        volume = self.add_fleet(region_name)
+
+        live_plan = json.loads(lambda_handler(self.event(region_name, mode="plan")))["plan"]
+
+        inventory_path = os.path.join(self.tempdir, "inventory.json")
+        event_path = os.path.join(self.tempdir, "event.json")
+        with open(event_path, "w") as event_file:
+            json.dump(self.event(region_name), event_file)
+
+        self.assertEqual(main([event_path, "--export-inventory", inventory_path]), 0)
+
+        with open(inventory_path) as inventory_file:
+            inventory = load_inventory(inventory_file)
+        self.assertEqual(len(inventory["ec2"]["Volumes"]), 1)
+        self.assertEqual(len([snap for snap in inventory["ec2"]["Snapshots"] if snap["VolumeId"] == volume]), 2)
+        self.assertEqual(len(inventory["rds"]["DBInstances"]), 1)
+        self.assertEqual(len(inventory["rds"]["DBSnapshots"]), 1)
+
+        offline_plan = json.loads(lambda_handler(self.event(region_name, inventory=inventory_path)))["plan"]
+
+        for service_name in ("ec2", "rds"):
+            self.assertEqual(offline_plan[service_name]["deletes"], live_plan[service_name]["deletes"])
+            self.assertEqual([create["resource_id"] for create in offline_plan[service_name]["creates"]],
+                             [create["resource_id"] for create in live_plan[service_name]["creates"]])
+
+    @mock_ec2
+    @mock_rds
+    def test_sweep_plan_from_inventory(self):
+        region_name = "ap-southeast-2"
+        self.add_fleet(region_name)
+
+        # Still there but backed up by another schedule, and deleted
+        untagged = add_volume("Name", "Anotherone", region_name)
+        add_volume_snapshot(untagged, description="day_snapshot %s_day_1 by snapshot script" % untagged,
+                            region_name=region_name)
+        gone = add_volume("MakeSnapshot", "True", region_name)
+        add_volume_snapshot(gone, description="day_snapshot %s_day_1 by snapshot script" % gone,
+                            region_name=region_name)
+        boto3.client('ec2', region_name=region_name).delete_volume(VolumeId=gone)
+
+        # Each run is given its own copy, the results are written back into the event
+        sweep = {"grace_days": 0, "keep_count": 0}
+        live_plan = json.loads(lambda_handler(self.event(region_name, mode="plan", sweep=dict(sweep))))["sweep"]
+
+        inventory_path = os.path.join(self.tempdir, "inventory.json")
+        event_path = os.path.join(self.tempdir, "event.json")
+        with open(event_path, "w") as event_file:
+            json.dump(self.event(region_name), event_file)
+        self.assertEqual(main([event_path, "--export-inventory", inventory_path]), 0)
+
+        offline_plan = json.loads(lambda_handler(self.event(region_name, inventory=inventory_path,
+                                                             sweep=dict(sweep))))["sweep"]
+
+        self.assertEqual([delete["resource_id"] for delete in live_plan["ec2"]["deletes"]], [gone])
+        self.assertEqual(offline_plan["ec2"]["deletes"], live_plan["ec2"]["deletes"])
+
+    def test_timestamps_round_trip(self):
+        created = datetime(2024, 2, 29, 23, 59, 58, 123456, tzinfo=UTC)
+
+        self.assertEqual(parse_timestamp(format_timestamp(created)), created)
+        self.assertEqual(parse_timestamp("2024-02-29T23:59:58+00:00"), created.replace(microsecond=0))
+
+
+class SweepTest(unittest.TestCase):
+    def add_orphans(self, region_name):
+        ec2_boto = boto3.client('ec2', region_name=region_name)
+
+        def add_tagged_snapshot(volume, description, tags):
+            ec2_boto.create_snapshot(VolumeId=volume, Description=description,
+                                     TagSpecifications=[{"ResourceType": "snapshot",
+                                                         "Tags": [{"Key": k, "Value": v} for k, v in tags.items()]}])
+
+        live = add_volume("MakeSnapshot", "True", region_name)
+        add_volume_snapshot(live, description="day_snapshot %s_day_1 by snapshot script" % live, region_name=region_name)
+        add_volume_snapshot(live, description="day_snapshot %s_day_2 by snapshot script" % live, region_name=region_name)
+
+        gone = add_volume("MakeSnapshot", "True", region_name)
+        for i in range(3):
+            add_volume_snapshot(gone, description="week_snapshot %s_week_%s by snapshot script" % (gone, i),
+                                region_name=region_name)
+        add_volume_snapshot(gone, description="taken by hand", region_name=region_name)
+        # A copy made into this region is swept along with the snapshot it was copied from, in its own region
+        add_tagged_snapshot(gone, "day_snapshot %s_day_1 by snapshot script" % gone,
+                            {PERIOD_TAG: "day", COPY_OF_TAG: "snap-12345678"})
+        ec2_boto.delete_volume(VolumeId=gone)
+
+        # Backed up by another schedule, or from before the schedule tag, either way not this sweep's
+        untagged = add_volume("Name", "Anotherone", region_name)
+        add_volume_snapshot(untagged, description="day_snapshot %s_day_1 by snapshot script" % untagged,
+                            region_name=region_name)
+        add_tagged_snapshot(untagged, "day_snapshot %s_day_2 by snapshot script" % untagged,
+                            {PERIOD_TAG: "day", SCHEDULE_TAG: "MakeSnapshot=Weekly"})
+
+        # Taken under this schedule, then untagged
+        dropped = add_volume("Name", "Dropped", region_name)
+        for i in range(2):
+            add_tagged_snapshot(dropped, "day_snapshot %s_day_%s by snapshot script" % (dropped, i),
+                                {PERIOD_TAG: "day", SCHEDULE_TAG: "MakeSnapshot=True"})
+        return live, gone, untagged, dropped
+
+    def mgr(self, region_name):
+        return EC2BackupManager(ec2_region_name=region_name,
+                                period="day",
+                                tag_name="MakeSnapshot",
+                                tag_value="True",
+                                date_suffix="dd",
+                                keep_count=2)
+
+    def snapshots(self, region_name, volume):
+        ec2_boto = boto3.client('ec2', region_name=region_name)
+        return ec2_boto.describe_snapshots(Filters=[{"Name": "volume-id", "Values": [volume]}])['Snapshots']
+
+    @mock_ec2
+    def test_sweep_orphans(self):
+        region_name = "ap-southeast-2"
+        live, gone, untagged, dropped = self.add_orphans(region_name)
+
+        mgr = self.mgr(region_name)
+        metrics = mgr.sweep_orphans(grace_days=0, keep_count=1)
+
+        self.assertEqual(metrics["total_orphans"], 5)
+        self.assertEqual(metrics["total_deletes"], 3)
+        self.assertEqual(len(self.snapshots(region_name, live)), 2)
+        self.assertEqual(sorted(snap["Description"] for snap in self.snapshots(region_name, gone)),
+                         ["day_snapshot %s_day_1 by snapshot script" % gone,
+                          "taken by hand",
+                          "week_snapshot %s_week_2 by snapshot script" % gone])
+        self.assertEqual(len(self.snapshots(region_name, untagged)), 2)
+        self.assertEqual(len(self.snapshots(region_name, dropped)), 1)
+
+    @mock_ec2
+    def test_sweep_grace_period(self):
+        region_name = "ap-southeast-2"
+        live, gone, untagged, dropped = self.add_orphans(region_name)
+
+        metrics = self.mgr(region_name).sweep_orphans(grace_days=1, keep_count=0)
+
+        self.assertEqual(metrics["total_orphans"], 5)
+        self.assertEqual(metrics["total_deletes"], 0)
+
+    @mock_ec2
+    def test_sweep_copies_in_dr_region(self):
+        region_name = "ap-southeast-2"
+        dr_region_name = "ap-southeast-1"
+        ec2_boto = boto3.client('ec2', region_name=region_name)
+        dr_boto = boto3.client('ec2', region_name=dr_region_name)
+
+        def add_copy(volume, i):
+            description = "day_snapshot %s_day_%s by snapshot script" % (volume, i)
+            snapshot = ec2_boto.create_snapshot(VolumeId=volume, Description=description)
+            tags = {PERIOD_TAG: "day", COPY_OF_TAG: snapshot["SnapshotId"], SOURCE_TAG: volume,
+                    SOURCE_TIME_TAG: format_timestamp(snapshot["StartTime"]), SCHEDULE_TAG: "MakeSnapshot=True"}
+            dr_boto.copy_snapshot(SourceRegion=region_name, SourceSnapshotId=snapshot["SnapshotId"],
+                                  Description=description,
+                                  TagSpecifications=[{"ResourceType": "snapshot",
+                                                      "Tags": [{"Key": k, "Value": v} for k, v in tags.items()]}])
+
+        live = add_volume("MakeSnapshot", "True", region_name)
+        gone = add_volume("MakeSnapshot", "True", region_name)
+        for i in range(3):
+            add_copy(live, i)
+            add_copy(gone, i)
+        ec2_boto.delete_volume(VolumeId=gone)
+
+        mgr = EC2BackupManager(ec2_region_name=region_name,
+                               period="day",
+                               tag_name="MakeSnapshot",
+                               tag_value="True",
+                               date_suffix="dd",
+                               keep_count=5,
+                               copy={"region": dr_region_name})
+        metrics = mgr.sweep_orphans(grace_days=0, keep_count=1)
+
+        # The copies of the deleted volume go the same way as the snapshots they were copied from
+        copies = [EC2BackupManager.tag_list_to_dict(snap.get("Tags", [])).get(SOURCE_TAG)
+                  for snap in dr_boto.describe_snapshots(OwnerIds=["self"])["Snapshots"]]
+        copies = [resource_id for resource_id in copies if resource_id is not None]
+        self.assertEqual(metrics["total_deletes"], 2)
+        self.assertEqual(metrics["total_copy_deletes"], 2)
+        self.assertEqual(sorted(copies), sorted([live] * 3 + [gone]))
+        self.assertEqual(len(self.snapshots(region_name, gone)), 1)
+
+    @mock_ec2
+    def test_sweep_mode(self):
+        region_name = "ap-southeast-2"
+        live, gone, untagged, dropped = self.add_orphans(region_name)
+
+        event = {
+            "period_label": "day",
+            "period_format": "%a%H",
+            "ec2_region_name": region_name,
+            "tag_name": "MakeSnapshot",
+            "tag_value": "True",
+            "keep_count": 2,
+            "mode": "sweep",
+            "sweep": {"grace_days": 0, "keep_count": 0}
+        }
+
+        dajson = json.loads(lambda_handler(event))
+
+        self.assertNotIn("metrics", dajson)
+        self.assertEqual(dajson["sweep"]["ec2"]["metrics"]["total_deletes"], 5)
+        self.assertEqual(len(self.snapshots(region_name, live)), 2)
+        self.assertEqual(len(self.snapshots(region_name, gone)), 2)
+        self.assertEqual(len(self.snapshots(region_name, untagged)), 2)
+        self.assertEqual(len(self.snapshots(region_name, dropped)), 0)
+
+
+class FanOutTest(unittest.TestCase):
+    def event(self, **kwargs):
+        event = {
+            "period_label": "day",
+            "period_format": "%a%H",
+            "tag_name": "MakeSnapshot",
+            "tag_value": "True",
+            "keep_count": 2
+        }
+        event.update(kwargs)
+        return event
+
+    def test_build_targets(self):
+        targets = build_targets(self.event(ec2_region_name=["ap-southeast-2", "us-east-1"],
+                                           rds_region_name="ap-southeast-2",
+                                           role_arns=[None, "arn:aws:iam::111111111111:role/backup"]))
+
+        self.assertEqual(len(targets), 6)
+        self.assertIn(("rds", "ap-southeast-2", "arn:aws:iam::111111111111:role/backup"), targets)
+        self.assertIn(("ec2", "us-east-1", None), targets)
+
+    def test_merge_metrics(self):
+        first = {"total_resources": 2, "total_api_calls": 6, "api_calls_per_resource": 3.0,
+                 "api_calls": {"ec2.CreateSnapshot": {"calls": 2, "p95_ms": 40}}, "phase_timings": {}}
+        second = {"total_resources": 1, "total_api_calls": 1, "api_calls_per_resource": 1.0,
+                  "api_calls": {"ec2.CreateSnapshot": {"calls": 1, "p95_ms": 90}}, "phase_timings": {}}
+
+        merged = merge_metrics([first, second])
+
+        self.assertEqual(merged["total_resources"], 3)
+        self.assertEqual(merged["api_calls_per_resource"], 2.33)
+        self.assertEqual(merged["api_calls"]["ec2.CreateSnapshot"], {"calls": 3, "p95_ms": 90})
+
+    @mock_ec2
+    @mock_sts
+    def test_regions_and_accounts(self):
+        role_arn = "arn:aws:iam::111111111111:role/backup"
+        clear_caches()
+
+        add_volume("MakeSnapshot", "True", "ap-southeast-2")
+        add_volume("MakeSnapshot", "True", "us-east-1")
+
+        # A volume in the other account, created through the role the run assumes
+        get_client('ec2', "ap-southeast-2", role_arn).create_volume(
+            Size=10, AvailabilityZone="ap-southeast-2a",
+            TagSpecifications=[{"ResourceType": "volume", "Tags": [{"Key": "MakeSnapshot", "Value": "True"}]}])
+
+        dajson = json.loads(lambda_handler(self.event(ec2_region_name=["ap-southeast-2", "us-east-1"],
+                                                      role_arns=[None, role_arn])))
+        clear_caches()
+
+        self.assertEqual(dajson["metrics"]["total_resources"], 3)
+        self.assertEqual(dajson["metrics"]["total_creates"], 3)
+        self.assertEqual(len(dajson["targets"]), 4)
+
+        resources = dict(((target["region"], target["role_arn"]), target["metrics"]["total_resources"])
+                         for target in dajson["targets"])
+        self.assertEqual(resources, {("ap-southeast-2", None): 1, ("us-east-1", None): 1,
+                                     ("ap-southeast-2", role_arn): 1, ("us-east-1", role_arn): 0})
+        self.assertIn("==== EC2 us-east-1 ====", dajson["ec2_backup_result"])
+        self.assertIn("==== EC2 ap-southeast-2 as " + role_arn + " ====", dajson["ec2_backup_result"])
+
+
+class ShardTest(unittest.TestCase):
+    def event(self, **kwargs):
+        event = {
+            "period_label": "day",
+            "period_format": "%a%H",
+            "ec2_region_name": "ap-southeast-2",
+            "tag_name": "MakeSnapshot",
+            "tag_value": "True",
+            "keep_count": 2,
+            "shard_count": 3
+        }
+        event.update(kwargs)
+        return event
+
+    def test_shard_of(self):
+        # The same in every invocation, unlike hash()
+        self.assertEqual(shard_of("vol-0123456789abcdef0", 4), shard_of("vol-0123456789abcdef0", 4))
+        self.assertEqual(shard_of("db-1", 1), 0)
+
+        counts = [0] * 4
+        for i in range(1000):
+            counts[shard_of("vol-%08x" % i, 4)] += 1
+        self.assertTrue(all(200 < count < 300 for count in counts), counts)
+
+    @mock_ec2
+    def test_shards_split_the_resources(self):
+        volumes = [add_volume("MakeSnapshot", "True", "ap-southeast-2") for i in range(6)]
+
+        created = []
+        for shard_index in range(3):
+            dajson = json.loads(lambda_handler(self.event(shard_index=shard_index)))
+            self.assertEqual(dajson["metrics"]["total_resources"],
+                             len([v for v in volumes if shard_of(v, 3) == shard_index]))
+            created.append(dajson["metrics"]["total_creates"])
+
+        self.assertEqual(sum(created), 6)
+
+        ec2_boto = boto3.client('ec2', region_name="ap-southeast-2")
+        snapshots = ec2_boto.describe_snapshots(Filters=[{"Name": "volume-id", "Values": volumes}])["Snapshots"]
+        self.assertEqual(sorted(snap["VolumeId"] for snap in snapshots), sorted(volumes))
+
+    @mock_ec2
+    def test_coordinator_merges_the_shards(self):
+        for i in range(6):
+            add_volume("MakeSnapshot", "True", "ap-southeast-2")
+
+        dajson = json.loads(lambda_handler(self.event(mode="plan")))
+
+        self.assertEqual(len(dajson["shards"]), 3)
+        self.assertEqual(dajson["metrics"]["total_resources"], 6)
+        self.assertEqual(sum(shard["metrics"]["total_resources"] for shard in dajson["shards"]), 6)
+
+        # Run in this process, each shard still counts its own calls
+        self.assertTrue(all(shard["metrics"]["total_api_calls"] > 0 for shard in dajson["shards"]), dajson["shards"])
+        self.assertEqual(sum(shard["metrics"]["total_api_calls"] for shard in dajson["shards"]),
+                         dajson["metrics"]["total_api_calls"])
+        self.assertEqual(len(dajson["plan"]["ec2"]["creates"]), 6)
+        self.assertIn("==== Shard 3 of 3 ====", dajson["ec2_backup_result"])
+
+    @mock_ec2
+    def test_managers_keep_their_own_clients(self):
+        def manager(**kwargs):
+            return EC2BackupManager(ec2_region_name="ap-southeast-2",
+                                    period="day",
+                                    tag_name="MakeSnapshot",
+                                    tag_value="True",
+                                    date_suffix="dd",
+                                    keep_count=2,
+                                    **kwargs)
+
+        shards = [manager(shard_index=i, shard_count=2) for i in range(2)]
+        self.assertIsNot(shards[0].conn, shards[1].conn)
+        self.assertIs(manager(shard_index=0, shard_count=2).conn, shards[0].conn)
+
+        # A DR region that is also backed up in its own right
+        mgr = manager(copy={"region": "ap-southeast-2"})
+        self.assertIsNot(mgr.get_replica().conn, mgr.conn)
+
+    @mock_ec2
+    def test_shard_invoke_is_not_retried(self):
+        from botocore.exceptions import ReadTimeoutError
+
+        class Context(object):
+            invoked_function_arn = "arn:aws:lambda:ap-southeast-2:123456789012:function:backup"
+
+        attempts = []
+
+        def timed_out(request, **kwargs):
+            attempts.append(request.url)
+            raise ReadTimeoutError(endpoint_url=request.url)
+
+        clear_caches()
+        region_name = os.environ.get("AWS_DEFAULT_REGION")
+        os.environ["AWS_DEFAULT_REGION"] = "ap-southeast-2"
+        try:
+            get_client('lambda', retries={'max_attempts': 0}).meta.events.register('before-send.lambda.Invoke',
+                                                                                    timed_out)
+
+            # A shard may still be running, so it is reported rather than invoked again
+            result = coordinate_shards(self.event(shard_count=2), Context())
+        finally:
+            if region_name is None:
+                del os.environ["AWS_DEFAULT_REGION"]
+            else:
+                os.environ["AWS_DEFAULT_REGION"] = region_name
+            clear_caches()
+
+        self.assertEqual(len(attempts), 2)
+        self.assertTrue(all("Read timeout" in shard["error"] for shard in result["shards"]), result["shards"])
+
+    def test_shard_index_out_of_range(self):
+        with self.assertRaises(ValueError):
+            lambda_handler(self.event(shard_index=3))
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_api_call_budget(self):
+        budget = load_budget()
+
+        for service_name in ('ec2', 'rds'):
+            report = run_benchmark(service_name, 100)
+
+            self.assertEqual(report['resources'], 100)
+            self.assertEqual(check_budget(report, budget), [])
+
+    def test_plan_only_describes(self):
+        for service_name in ('ec2', 'rds'):
+            report = run_benchmark(service_name, 100, extra_event={'mode': 'plan'})
+
+            self.assertEqual(report['resources'], 100)
+            self.assertTrue(all(op.startswith('Describe') for op in report['calls_per_resource']),
+                            report['calls_per_resource'])
+
+    def test_instance_snapshots_calls(self):
+        report = run_benchmark('ec2', 100, volumes_per_instance=4)
+
+        self.assertEqual(report['resources'], 100)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(report['calls_per_resource']['CreateSnapshots'], 0.25)
+        self.assertNotIn('CreateSnapshot', report['calls_per_resource'])
+        self.assertEqual(check_budget(report, load_budget()), [])
+
+    def test_snapshot_index_calls(self):
+        def listing_calls(report):
+            return sum(calls for op, calls in report['calls_per_resource'].items() if 'Snapshots' in op)
+
+        for service_name in ('ec2', 'rds'):
+            listed = run_benchmark(service_name, 100, runs=2, history=30, keep_count=30)
+            refreshed = run_benchmark(service_name, 100, runs=2, history=30, keep_count=30,
+                                      extra_event={'snapshot_index': {}})
+
+            self.assertEqual(refreshed['errors'], 0)
+            self.assertEqual(refreshed['resources'], 100)
+            self.assertLess(listing_calls(refreshed), listing_calls(listed))
+
+    def test_promote_automated_calls(self):
+        report = run_benchmark('rds', 100, automated=True, extra_event={'promote_automated': {}})
+
+        self.assertEqual(report['resources'], 100)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(report['calls_per_resource']['CopyDBSnapshot'], 0.9)
+        self.assertEqual(report['calls_per_resource']['CopyDBClusterSnapshot'], 0.1)
+        self.assertNotIn('CreateDBSnapshot', report['calls_per_resource'])
+
+    def test_startup_defers_boto3(self):
+        report = measure_startup()
+
+        self.assertEqual(check_startup(report, load_budget()), [])
+        self.assertIn("backuplambda", report["imported"])
 
 
 class LambdaHandlerTest(unittest.TestCase):
@@ -118,3 +1736,35 @@ class LambdaHandlerTest(unittest.TestCase):
         self.assertEqual(dajson["metrics"]["total_creates"], 1)
         self.assertEqual(dajson["metrics"]["total_deletes"], 2)
         self.assertEqual(dajson["metrics"]["total_errors"], 0)
+
+    @mock_ec2
+    def test_ec2_api_call_metrics(self):
+        region_name = "ap-southeast-2"
+
+        add_volume("MakeSnapshot", "True", region_name)
+        add_volume("MakeSnapshot", "True", region_name)
+
+        event = {
+            "period_label": "day",
+            "period_format": "%a%H",
+
+            "ec2_region_name": region_name,
+
+            "tag_name": "MakeSnapshot",
+            "tag_value": "True",
+
+            "keep_count": 2
+        }
+
+        result = lambda_handler(event)
+        dajson = json.loads(result)
+
+        api_calls = dajson["metrics"]["api_calls"]
+        self.assertEqual(api_calls["ec2.DescribeVolumes"]["calls"], 1)
+        self.assertEqual(api_calls["ec2.DescribeSnapshots"]["calls"], 1)
+        self.assertEqual(api_calls["ec2.CreateSnapshot"]["calls"], 2)
+        self.assertEqual(api_calls["ec2.CreateSnapshot"]["retries"], 0)
+
+        self.assertEqual(dajson["metrics"]["total_api_calls"], 4)
+        self.assertEqual(dajson["metrics"]["api_calls_per_resource"], 2)
+        self.assertEqual(sorted(dajson["metrics"]["phase_timings"]), ["create", "list", "tag"])
@@ -19,6 +19,10 @@ fi
 # Install dependancies locally, so they get included in the zip file
 pip install -r requirements.txt -t lambda
 
+# The deployed code is read only, so compile it here rather than on every cold start,
+# this needs to be run with the same python version as the Lambda runtime
+python -m compileall -q lambda/backuplambda.py
+
 aws cloudformation package --profile ${PROFILE}\
   --template-file cloudformation.yaml   \
   --output-template-file generated-cloudformation.yaml    \